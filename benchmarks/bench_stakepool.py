@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Benchmark the stake pool against an in process fake particld.
+
+coldstakepool$ python benchmarks/bench_stakepool.py --stakers=1000 --out=bench.json
+coldstakepool$ python benchmarks/bench_stakepool.py --compare=bench.json
+
+Measures startup time on a new and an existing db, blocks/s while catching
+up and while following zmq notifications (including payment runs) and
+http requests/s per route. With --workers the catch up is repeated with
+that many sync workers and the db is compared with the sequential one.
+Results are written as json.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import urllib.request
+from functools import wraps
+
+import plyvel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from coldstakepool import __version__  # noqa: E402
+from coldstakepool.stakepool import StakePool  # noqa: E402
+from coldstakepool.http_server import HttpThread  # noqa: E402
+from coldstakepool.util import setLogLevel  # noqa: E402
+from fakeparticld import (  # noqa: E402
+    FakeParticld,
+    SyntheticChain,
+    POOL_ADDRESS,
+    REWARD_ADDRESS,
+)
+from replay_rpc import compareDBs  # noqa: E402
+
+
+BLOCK_BUFFER = 100
+HTTP_ROUTES = ('/', '/json', '/json/blocks', '/json/payouts', '/json/metrics?res=day', '/json/address/{address}', '/metrics')
+
+
+def poolSettings(args):
+    return {
+        'mode': 'master',
+        'debug': False,
+        'particlbindir': '',
+        'particldatadir': '',
+        'startheight': 0,
+        'pooladdress': POOL_ADDRESS,
+        'rewardaddress': REWARD_ADDRESS,
+        'rpcauth': 'bench:bench',
+        'rpcport': args.rpcport,
+        'zmqhost': 'tcp://127.0.0.1',
+        'zmqport': args.zmqport,
+        'maxoutputspertx': args.outputs,
+        'zmqrawblock': args.rawblock,
+        'parameters': [{'height': 0, 'payoutthreshold': 0.5, 'minblocksbetweenpayments': args.payment_interval}],
+        'poolownerwithdrawal': {'frequency': 1000000, 'address': REWARD_ADDRESS, 'reserve': 1.0, 'threshold': 1.0},
+    }
+
+
+class Timings():
+    def __init__(self):
+        self.times = []
+
+    def wrap(self, method):
+        @wraps(method)
+        def _impl(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.times.append(time.perf_counter() - start)
+        return _impl
+
+
+def startPool(data_dir, settings):
+    start = time.perf_counter()
+    pool = StakePool(None, data_dir, settings, 'testnet')
+    pool.start()
+    if pool.migration_thread is not None:
+        pool.migration_thread.join()
+    return pool, time.perf_counter() - start
+
+
+def stopPool(pool):
+    pool.stopRunning()
+    pool.shutdown()
+    pool.zmqSubscriber.close()
+    pool.zmqContext.term()
+
+
+def benchHttp(pool, args):
+    server = HttpThread(None, '127.0.0.1', args.httpport, False, pool)
+    server.start()
+    results = {}
+    try:
+        for route in HTTP_ROUTES:
+            path = route.format(address=pool.bench_address)
+            start = time.perf_counter()
+            for i in range(args.requests):
+                with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(args.httpport, path)) as conn:
+                    conn.read()
+            results[route] = round(args.requests / (time.perf_counter() - start), 2)
+    finally:
+        server.stop()
+        server.join()
+    return results
+
+
+def runBenchmarks(args):
+    data_dir = tempfile.mkdtemp(prefix='stakepool_bench_')
+    chain = SyntheticChain(args.blocks + BLOCK_BUFFER, args.stakers, args.pool_block_every, raw_blocks=args.rawblock)
+    daemon = FakeParticld(chain, args.rpcport, args.zmqport, latency=args.rpclatency)
+    daemon.start()
+    settings = poolSettings(args)
+    results = {}
+    try:
+        pool, results['startup_new_db_s'] = startPool(data_dir, settings)
+
+        start = time.perf_counter()
+        while chain.tip - BLOCK_BUFFER > pool.poolHeight:
+            pool.processBlock(pool.poolHeight + 1)
+        results['catchup_blocks_per_s'] = round(args.blocks / (time.perf_counter() - start), 2)
+
+        if args.workers > 1:
+            parallel_dir = os.path.join(data_dir, 'parallel')
+            os.makedirs(parallel_dir)
+            parallel_pool, _ = startPool(parallel_dir, dict(settings, syncworkers=args.workers))
+            start = time.perf_counter()
+            parallel_pool.syncBlocks(chain.tip - BLOCK_BUFFER)
+            results['parallel_catchup_blocks_per_s'] = round(args.blocks / (time.perf_counter() - start), 2)
+            stopPool(parallel_pool)
+            db = plyvel.DB(pool.dbPath)
+            parallel_db = plyvel.DB(parallel_pool.dbPath)
+            results['parallel_matches_sequential'] = compareDBs(db, parallel_db) == 0
+            db.close()
+            parallel_db.close()
+
+        payments = Timings()
+        pool.processPayments = payments.wrap(pool.processPayments)
+        time.sleep(0.5)  # Let the zmq subscription propagate
+
+        start = time.perf_counter()
+        for i in range(args.follow):
+            daemon.mineBlock()
+            last_publish = time.perf_counter()
+            while pool.poolHeight < chain.tip - BLOCK_BUFFER:
+                pool.checkBlocks()
+                if time.perf_counter() - last_publish > 1.0:
+                    daemon.publishBlock()
+                    last_publish = time.perf_counter()
+        results['follow_blocks_per_s'] = round(args.follow / (time.perf_counter() - start), 2)
+        results['payment_runs'] = len(payments.times)
+        results['payment_txns'] = chain.num_sent
+        if len(payments.times) > 0:
+            results['payment_run_mean_s'] = round(sum(payments.times) / len(payments.times), 6)
+            results['payment_run_max_s'] = round(max(payments.times), 6)
+
+        pool.bench_address = chain.staker_addresses[0]
+        results['http_req_per_s'] = benchHttp(pool, args)
+        stopPool(pool)
+
+        pool, results['startup_existing_db_s'] = startPool(data_dir, settings)
+        stopPool(pool)
+    finally:
+        daemon.stop()
+        shutil.rmtree(data_dir)
+
+    for k in ('startup_new_db_s', 'startup_existing_db_s'):
+        results[k] = round(results[k], 4)
+    return results
+
+
+def compareResults(results, previous):
+    for k, v in results.items():
+        old = previous.get(k)
+        if isinstance(v, dict):
+            compareResults({k + ' ' + route: rv for route, rv in v.items()}, {k + ' ' + route: rv for route, rv in (old or {}).items()})
+            continue
+        if not old:
+            print('{}: {}'.format(k, v))
+            continue
+        print('{}: {} ({:+.1f}%)'.format(k, v, (v - old) * 100.0 / old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stake pool benchmarks')
+    parser.add_argument('--stakers', type=int, default=500, help='Number of addresses staking with the pool')
+    parser.add_argument('--pool-block-every', type=int, default=3, help='The pool finds every n\'th block')
+    parser.add_argument('--blocks', type=int, default=500, help='Blocks to process while catching up')
+    parser.add_argument('--follow', type=int, default=200, help='Blocks to process from zmq notifications')
+    parser.add_argument('--payment-interval', type=int, default=20, help='Minimum blocks between payment runs')
+    parser.add_argument('--outputs', type=int, default=48, help='Max outputs per payment tx')
+    parser.add_argument('--requests', type=int, default=200, help='Http requests per route')
+    parser.add_argument('--workers', type=int, default=0, help='Also measure catching up with this many sync workers')
+    parser.add_argument('--rawblock', action='store_true', help='Publish rawblock notifications and read blocks from them')
+    parser.add_argument('--rpclatency', type=float, default=0.0, help='Seconds the fake daemon adds to each rpc call')
+    parser.add_argument('--rpcport', type=int, default=19835)
+    parser.add_argument('--zmqport', type=int, default=19836)
+    parser.add_argument('--httpport', type=int, default=19837)
+    parser.add_argument('--out', default='bench_results.json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Print the change from the results in this file')
+    parser.add_argument('--loglevel', default='error', help='Stake pool log level')
+    args = parser.parse_args()
+
+    setLogLevel(args.loglevel)
+
+    results = runBenchmarks(args)
+    output = {
+        'version': __version__,
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'loglevel')},
+        'results': results,
+    }
+    with open(args.out, 'w') as fp:
+        json.dump(output, fp, indent=4)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compareResults(results, json.load(fp)['results'])
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# In process stand in for particld: a json-rpc server and zmq publisher over a synthetic chain
+
+import json
+import time
+import struct
+import hashlib
+import threading
+import zmq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from coldstakepool.util import encodeAddress, decodeAddress, COIN
+
+
+POOL_ADDRESS = 'tpcs1qqqsyqcyq5rqwzqfpg9scrgwpugpzysn6g5ken'
+REWARD_ADDRESS = 'pUyWGnbNAkb1Db8k9o9AAaGCMu477trzVi'
+OTHER_STAKER = 999999
+GENESIS_TIME = 1600000000
+BLOCK_SPACING = 120
+
+
+def stakerAddress(i):
+    return encodeAddress(bytes([0x77]) + (i + 1).to_bytes(32, 'big'))
+
+
+def makeHash(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def blockHash(height):
+    # Height in the leading bytes so getblockheader needs no lookup table
+    return '%08x' % (height) + makeHash('block%d' % (height))[8:]
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def compactSize(n):
+    if n < 253:
+        return bytes([n])
+    if n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    return b'\xfe' + struct.pack('<I', n)
+
+
+def varBytes(data):
+    return compactSize(len(data)) + data
+
+
+def addressScript(address):
+    # p2pkh for 20 byte hashes, p2pkh256 for 32 byte hashes
+    addr = decodeAddress(address)
+    if len(addr) == 21:
+        return b'\x76\xa9\x14' + addr[1:] + b'\x88\xac'
+    return b'\x76\xa8\x20' + addr[1:] + b'\x88\xac'
+
+
+def serializeCoinstake(height, outputs):
+    # Particl coinstake paying [(address, value)] after the height data output, returns the txn and its txid
+    data = bytes([0xa0, 2]) + struct.pack('<I', 0)
+    data += compactSize(1) + bytes.fromhex(makeHash('kernel%d' % (height)))[::-1] + struct.pack('<I', 0) + varBytes(b'') + struct.pack('<I', 0xffffffff)
+    data += compactSize(1 + len(outputs)) + bytes([4]) + varBytes(struct.pack('<i', height))
+    for address, value in outputs:
+        data += bytes([1]) + struct.pack('<q', value) + varBytes(addressScript(address))
+    return data + compactSize(0), sha256d(data)
+
+
+class SyntheticChain():
+    # Stakers 0..nstakers-1 delegate to the pool, the pool finds every pool_block_every'th block.
+    # With raw_blocks set each block is serialized, blockhashes and coinstake txids are read from the serialization.
+    def __init__(self, tip, nstakers, pool_block_every, raw_blocks=False):
+        self.mx = threading.Lock()
+        self.mx_raw = threading.Lock()
+        self.raw_blocks = [] if raw_blocks else None
+        self.raw_block_heights = {}
+        self.tip = tip
+        self.nstakers = nstakers
+        self.pool_block_every = pool_block_every
+        self.txs = {}
+        self.mined_txs = {}  # height: [txid]
+        self.tx_heights = {}  # txid: height
+        self.mempool = []
+        self.num_sent = 0
+        self.unspent = []  # pool_reward wallet coins returned by listunspent
+        self.staker_addresses = [stakerAddress(i) for i in range(nstakers)]
+        self.other_address = stakerAddress(OTHER_STAKER)
+        self.prevout = {'txid': makeHash('prevout'), 'vout': [{'type': 'standard', 'n': 0, 'value': 1000.0}]}
+        self.txs[self.prevout['txid']] = self.prevout
+
+    def mine(self):
+        with self.mx:
+            self.tip += 1
+            if len(self.mempool) > 0:
+                self.mined_txs[self.tip] = self.mempool
+                for txid in self.mempool:
+                    self.tx_heights[txid] = self.tip
+                self.mempool = []
+            return self.tip
+
+    def blockReward(self, height):
+        # Value and address of the coinstake output
+        return 1.5 + (height % 7) * 0.01, REWARD_ADDRESS if height % self.pool_block_every == 0 else self.other_address
+
+    def rawBlock(self, height):
+        # Serialized block and its hash and coinstake txid
+        with self.mx_raw:
+            while len(self.raw_blocks) <= height:
+                h = len(self.raw_blocks)
+                blockreward, spendaddr = self.blockReward(h)
+                tx, txid = serializeCoinstake(h, [(spendaddr, int(round(blockreward * COIN)))])
+                prevhash = bytes(32) if h == 0 else bytes.fromhex(self.raw_blocks[h - 1]['hash'])[::-1]
+                header = struct.pack('<i', 0xa0000000 - 2 ** 32) + prevhash + txid + bytes(32) + struct.pack('<III', GENESIS_TIME + h * BLOCK_SPACING, 0x1f00ffff, 0)
+                block = {'hash': sha256d(header)[::-1].hex(), 'coinstake': txid[::-1].hex(), 'data': header + compactSize(1) + tx + varBytes(b'')}
+                self.raw_blocks.append(block)
+                self.raw_block_heights[block['hash']] = h
+            return self.raw_blocks[height]
+
+    def getBlockHash(self, height):
+        return blockHash(height) if self.raw_blocks is None else self.rawBlock(height)['hash']
+
+    def getblockreward(self, height):
+        blockreward, spendaddr = self.blockReward(height)
+        return {
+            'blockhash': self.getBlockHash(height),
+            'blocktime': GENESIS_TIME + height * BLOCK_SPACING,
+            'blockreward': blockreward,
+            'coinstake': makeHash('coinstake%d' % (height)) if self.raw_blocks is None else self.rawBlock(height)['coinstake'],
+            'outputs': [{'script': {'spendaddr': spendaddr}, 'value': blockreward}],
+            'kernelscript': {'spendaddr': self.staker_addresses[height % self.nstakers]},
+        }
+
+    def listcoldstakeunspent(self, height):
+        return [{'addrspend': address, 'value': (i % 100 + 1) * 10 * COIN + height}
+                for i, address in enumerate(self.staker_addresses)]
+
+    def sendtypeto(self, outputs, opts=None):
+        with self.mx:
+            if opts is not None and 'inputs' in opts:
+                spent = set((i['tx'], i['n']) for i in opts['inputs'])
+                self.unspent = [u for u in self.unspent if (u['txid'], u['vout']) not in spent]
+            # Same payment at the same height gets the same txid, pools synced from the same chain match
+            txid = makeHash('payout%d%s' % (self.tip, json.dumps(outputs, sort_keys=True)))
+            if txid in self.txs:
+                return {'txid': txid, 'fee': 0.0002 + len(outputs) * 0.00004}
+            self.num_sent += 1
+            total = 0.0
+            vout = []
+            for o in outputs:
+                value = float(o['amount'])
+                total += value
+                vout.append({'type': 'standard', 'n': len(vout), 'value': value, 'scriptPubKey': {'addresses': [o['address']]}})
+            fee = 0.0002 + len(outputs) * 0.00004
+            vout.append({'type': 'standard', 'n': len(vout), 'value': 1000.0 - total - fee, 'scriptPubKey': {'addresses': [REWARD_ADDRESS]}})
+            self.txs[txid] = {'txid': txid, 'vin': [{'txid': self.prevout['txid'], 'vout': 0}], 'vout': vout}
+            self.mempool.append(txid)
+            return {'txid': txid, 'fee': fee}
+
+    def handle(self, method, params, wallet):
+        if method == 'getblockreward':
+            return self.getblockreward(params[0])
+        if method == 'listcoldstakeunspent':
+            return self.listcoldstakeunspent(params[1])
+        if method == 'getaddressdeltas':
+            return [{'txid': txid, 'satoshis': 1} for txid in self.mined_txs.get(params[0]['start'], [])]
+        if method == 'getrawtransaction':
+            tx = self.txs[params[0]]
+            if params[0] in self.tx_heights:
+                height = self.tx_heights[params[0]]
+                tx = dict(tx, blockhash=self.getBlockHash(height), blocktime=GENESIS_TIME + height * BLOCK_SPACING, confirmations=self.tip - height + 1)
+            return tx
+        if method == 'sendtypeto':
+            return self.sendtypeto(params[2], params[8] if len(params) > 8 else None)
+        if method == 'getblockchaininfo':
+            return {'chain': 'test', 'blocks': self.tip, 'bestblockhash': self.getBlockHash(self.tip)}
+        if method == 'getblockhash':
+            if params[0] > self.tip:
+                raise ValueError('Block height out of range')
+            return self.getBlockHash(params[0])
+        if method == 'getblockheader':
+            height = int(params[0][:8], 16) if self.raw_blocks is None else self.raw_block_heights.get(params[0], self.tip + 1)
+            if height > self.tip or self.getBlockHash(height) != params[0]:
+                raise ValueError('Block not found')
+            return {'hash': params[0], 'height': height, 'time': GENESIS_TIME + height * BLOCK_SPACING}
+        if method == 'walletsettings':
+            if wallet == 'pool_stake':
+                return {'stakingoptions': {'rewardaddress': REWARD_ADDRESS}}
+            return {'stakingoptions': {'enabled': False}}
+        if method == 'validateaddress':
+            return {'isvalid': True, 'address': params[0]}
+        if method == 'getnetworkinfo':
+            return {'version': 23000000}
+        if method == 'getwalletinfo':
+            return {'balance': 0.0, 'watchonly_total_balance': 100.0, 'watchonly_staked_balance': 0.0}
+        if method == 'getstakinginfo':
+            return {'weight': 100 * COIN}
+        if method == 'listunspent':
+            return list(self.unspent)
+        if method == 'votehistory':
+            return []
+        raise ValueError('Method not found: ' + method)
+
+
+class RpcHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def handleRequest(self, request, wallet):
+        try:
+            response = {'result': self.server.chain.handle(request['method'], request['params'], wallet), 'error': None}
+        except Exception as e:
+            response = {'result': None, 'error': {'code': -1, 'message': str(e)}}
+        response['id'] = request.get('id')
+        return response
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        path = self.path.split('/')
+        wallet = path[2] if len(path) > 2 and path[1] == 'wallet' else None
+        if isinstance(request, list):
+            response = [self.handleRequest(r, wallet) for r in request]
+        else:
+            response = self.handleRequest(request, wallet)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeParticld():
+    def __init__(self, chain, rpc_port, zmq_port, host='127.0.0.1', latency=0.0):
+        self.chain = chain
+        self.rpc_server = ThreadingHTTPServer((host, rpc_port), RpcHandler)
+        self.rpc_server.daemon_threads = True
+        self.rpc_server.chain = chain
+        self.rpc_server.latency = latency  # Seconds added to each rpc call
+        self.rpc_thread = threading.Thread(target=self.rpc_server.serve_forever, name='fakerpc', daemon=True)
+
+        self.zmq_context = zmq.Context()
+        self.zmq_publisher = self.zmq_context.socket(zmq.PUB)
+        self.zmq_publisher.bind('tcp://{}:{}'.format(host, zmq_port))
+        self.zmq_sequence = 0
+
+    def start(self):
+        self.rpc_thread.start()
+
+    def stop(self):
+        self.rpc_server.shutdown()
+        self.rpc_server.server_close()
+        self.zmq_publisher.close()
+        self.zmq_context.term()
+
+    def publishBlock(self):
+        tip = self.chain.tip
+        self.zmq_publisher.send_multipart([b'hashblock', bytes.fromhex(self.chain.getBlockHash(tip)), struct.pack('<I', self.zmq_sequence)])
+        if self.chain.raw_blocks is not None:
+            self.zmq_publisher.send_multipart([b'rawblock', self.chain.rawBlock(tip)['data'], struct.pack('<I', self.zmq_sequence)])
+        self.zmq_sequence += 1
+
+    def mineBlock(self):
+        self.chain.mine()
+        self.publishBlock()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Replay rpc traffic recorded with the 'rpcrecord' setting and time the sync.
+
+Record on a live pool:
+    Copy <datadir>/stakepooldb to keep the starting state,
+    set "rpcrecord": "<path>/rpc.jsonl.gz" in stakepool.json and run the pool.
+
+Replay offline:
+    coldstakepool$ python benchmarks/replay_rpc.py --datadir=<datadir> --recording=rpc.jsonl.gz \\
+        --startdb=<copy of stakepooldb> --reference=<datadir>/stakepooldb
+
+The pool processes every recorded block on a copy of the starting db, the
+result is compared key by key against the reference db.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+import plyvel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coldstakepool.stakepool import StakePool  # noqa: E402
+from coldstakepool.util import setLogLevel  # noqa: E402
+
+
+def recordedHeights(path):
+    heights = set()
+    with gzip.open(path, 'rt') as fp:
+        for line in fp:
+            record = json.loads(line)
+            if record['m'] == 'getblockreward' and 'r' in record:
+                heights.add(record['p'][0])
+    return heights
+
+
+def dbDigest(db):
+    h = hashlib.sha256()
+    num_records = 0
+    for k, v in db.iterator():
+        h.update(len(k).to_bytes(4, 'big') + k + len(v).to_bytes(4, 'big') + v)
+        num_records += 1
+    return h.hexdigest(), num_records
+
+
+def compareDBs(db, reference, max_report=10):
+    num_diffs = 0
+    it_a = db.iterator()
+    it_b = reference.iterator()
+    a = next(it_a, None)
+    b = next(it_b, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            diff, a = ('extra', a[0]), next(it_a, None)
+        elif a is None or b[0] < a[0]:
+            diff, b = ('missing', b[0]), next(it_b, None)
+        else:
+            diff = ('value', a[0]) if a[1] != b[1] else None
+            a, b = next(it_a, None), next(it_b, None)
+        if diff is not None:
+            if num_diffs < max_report:
+                print('{} key {}'.format(diff[0], diff[1].hex()))
+            num_diffs += 1
+    return num_diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded stake pool rpc traffic')
+    parser.add_argument('--datadir', required=True, help='Pool datadir to read stakepool.json from')
+    parser.add_argument('--recording', required=True, help='File written by the \'rpcrecord\' setting')
+    parser.add_argument('--startdb', help='Copy of the pool db from when recording started, omit to start from an empty db')
+    parser.add_argument('--reference', help='Db to compare the result against')
+    parser.add_argument('--chain', default='mainnet')
+    parser.add_argument('--toheight', type=int, help='Stop after this height, default the last recorded block')
+    parser.add_argument('--loglevel', default='error', help='Stake pool log level')
+    args = parser.parse_args()
+
+    setLogLevel(args.loglevel)
+
+    with open(os.path.join(os.path.expanduser(args.datadir), 'stakepool.json')) as fp:
+        settings = json.load(fp)
+    settings.pop('rpcrecord', None)
+    settings['rpcreplay'] = args.recording
+
+    heights = recordedHeights(args.recording)
+    if len(heights) < 1:
+        print('No blocks recorded.')
+        return 1
+    to_height = max(heights) if args.toheight is None else args.toheight
+
+    work_dir = tempfile.mkdtemp(prefix='stakepool_replay_')
+    try:
+        if args.startdb:
+            shutil.copytree(os.path.expanduser(args.startdb), os.path.join(work_dir, 'stakepooldb'))
+
+        start = time.perf_counter()
+        pool = StakePool(None, work_dir, settings, args.chain)
+        pool.start()
+        if pool.migration_thread is not None:
+            pool.migration_thread.join()
+        startup_time = time.perf_counter() - start
+
+        from_height = pool.poolHeight
+        start = time.perf_counter()
+        while pool.poolHeight < to_height and pool.is_running:
+            pool.processBlock(pool.poolHeight + 1)
+        sync_time = time.perf_counter() - start
+        pool.stopRunning()
+        pool.shutdown()
+
+        num_blocks = pool.poolHeight - from_height
+        print('Startup: {:.3f}s'.format(startup_time))
+        print('Processed {} blocks, {} to {} in {:.3f}s, {:.2f} blocks/s'.format(
+            num_blocks, from_height + 1, pool.poolHeight, sync_time, num_blocks / sync_time if sync_time > 0 else 0))
+
+        db = plyvel.DB(os.path.join(work_dir, 'stakepooldb'))
+        try:
+            print('Result db sha256: {}, {} records'.format(*dbDigest(db)))
+            if args.reference is None:
+                return 0
+            reference = plyvel.DB(os.path.expanduser(args.reference))
+            try:
+                num_diffs = compareDBs(db, reference)
+            finally:
+                reference.close()
+        finally:
+            db.close()
+        print('Db matches reference.' if num_diffs == 0 else '{} differing records.'.format(num_diffs))
+        return 0 if num_diffs == 0 else 1
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,14 +18,18 @@ import traceback
 
 from coldstakepool import __version__
 from coldstakepool.stakepool import StakePool
+from coldstakepool.profiler import Profiler
 from coldstakepool.http_server import HttpThread
 from coldstakepool.util import (
     logmt,
-    callrpc,
+    setLogLevel,
+    startLogThread,
+    stopLogThread,
 )
 
 ALLOW_CORS = True
 stakePool = None
+profiler = None
 
 
 def signal_handler(sig, frame):
@@ -34,8 +38,14 @@ def signal_handler(sig, frame):
         stakePool.stopRunning()
 
 
-def runStakePool(dataDir, chain):
-    global stakePool
+def profile_signal_handler(sig, frame):
+    # Logging from a signal handler can deadlock on the log queue, the profiler's watcher thread starts it
+    if profiler is not None:
+        profiler.request()
+
+
+def runStakePool(dataDir, chain, export_path=None, import_path=None):
+    global stakePool, profiler
     settings_path = os.path.join(dataDir, 'stakepool.json')
 
     if not os.path.exists(settings_path):
@@ -50,9 +60,17 @@ def runStakePool(dataDir, chain):
             fp = open(os.path.join(dataDir, 'stakepool.log'), 'w')
 
         log_time: bool = settings.get('logtime', True)
+        setLogLevel(settings.get('loglevel', 'debug'))
+        startLogThread(settings.get('logflushinterval', 0.5))
         logmt(fp, os.path.basename(sys.argv[0]) + ', version: ' + __version__ + '\n\n', log_time=log_time)
 
         stakePool = StakePool(fp, dataDir, settings, chain)
+        profiler = Profiler(dataDir, settings, stakePool.log)
+        profiler.watch()
+        if settings.get('profileatstart', False):
+            profiler.start()
+        if import_path is not None:
+            stakePool.importSnapshot(import_path)
         stakePool.start()
 
         threads = []
@@ -65,10 +83,17 @@ def runStakePool(dataDir, chain):
             threads.append(tS1)
             tS1.start()
 
+        while stakePool.db_upgrading and stakePool.is_running:
+            time.sleep(0.5)
+
+        if export_path is not None and stakePool.is_running:
+            stakePool.exportSnapshot(export_path)
+            stakePool.stopRunning()
+
         try:
-            r = callrpc(stakePool.rpc_port, stakePool.rpc_auth, 'getblockchaininfo')
-            while r['blocks'] - stakePool.blockBuffer > stakePool.poolHeight and stakePool.is_running:
-                stakePool.processBlock(stakePool.poolHeight + 1)
+            r = stakePool.rpc_func('getblockchaininfo')
+            stakePool.chainHeight = r['blocks']
+            stakePool.syncBlocks(r['blocks'] - stakePool.blockBuffer)
         except Exception as ex:
             traceback.print_exc()
 
@@ -80,7 +105,11 @@ def runStakePool(dataDir, chain):
         for t in threads:
             t.stop()
             t.join()
+        stakePool.shutdown()
     finally:
+        if profiler is not None:
+            profiler.stop()
+        stopLogThread()
         if fp:
             fp.close()
 
@@ -91,11 +120,15 @@ def printVersion():
 
 def printHelp():
     print('coldstakepool-run --datadir=path -testnet')
+    print('  --exportsnapshot=path   Write a snapshot of the pool db at the synced height and exit.')
+    print('  --importsnapshot=path   Start a new pool from a snapshot, then continue syncing.')
 
 
 def main():
     dataDir = None
     chain = 'mainnet'
+    export_path = None
+    import_path = None
 
     for v in sys.argv[1:]:
         if len(v) < 2 or v[0] != '-':
@@ -126,6 +159,12 @@ def main():
             if name == 'datadir':
                 dataDir = os.path.expanduser(s[1])
                 continue
+            if name == 'exportsnapshot':
+                export_path = os.path.expanduser(s[1])
+                continue
+            if name == 'importsnapshot':
+                import_path = os.path.expanduser(s[1])
+                continue
 
         print('Unknown argument', v)
 
@@ -138,12 +177,14 @@ def main():
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profile_signal_handler)
     print('Ctrl + c to exit.')
 
     if not os.path.exists(dataDir):
         os.makedirs(dataDir)
 
-    runStakePool(dataDir, chain)
+    runStakePool(dataDir, chain, export_path, import_path)
 
     print('Done.')
     return stakePool.fail_code if stakePool is not None else 0
@@ -13,6 +13,8 @@ chainparams = {
         'rpcport': 51735,
         'pubkey_address': 0x38,
         'script_address': 0x3c,
+        'pubkey_address_256': 0x39,
+        'script_address_256': 0x3d,
         'key_prefix': 0x6c,
         'hrp': 'pw',
         'bip44': 44,
@@ -21,6 +23,8 @@ chainparams = {
         'rpcport': 51935,
         'pubkey_address': 0x76,
         'script_address': 0x7a,
+        'pubkey_address_256': 0x77,
+        'script_address_256': 0x7b,
         'key_prefix': 0x2e,
         'hrp': 'tpw',
         'bip44': 1,
@@ -29,6 +33,8 @@ chainparams = {
         'rpcport': 51936,
         'pubkey_address': 0x76,
         'script_address': 0x7a,
+        'pubkey_address_256': 0x77,
+        'script_address_256': 0x7b,
         'key_prefix': 0x2e,
         'hrp': 'rtpw',
         'bip44': 1,
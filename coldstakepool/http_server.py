@@ -6,19 +6,37 @@
 
 import os
 import time
-import decimal
+import urllib.parse
 import hashlib
 import threading
 import http.client
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from . import telemetry
+from .stakepool import HISTORY_PAGE_SIZE
 from .util import (
-    COIN,
     json,
     makeInt,
+    amountToSats,
     format8,
     format16,
 )
 
+PAGE_ROUTES = ('config', 'json', 'address', 'version', 'voting', 'metrics', 'changes')
+MAX_CHANGE_RECORDS = 1000
+JSON_ROUTES = ('address', 'metrics', 'version', 'voting', 'pending', 'blocks', 'payouts', 'payoutstatus', 'paymentjobs')
+
+
+def routeName(path):
+    # Bounded route label for the request latency metrics
+    urlSplit = urllib.parse.urlparse(path).path.split('/')
+    if len(urlSplit) < 2 or urlSplit[1] == '':
+        return 'index'
+    if urlSplit[1] not in PAGE_ROUTES:
+        return 'other'
+    if urlSplit[1] == 'json' and len(urlSplit) > 2 and urlSplit[2] in JSON_ROUTES:
+        return 'json/' + urlSplit[2]
+    return urlSplit[1]
+
 
 class HttpHandler(BaseHTTPRequestHandler):
     def page_error(self, error_str):
@@ -35,24 +53,39 @@ class HttpHandler(BaseHTTPRequestHandler):
         error_str_json = json.dumps({'error': error_str})
         return bytes(error_str_json, 'UTF-8')
 
-    def js_address(self, urlSplit):
+    def js_address(self, urlSplit, query):
         if len(urlSplit) < 4:
             raise ValueError('Must specify address')
         address_str = urlSplit[3]
         stakePool = self.server.stakePool
+        if len(urlSplit) > 4 and urlSplit[4] == 'history':
+            cursor = query['cursor'][0] if 'cursor' in query else None
+            limit = int(query['limit'][0]) if 'limit' in query else HISTORY_PAGE_SIZE
+            return bytes(json.dumps(stakePool.getAddressHistory(address_str, cursor, limit)), 'UTF-8')
         return bytes(json.dumps(stakePool.getAddressSummary(address_str)), 'UTF-8')
 
-    def js_metrics(self, urlSplit):
+    def js_metrics(self, urlSplit, query):
         stakePool = self.server.stakePool
         if len(urlSplit) > 3:
             code_str = urlSplit[3]
             hashed = hashlib.sha256(str(code_str + self.server.management_key_salt).encode('utf-8')).hexdigest()
             if not hashed == self.server.management_key_hash:
                 raise ValueError('Unknown argument')
-            return bytes(json.dumps(stakePool.rebuildMetrics()), 'UTF-8')
+            return bytes(json.dumps(stakePool.requestRebuildMetrics()), 'UTF-8')
+        if 'res' in query or 'from' in query or 'to' in query:
+            resolution = query.get('res', ['day'])[0]
+            time_from = int(query['from'][0]) if 'from' in query else None
+            time_to = int(query['to'][0]) if 'to' in query else None
+            return bytes(json.dumps(stakePool.getPeriodMetrics(resolution, time_from, time_to)), 'UTF-8')
         return bytes(json.dumps(stakePool.getMetrics()), 'UTF-8')
 
-    def js_pending(self, urlSplit):
+    def js_history(self, urlSplit, query):
+        cursor = query['cursor'][0] if 'cursor' in query else None
+        height = int(query['height'][0]) if 'height' in query else None
+        limit = int(query['limit'][0]) if 'limit' in query else HISTORY_PAGE_SIZE
+        return bytes(json.dumps(self.server.stakePool.getHistoryPage(urlSplit[2], cursor, height, limit)), 'UTF-8')
+
+    def js_pending(self, urlSplit, query):
         stakePool = self.server.stakePool
         if len(urlSplit) > 3:
             code_str = urlSplit[3]
@@ -60,7 +93,29 @@ class HttpHandler(BaseHTTPRequestHandler):
             if not hashed == self.server.management_key_hash:
                 raise ValueError('Unknown argument')
             return bytes(json.dumps(stakePool.getPending(True)), 'UTF-8')
-        return bytes(json.dumps(stakePool.getPending()), 'UTF-8')
+        cursor = query['cursor'][0] if 'cursor' in query else None
+        limit = int(query['limit'][0]) if 'limit' in query else HISTORY_PAGE_SIZE
+        return bytes(json.dumps(stakePool.getPendingPage(cursor, limit)), 'UTF-8')
+
+    def js_route(self, urlSplit, query):
+        if len(urlSplit) > 2:
+            if urlSplit[2] == 'address':
+                return self.js_address(urlSplit, query)
+            if urlSplit[2] == 'metrics':
+                return self.js_metrics(urlSplit, query)
+            if urlSplit[2] == 'version':
+                return bytes(json.dumps(self.server.stakePool.getVersions()), 'UTF-8')
+            if urlSplit[2] == 'voting':
+                return bytes(json.dumps(self.server.stakePool.getVotingInfo()), 'UTF-8')
+            if urlSplit[2] == 'pending':
+                return self.js_pending(urlSplit, query)
+            if urlSplit[2] == 'payoutstatus':
+                return bytes(json.dumps(self.server.stakePool.getPayoutStatus()), 'UTF-8')
+            if urlSplit[2] == 'paymentjobs':
+                return bytes(json.dumps(self.server.stakePool.getPaymentJobs()), 'UTF-8')
+            if urlSplit[2] in ('blocks', 'payouts'):
+                return self.js_history(urlSplit, query)
+        return self.js_index(urlSplit)
 
     def js_index(self, urlSplit):
         return bytes(json.dumps(self.server.stakePool.getSummary()), 'UTF-8')
@@ -182,7 +237,7 @@ class HttpHandler(BaseHTTPRequestHandler):
             + 'Total Pool Fees: ' + format8(summary['poolfeestotal']) + '<br/>' \
             + 'Total Pool Rewards Withdrawn: ' + format8(summary['poolwithdrawntotal']) + '<br/>' \
             + '<br/>' \
-            + 'Total Pooled Coin: ' + format8(int(decimal.Decimal(summary['watchonlytotalbalance']) * COIN)) + '<br/>' \
+            + 'Total Pooled Coin: ' + format8(amountToSats(summary['watchonlytotalbalance'])) + '<br/>' \
             + 'Currently Staking: ' + format8(summary['stakeweight']) + '<br/>' \
             + '</p>'
 
@@ -225,28 +280,41 @@ class HttpHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def handle_http(self, status_code, path):
-        urlSplit = self.path.split('/')
+        parsed = urllib.parse.urlparse(self.path)
+        urlSplit = parsed.path.split('/')
+        query = urllib.parse.parse_qs(parsed.query)
         is_json = False
         try:
             if len(urlSplit) > 1:
                 if urlSplit[1] == 'config':
                     self.putHeaders(status_code, 'text/plain')
                     return self.page_config(urlSplit)
+                if urlSplit[1] == 'metrics':
+                    self.putHeaders(status_code, 'text/plain; version=0.0.4')
+                    return bytes(self.server.stakePool.getTelemetry(), 'UTF-8')
+                if urlSplit[1] == 'changes' and len(urlSplit) > 2:
+                    # As for the json routes the headers are sent once the content is known
+                    try:
+                        height = int(urlSplit[2])
+                        count = min(int(query['count'][0]), MAX_CHANGE_RECORDS) if 'count' in query else 1
+                        if height < 0 or height > 0x7FFFFFFF or count < 1:
+                            raise ValueError('Invalid argument')
+                        content = self.server.stakePool.getChanges(height, count)
+                    except Exception as e:
+                        self.putHeaders(400 if isinstance(e, ValueError) else status_code, 'text/plain')
+                        raise
+                    self.putHeaders(status_code, 'application/octet-stream')
+                    return content
                 if urlSplit[1] == 'json':
                     is_json = True
+                    # The headers are sent once the content is known, invalid arguments are reported as 400
+                    try:
+                        content = self.js_route(urlSplit, query)
+                    except Exception as e:
+                        self.putHeaders(400 if isinstance(e, ValueError) else status_code, 'text/plain')
+                        raise
                     self.putHeaders(status_code, 'text/plain')
-                    if len(urlSplit) > 2:
-                        if urlSplit[2] == 'address':
-                            return self.js_address(urlSplit)
-                        if urlSplit[2] == 'metrics':
-                            return self.js_metrics(urlSplit)
-                        if urlSplit[2] == 'version':
-                            return bytes(json.dumps(self.server.stakePool.getVersions()), 'UTF-8')
-                        if urlSplit[2] == 'voting':
-                            return bytes(json.dumps(self.server.stakePool.getVotingInfo()), 'UTF-8')
-                        if urlSplit[2] == 'pending':
-                            return self.js_pending(urlSplit)
-                    return self.js_index(urlSplit)
+                    return content
                 self.putHeaders(status_code, 'text/html')
                 if urlSplit[1] == 'address':
                     return self.page_address(urlSplit)
@@ -266,8 +334,10 @@ class HttpHandler(BaseHTTPRequestHandler):
             return self.js_error(str(e)) if is_json else self.page_error(str(e))
 
     def do_GET(self):
+        start = time.perf_counter()
         response = self.handle_http(200, self.path)
         self.wfile.write(response)
+        telemetry.http_latency.observe(time.perf_counter() - start, routeName(self.path))
 
     def do_HEAD(self):
         self.putHeaders(200, 'text/html')
@@ -282,7 +352,7 @@ class HttpHandler(BaseHTTPRequestHandler):
 
 class HttpThread(threading.Thread, HTTPServer):
     def __init__(self, fp, hostName, portNo, allow_cors, stakePool, key_salt=None, key_hash=None):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='http')
 
         self.stop_event = threading.Event()
         self.fp = fp
@@ -301,11 +371,15 @@ class HttpThread(threading.Thread, HTTPServer):
 
         # Send fake request
         conn = http.client.HTTPConnection(self.hostName, self.portNo)
-        conn.connect()
-        conn.request('GET', '/none')
-        response = conn.getresponse()
-        data = response.read()
-        conn.close()
+        try:
+            conn.connect()
+            conn.request('GET', '/none')
+            response = conn.getresponse()
+            data = response.read()
+        except ConnectionError:
+            pass  # The server stopped before handling the request
+        finally:
+            conn.close()
 
     def stopped(self):
         return self.stop_event.is_set()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Splits payment run outputs into txns by estimated size instead of a fixed output count
+
+import bisect
+import itertools
+
+from .util import decodeAddress, amountToSats
+
+
+TX_OVERHEAD = 14  # Version, type, locktime and input and output counts
+INPUT_SIZE = 149  # Outpoint, empty scriptSig, sequence and a signature and pubkey witness
+OUTPUT_OVERHEAD = 10  # Type, value and script length
+CHANGE_OUTPUT_SIZE = OUTPUT_OVERHEAD + 25
+MAX_STANDARD_TX_SIZE = 100000
+DEFAULT_MAX_TX_SIZE = 90000  # Margin below the standard limit for estimation error
+
+
+def outputSize(address):
+    # 20 byte hashes are p2pkh or p2sh, 32 byte hashes the 256 bit variants
+    return OUTPUT_OVERHEAD + (25 if len(decodeAddress(address)) == 21 else 37)
+
+
+def inputsNeeded(totals, value):
+    # totals are the running sums of the coins largest first,
+    # returns the number of inputs and the change, inputs is 0 if the coins don't cover value
+    i = bisect.bisect_left(totals, value)
+    if i >= len(totals):
+        return 0, 0
+    return i + 1, totals[i] - value
+
+
+def estimateTxSize(num_inputs, outputs_size):
+    return TX_OVERHEAD + num_inputs * INPUT_SIZE + outputs_size + CHANGE_OUTPUT_SIZE
+
+
+def planPayoutTxns(outputs, utxos, max_size, fee_per_kb):
+    # Returns [(num_outputs, estimated_size)], each txn is filled to max_size.
+    # utxos are the values of the wallet coins, change from each txn is assumed to fund the next.
+    # Without coin values each txn is assumed to need one input.
+    utxos = sorted(utxos, reverse=True)
+    totals = list(itertools.accumulate(utxos))
+    plan = []
+    i = 0
+    while i < len(outputs):
+        outputs_size = 0
+        value = 0
+        n = 0
+        size = estimateTxSize(1, 0)
+        while i + n < len(outputs):
+            next_outputs_size = outputs_size + outputSize(outputs[i + n]['address'])
+            next_value = value + amountToSats(outputs[i + n]['amount'])
+            num_inputs = 1
+            if len(utxos) > 0:
+                fee = estimateTxSize(1, next_outputs_size) * fee_per_kb // 1000
+                num_inputs, change = inputsNeeded(totals, next_value + fee)
+                if num_inputs == 0:
+                    num_inputs = len(utxos)  # The send will fail, keep the plan bounded
+            next_size = estimateTxSize(num_inputs, next_outputs_size)
+            if n > 0 and next_size > max_size:
+                break
+            outputs_size, value, size = next_outputs_size, next_value, next_size
+            n += 1
+
+        if len(utxos) > 0:
+            fee = size * fee_per_kb // 1000
+            num_inputs, change = inputsNeeded(totals, value + fee)
+            if num_inputs > 0:
+                utxos = sorted(utxos[num_inputs:] + [change], reverse=True)
+                totals = list(itertools.accumulate(utxos))
+        plan.append((n, size))
+        i += n
+    return plan
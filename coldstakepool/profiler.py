@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Samples the stacks of running threads and writes them in the folded format read by flamegraph.pl and speedscope
+
+import os
+import sys
+import time
+import threading
+
+
+PROFILE_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+PROFILE_THREADS = ('MainThread', 'http')
+
+
+def foldStack(thread_name, frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, out_dir, seconds=PROFILE_SECONDS, interval=PROFILE_INTERVAL, thread_names=PROFILE_THREADS, log=None):
+        threading.Thread.__init__(self, name='profiler', daemon=True)
+        self.out_dir = out_dir
+        self.log = log
+        self.seconds = seconds
+        self.interval = interval
+        self.thread_names = thread_names
+        self.stacks = {}
+        self.num_samples = 0
+        self.out_path = None
+
+    def sample(self):
+        names = {t.ident: t.name for t in threading.enumerate() if t.name in self.thread_names}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident)
+            if name is None:
+                continue
+            stack = foldStack(name, frame)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.num_samples += 1
+
+    def run(self):
+        end = time.time() + self.seconds
+        while time.time() < end:
+            self.sample()
+            time.sleep(self.interval)
+
+        self.out_path = os.path.join(self.out_dir, time.strftime('profile_%Y%m%d_%H%M%S.folded'))
+        with open(self.out_path, 'w') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write('{} {}\n'.format(stack, count))
+        if self.log is not None:
+            self.log('Wrote %d profile samples to %s' % (self.num_samples, self.out_path))
+
+
+class Profiler():
+    # Runs one sampling window at a time.
+    # A signal handler only calls request(), the window is started and logged by the watcher thread,
+    # which doesn't wait for the main loop to be idle.
+    def __init__(self, out_dir, settings, log=None):
+        self.out_dir = out_dir
+        self.log = log
+        self.seconds = settings.get('profileseconds', PROFILE_SECONDS)
+        self.interval = settings.get('profileinterval', PROFILE_INTERVAL)
+        self.thread_names = tuple(settings.get('profilethreads', PROFILE_THREADS))
+        self.sampler = None
+        self.requested = threading.Event()
+        self.watcher = None
+        self.is_running = False
+
+    def isRunning(self):
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def request(self):
+        self.requested.set()
+
+    def watch(self):
+        self.is_running = True
+        self.watcher = threading.Thread(target=self.runWatcher, name='profilewatch', daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.is_running = False
+        self.requested.set()
+        if self.watcher is not None:
+            self.watcher.join()
+
+    def runWatcher(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            if not self.is_running:
+                return
+            if not self.start() and self.log is not None:
+                self.log('Profiler is already running.')
+
+    def start(self):
+        if self.isRunning():
+            return False
+        self.sampler = StackSampler(self.out_dir, self.seconds, self.interval, self.thread_names, self.log)
+        self.sampler.start()
+        if self.log is not None:
+            self.log('Profiling %s for %ds' % (', '.join(self.thread_names), self.seconds))
+        return True
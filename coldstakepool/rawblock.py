@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Decodes blocks from zmq rawblock notifications and answers chain data rpc calls from them
+
+import struct
+import hashlib
+import threading
+
+from . import telemetry
+from .chainparams import chainparams
+from .util import encodeAddress, decodeAddress, format8, amountToSats, LOG_WARNING
+
+
+OUTPUT_STANDARD = 1
+OUTPUT_CT = 2
+OUTPUT_RINGCT = 3
+OUTPUT_DATA = 4
+PARTICL_TXN_VERSION = 0xa0
+TXN_COINSTAKE = 2
+ANON_MARKER = 0xffffffa0
+BLOCK_HEADER_SIZE = 112
+RAW_BLOCK_MARGIN = 10  # Blocks kept past the block buffer
+RAW_BLOCK_VERIFY = 100  # Every n'th decoded result is compared with the rpc result, starting with the first
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def merkleRoot(hashes):
+    # hashes and the root in internal byte order
+    if len(hashes) < 1:
+        return bytes(32)
+    while len(hashes) > 1:
+        if len(hashes) % 2 == 1:
+            hashes = hashes + [hashes[-1]]
+        hashes = [sha256d(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+def readCompactSize(data, o):
+    n = data[o]
+    if n < 253:
+        return n, o + 1
+    if n == 253:
+        return struct.unpack('<H', data[o + 1:o + 3])[0], o + 3
+    if n == 254:
+        return struct.unpack('<I', data[o + 1:o + 5])[0], o + 5
+    return struct.unpack('<Q', data[o + 1:o + 9])[0], o + 9
+
+
+def readVarBytes(data, o):
+    n, o = readCompactSize(data, o)
+    if o + n > len(data):
+        raise ValueError('Truncated data')
+    return data[o:o + n], o + n
+
+
+def scriptToAddress(script, chain):
+    params = chainparams[chain]
+    if len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+        return encodeAddress(bytes([params['pubkey_address']]) + script[3:23])
+    if len(script) == 23 and script[:2] == b'\xa9\x14' and script[22] == 0x87:
+        return encodeAddress(bytes([params['script_address']]) + script[2:22])
+    if len(script) == 37 and script[:3] == b'\x76\xa8\x20' and script[35:] == b'\x88\xac':
+        return encodeAddress(bytes([params['pubkey_address_256']]) + script[3:35])
+    if len(script) == 35 and script[:2] == b'\xa8\x20' and script[34] == 0x87:
+        return encodeAddress(bytes([params['script_address_256']]) + script[2:34])
+    return None
+
+
+def decodeTx(data, o, chain):
+    # Returns the transaction in the getrawtransaction verbose layout and the offset after it.
+    # 'local' is False if the rpc result would hold fields not decoded here: blinded or anon outputs and inputs, unknown scripts.
+    start = o
+    if data[o] < PARTICL_TXN_VERSION:
+        raise ValueError('Not a Particl transaction')
+    tx = {'version': data[o], 'type': data[o + 1], 'vin': [], 'vout': [], 'scripts': [], 'local': True}
+    o += 6  # Version, type and locktime
+
+    num_inputs, o = readCompactSize(data, o)
+    for i in range(num_inputs):
+        txid = data[o:o + 32][::-1].hex()
+        n = struct.unpack('<I', data[o + 32:o + 36])[0]
+        script_sig, o = readVarBytes(data, o + 36)
+        o += 4  # Sequence
+        if n == ANON_MARKER:
+            tx['local'] = False
+            num_items, o = readCompactSize(data, o)
+            for k in range(num_items):
+                item, o = readVarBytes(data, o)
+        tx['vin'].append({'txid': txid, 'vout': n})
+
+    num_outputs, o = readCompactSize(data, o)
+    for i in range(num_outputs):
+        output_type = data[o]
+        o += 1
+        if output_type == OUTPUT_STANDARD:
+            value = struct.unpack('<q', data[o:o + 8])[0]
+            script, o = readVarBytes(data, o + 8)
+            tx['scripts'].append(script)
+            out = {'n': i, 'type': 'standard', 'value': float(format8(value)), 'scriptPubKey': {'hex': script.hex()}}
+            address = scriptToAddress(script, chain)
+            if address is None:
+                tx['local'] = False
+            else:
+                out['scriptPubKey']['addresses'] = [address, ]
+        elif output_type == OUTPUT_CT:
+            o += 33  # Commitment
+            vdata, o = readVarBytes(data, o)
+            script, o = readVarBytes(data, o)
+            rangeproof, o = readVarBytes(data, o)
+            tx['scripts'].append(script)
+            tx['local'] = False
+            out = {'n': i, 'type': 'blind'}
+        elif output_type == OUTPUT_RINGCT:
+            o += 66  # Public key and commitment
+            vdata, o = readVarBytes(data, o)
+            rangeproof, o = readVarBytes(data, o)
+            tx['local'] = False
+            out = {'n': i, 'type': 'anon'}
+        elif output_type == OUTPUT_DATA:
+            vdata, o = readVarBytes(data, o)
+            out = {'n': i, 'type': 'data', 'data_hex': vdata.hex()}
+        else:
+            raise ValueError('Unknown output type %d' % (output_type))
+        tx['vout'].append(out)
+
+    tx['txid'] = sha256d(data[start:o])[::-1].hex()
+
+    for i in range(num_inputs):
+        num_items, o = readCompactSize(data, o)
+        for k in range(num_items):
+            item, o = readVarBytes(data, o)
+    return tx, o
+
+
+def decodeBlock(data, chain):
+    # Returns hash, prevhash, time, height and txns, height is read from the coinstake and None if there is none.
+    # Raises ValueError if the txids don't hash to the merkle root in the header.
+    if len(data) < BLOCK_HEADER_SIZE:
+        raise ValueError('Truncated block')
+    block = {
+        'hash': sha256d(data[:BLOCK_HEADER_SIZE])[::-1].hex(),
+        'prevhash': data[4:36][::-1].hex(),
+        'time': struct.unpack('<I', data[100:104])[0],
+        'height': None,
+        'tx': [],
+    }
+    num_txns, o = readCompactSize(data, BLOCK_HEADER_SIZE)
+    for i in range(num_txns):
+        tx, o = decodeTx(data, o, chain)
+        tx['blockhash'] = block['hash']
+        tx['blocktime'] = block['time']
+        block['tx'].append(tx)
+    if merkleRoot([bytes.fromhex(tx['txid'])[::-1] for tx in block['tx']]) != data[36:68]:
+        raise ValueError('Block %s merkle root mismatch' % (block['hash']))
+
+    if len(block['tx']) > 0 and block['tx'][0]['type'] == TXN_COINSTAKE:
+        out = block['tx'][0]['vout'][0]
+        if out['type'] == 'data' and len(out['data_hex']) >= 8:
+            block['height'] = struct.unpack('<i', bytes.fromhex(out['data_hex'][:8]))[0]
+    return block
+
+
+def compareResult(method, rv, expect, reward_addr):
+    # Returns the first difference between a decoded result and the rpc result, None if they match
+    if method == 'getblockhash':
+        return None if rv == expect else 'blockhash %s, rpc %s' % (rv, expect)
+
+    if method == 'getblockreward':
+        for k in ('blockhash', 'blocktime', 'coinstake'):
+            if rv[k] != expect[k]:
+                return '%s %s, rpc %s' % (k, rv[k], expect[k])
+        for out in expect['outputs']:
+            if out.get('script', {}).get('spendaddr') == reward_addr:
+                return 'block pays the reward address'
+        return None
+
+    if rv['txid'] != expect['txid']:
+        return 'txid %s, rpc %s' % (rv['txid'], expect['txid'])
+    if len(rv['vin']) != len(expect['vin']) or len(rv['vout']) != len(expect['vout']):
+        return 'txn %s input or output count' % (rv['txid'])
+    for inp, expect_inp in zip(rv['vin'], expect['vin']):
+        if 'coinbase' in expect_inp:
+            continue
+        if inp['txid'] != expect_inp.get('txid') or inp['vout'] != expect_inp.get('vout'):
+            return 'txn %s input %s:%d' % (rv['txid'], inp['txid'], inp['vout'])
+    for out, expect_out in zip(rv['vout'], expect['vout']):
+        if out['type'] != expect_out['type']:
+            return 'txn %s output %d type %s, rpc %s' % (rv['txid'], out['n'], out['type'], expect_out['type'])
+        if out['type'] == 'data' and out['data_hex'] != expect_out.get('data_hex'):
+            return 'txn %s output %d data' % (rv['txid'], out['n'])
+        if out['type'] != 'standard':
+            continue
+        if amountToSats(out['value']) != amountToSats(expect_out['value']):
+            return 'txn %s output %d value %s, rpc %s' % (rv['txid'], out['n'], out['value'], expect_out['value'])
+        spk = expect_out['scriptPubKey']
+        if out['scriptPubKey']['hex'] != spk['hex']:
+            return 'txn %s output %d script' % (rv['txid'], out['n'])
+        addresses = spk['addresses'] if 'addresses' in spk else [spk['address']] if 'address' in spk else None
+        if 'addresses' in out['scriptPubKey'] and out['scriptPubKey']['addresses'] != addresses:
+            return 'txn %s output %d address %s, rpc %s' % (rv['txid'], out['n'], out['scriptPubKey']['addresses'], addresses)
+    return None
+
+
+class RawBlocks():
+    # Decoded blocks keyed by height, kept as a linked chain ending at the last block received
+    def __init__(self, chain, max_blocks):
+        self.mx = threading.Lock()
+        self.chain = chain
+        self.max_blocks = max_blocks
+        self.blocks = {}
+        self.txns = {}
+
+    def dropBlock(self, height):
+        block = self.blocks.pop(height)
+        for tx in block['tx']:
+            self.txns.pop(tx['txid'], None)
+
+    def add(self, data):
+        # Returns the height of the block, raises ValueError if the block can't be used
+        block = decodeBlock(data, self.chain)
+        height = block['height']
+        if height is None:
+            raise ValueError('Block %s has no coinstake height' % (block['hash']))
+        with self.mx:
+            # Blocks at and above are replaced by a reorg, the previous block must link to the new one
+            prev = self.blocks.get(height - 1)
+            for h in list(self.blocks.keys()):
+                if h >= height or prev is None or prev['hash'] != block['prevhash']:
+                    self.dropBlock(h)
+            self.blocks[height] = block
+            for tx in block['tx']:
+                tx['height'] = height
+                self.txns[tx['txid']] = tx
+            for h in list(self.blocks.keys()):
+                if h <= height - self.max_blocks:
+                    self.dropBlock(h)
+        return height
+
+    def prune(self, height):
+        # Drop blocks below height
+        with self.mx:
+            for h in list(self.blocks.keys()):
+                if h < height:
+                    self.dropBlock(h)
+
+    def getBlockHash(self, height):
+        block = self.blocks.get(height)
+        return None if block is None else block['hash']
+
+    def getTx(self, txid):
+        tx = self.txns.get(txid)
+        if tx is None or not tx['local']:
+            return None
+        return {k: v for k, v in tx.items() if k not in ('scripts', 'local', 'height')}
+
+    def getTxHeight(self, txid):
+        tx = self.txns.get(txid)
+        return None if tx is None else tx['height']
+
+    def getBlockReward(self, height, reward_addr):
+        # getblockreward fields processBlock uses for blocks not paying the pool, None for blocks that may pay reward_addr
+        block = self.blocks.get(height)
+        if block is None:
+            return None
+        coinstake = block['tx'][0]
+        reward_hash = decodeAddress(reward_addr)[1:]
+        if any(reward_hash in script for script in coinstake['scripts']):
+            return None
+        return {'blockhash': block['hash'], 'blocktime': block['time'], 'coinstake': coinstake['txid'], 'outputs': []}
+
+
+class RawBlockRpc():
+    # Answers chain data rpc calls from ingested raw blocks, other calls and blocks paying the pool go to the daemon.
+    # Every verify_every'th answer is checked against the daemon, any mismatch disables answering from raw blocks.
+    def __init__(self, rpc_func, raw_blocks, reward_addr, verify_every=RAW_BLOCK_VERIFY, log=None):
+        self.rpc_func = rpc_func
+        self.raw_blocks = raw_blocks
+        self.reward_addr = reward_addr
+        self.verify_every = verify_every
+        self.log = log
+        self.num_answered = 0
+        self.enabled = True
+        self.batch = getattr(rpc_func, 'batch', None)
+
+    def verify(self, method, params, rv):
+        expect = self.rpc_func(method, params)
+        mismatch = compareResult(method, rv, expect, self.reward_addr)
+        if mismatch is None:
+            return rv
+        self.enabled = False
+        if self.log is not None:
+            self.log('WARNING: Rawblock decoding disabled, %s %s does not match the rpc result: %s' % (method, params, mismatch), level=LOG_WARNING)
+        return expect
+
+    def __call__(self, method, params=None, wallet=None):
+        if wallet is None and self.enabled:
+            rv = None
+            if method == 'getblockhash':
+                rv = self.raw_blocks.getBlockHash(params[0])
+            elif method == 'getblockreward':
+                rv = self.raw_blocks.getBlockReward(params[0], self.reward_addr)
+            elif method == 'getrawtransaction' and len(params) > 1 and params[1]:
+                rv = self.raw_blocks.getTx(params[0])
+            else:
+                return self.rpc_func(method, params, wallet)
+            telemetry.recordCache('rawblock', rv is not None)
+            if rv is not None:
+                if self.verify_every > 0 and self.num_answered % self.verify_every == 0:
+                    rv = self.verify(method, params, rv)
+                self.num_answered += 1
+                return rv
+        return self.rpc_func(method, params, wallet)
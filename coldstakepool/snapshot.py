@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Pool db snapshot files: gzip of magic, header, length prefixed records and a sha256 of the preceding bytes
+
+import gzip
+import struct
+import hashlib
+
+
+SNAPSHOT_MAGIC = b'CSPSNAP\x01'
+
+
+class SnapshotWriter():
+    def __init__(self, path, chain, height, blockhash, db_version):
+        self.fp = gzip.open(path, 'wb')
+        self.hasher = hashlib.sha256()
+        self.num_records = 0
+        chain_bytes = chain.encode('utf-8')
+        self.write(SNAPSHOT_MAGIC + struct.pack('>B', len(chain_bytes)) + chain_bytes
+                   + struct.pack('>i', height) + bytes.fromhex(blockhash) + struct.pack('>i', db_version))
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.fp.write(data)
+
+    def add(self, k, v):
+        self.write(struct.pack('>HI', len(k), len(v)) + k + v)
+        self.num_records += 1
+
+    def abort(self):
+        self.fp.close()
+
+    def close(self):
+        # Zero length key marks the end of the records
+        self.write(struct.pack('>HI', 0, 0))
+        self.fp.write(self.hasher.digest())
+        self.fp.close()
+
+
+def readExact(fp, hasher, n):
+    data = fp.read(n)
+    if len(data) != n:
+        raise ValueError('Truncated snapshot')
+    hasher.update(data)
+    return data
+
+
+def readSnapshot(path):
+    # Returns the header dict and records, raises ValueError if the checksum fails
+    hasher = hashlib.sha256()
+    records = []
+    with gzip.open(path, 'rb') as fp:
+        if readExact(fp, hasher, len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('Unknown snapshot format')
+        chain_len = readExact(fp, hasher, 1)[0]
+        header = {
+            'chain': readExact(fp, hasher, chain_len).decode('utf-8'),
+            'height': struct.unpack('>i', readExact(fp, hasher, 4))[0],
+            'blockhash': readExact(fp, hasher, 32).hex(),
+            'db_version': struct.unpack('>i', readExact(fp, hasher, 4))[0],
+        }
+        while True:
+            key_len, value_len = struct.unpack('>HI', readExact(fp, hasher, 6))
+            if key_len == 0:
+                break
+            records.append((readExact(fp, hasher, key_len), readExact(fp, hasher, value_len)))
+        if fp.read(32) != hasher.digest():
+            raise ValueError('Snapshot checksum mismatch')
+    return header, records
@@ -5,47 +5,118 @@
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 
 import os
-import sys
 import zmq
+import json
+import zlib
 import time
 import plyvel
 import struct
-import decimal
+import calendar
 import threading
+import hashlib
 import traceback
+import collections
+import urllib.request
+import multiprocessing
 
 from functools import wraps
-from . import __version__
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from . import __version__, telemetry
 from .util import (
     COIN,
     dumpj,
     logmt,
+    LOG_DEBUG,
+    LOG_INFO,
+    LOG_WARNING,
+    LOG_ERROR,
     format8,
     format16,
+    fixedToInt,
+    amountToSats,
     bech32Decode,
     bech32Encode,
     decodeAddress,
     encodeAddress,
     make_rpc_func,
+    rpcKey,
+    AuditWriter,
+    RpcRecorder,
+    RpcReplay,
 )
 
 from .chainparams import is_script_prefix
+from .snapshot import SnapshotWriter, readSnapshot
+from .rawblock import RawBlocks, RawBlockRpc, RAW_BLOCK_MARGIN, RAW_BLOCK_VERIFY
+from .packing import planPayoutTxns, DEFAULT_MAX_TX_SIZE, MAX_STANDARD_TX_SIZE
 
 
 DEBUG = True
-CURRENT_DB_VERSION = 1
+MIGRATION_BATCH_SIZE = 100
+RPC_THREADS = 8
+RPC_BATCH_SIZE = 500  # Calls per json-rpc batch request
+SYNC_RANGE_SIZE = 100
+CHANGE_STREAM_FETCH = 100  # Change records requested at a time by observers
+CHANGE_PUT = 0
+CHANGE_DELETE = 1
+COINBASE_MATURITY = 100
+
+# Ordered database migrations, (version, method): method upgrades the db from version - 1
+DB_MIGRATIONS = (
+    (1, 'migrateRebuildMetrics'),
+    (2, 'migrateBlockTimes'),
+    (3, 'migratePeriodMetrics'),
+    (4, 'migrateAddressHistory'),
+    (5, 'migratePendingIndex'),
+)
+CURRENT_DB_VERSION = DB_MIGRATIONS[-1][0]
 
 DBT_DATA = ord('d')
 DBT_BAL = ord('b')
 DBT_POOL_BAL = ord('p')
-DBT_POOL_BLOCK = ord('B')           # Key height : data blockhash + blockreward + poolcointotal
-DBT_POOL_PAYOUT = ord('P')          # Key height + txhash : data totalDisbursed
+DBT_POOL_BLOCK = ord('B')           # Key height : data blockhash + blockreward + poolcointotal + blocktime
+DBT_POOL_PAYOUT = ord('P')          # Key height + txhash : data totalDisbursed + blocktime
 DBT_POOL_PENDING_PAYOUT = ord('Q')  # Key txhash : data totalDisbursed + fees
 DBT_POOL_METRICS = ord('M')         # Key Y-m : data nblocks + totalcoin
-
-
-decimal.getcontext().prec = 8
-mxDB = threading.Lock()
+DBT_POOL_PERIOD_METRICS = ord('T')  # Key resolution + period start : data nblocks + totalcoin + disbursed + fees
+DBT_ADDR_HISTORY = ord('H')         # Key address length + address + height + type [+ txhash] : data by type
+DBT_CHANGES = ord('C')              # Key height : data compressed db changes made processing the block
+DBT_UNDO = ord('U')                 # Key height : data compressed prior values of the keys changed processing the block
+DBT_POOL_PLANNED_PAYOUT = ord('R')  # Key height : data json outputs of a payment run waiting for the block to mature
+DBT_PAYOUT_STATUS = ord('S')        # Key txhash : data status + seen time + confirmed height + outputs, while the payout is pending
+DBT_PAYMENT_JOB = ord('J')          # Key height : data json payment run sent by the payment worker
+DBT_PENDING_INDEX = ord('I')        # Key address : data pending amount, for addresses with a pending payout
+DBT_METRICS_REBUILD = ord('N')      # Key metrics key : data metrics rebuilt from the records so far, while rebuilding
+
+# The master's payout work, left out of the change stream so observers never send
+CHANGE_STREAM_EXCLUDED = (DBT_POOL_PLANNED_PAYOUT, DBT_PAYMENT_JOB)
+
+# Records a snapshot carries, balances, blocks, payouts, metrics and counters.
+# Payout work, undo and change records and migration or rebuild progress stay with the pool that wrote them.
+SNAPSHOT_PREFIXES = (DBT_BAL, DBT_POOL_BAL, DBT_POOL_BLOCK, DBT_POOL_PAYOUT, DBT_POOL_PENDING_PAYOUT,
+                     DBT_POOL_METRICS, DBT_POOL_PERIOD_METRICS, DBT_ADDR_HISTORY, DBT_PENDING_INDEX)
+SNAPSHOT_DATA_KEYS = (b'current_height', b'db_version', b'pool_addr', b'reward_addr', b'blocks_found',
+                      b'last_payment_run', b'last_payment_cohort', b'last_withdrawal_run', b'pending_index',
+                      b'pool_disbursed', b'pool_fees', b'pool_fees_detected', b'pool_withdrawn')
+
+HISTORY_REWARD = 0                  # data poolcointotal + addrstaking + stakebonus + reward + accumulated
+HISTORY_PAYOUT = 1                  # data amount
+
+PAYOUT_BROADCAST = 0
+PAYOUT_MEMPOOL = 1
+PAYOUT_CONFIRMED = 2
+PAYOUT_STATUS_NAMES = ('broadcast', 'mempool', 'confirmed')
+PAYMENT_JOB_RETRY = 30  # Seconds the payment worker waits after a failed send
+
+METRICS_RESOLUTIONS = {'hour': b'h', 'day': b'd', 'month': b'm'}
+MAX_METRICS_PERIODS = 1000
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 500
+
+
+mxDB = telemetry.TimedLock('db')
+# Serialises the pool_reward wallet's coin selection, taken after mxDB and never held while waiting for it
+mxSend = telemetry.TimedLock('send')
 
 
 def getDBMutex(method):
@@ -59,6 +130,14 @@ def getDBMutex(method):
     return _impl
 
 
+def timeBlock(method):
+    @wraps(method)
+    def _impl(self, *method_args, **method_kwargs):
+        with telemetry.BlockTimer():
+            return method(self, *method_args, **method_kwargs)
+    return _impl
+
+
 def unpackMonthMetrics(m):
     if m is None:
         return [0, 0, 0]
@@ -69,6 +148,315 @@ def packMonthMetrics(m):
     return struct.pack('>i', m[0]) + m[1].to_bytes(16, 'big') + m[2].to_bytes(8, 'big')
 
 
+def periodStart(resolution, t):
+    if resolution == b'm':
+        tm = time.gmtime(t)
+        return calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+    period = 3600 if resolution == b'h' else 86400
+    return t - t % period
+
+
+def unpackPeriodMetrics(m):
+    if m is None:
+        return [0, 0, 0, 0]
+    return [struct.unpack('>i', m[:4])[0], int.from_bytes(m[4:20], 'big'), int.from_bytes(m[20:28], 'big'), int.from_bytes(m[28:36], 'big')]
+
+
+def packPeriodMetrics(m):
+    return struct.pack('>i', m[0]) + m[1].to_bytes(16, 'big') + m[2].to_bytes(8, 'big') + m[3].to_bytes(8, 'big')
+
+
+def periodMetricsKeys(t):
+    # Keys of the hour, day and month periods containing time t
+    return [bytes([DBT_POOL_PERIOD_METRICS]) + r + struct.pack('>I', periodStart(r, t)) for r in METRICS_RESOLUTIONS.values()]
+
+
+def unpackMetrics(dbkey, m):
+    # Metrics values by the type of their key, pool_disbursed is a single value
+    if dbkey[0] == DBT_POOL_METRICS:
+        return unpackMonthMetrics(m)
+    if dbkey[0] == DBT_POOL_PERIOD_METRICS:
+        return unpackPeriodMetrics(m)
+    return [0 if m is None else int.from_bytes(m, 'big')]
+
+
+def packMetrics(dbkey, m):
+    if dbkey[0] == DBT_POOL_METRICS:
+        return packMonthMetrics(m)
+    if dbkey[0] == DBT_POOL_PERIOD_METRICS:
+        return packPeriodMetrics(m)
+    return m[0].to_bytes(8, 'big')
+
+
+def hasBlockTime(k, v):
+    return len(v) >= (56 if k[0] == DBT_POOL_BLOCK else 16)
+
+
+def addressHistoryPrefix(address):
+    return bytes([DBT_ADDR_HISTORY, len(address)]) + address
+
+
+def unpackAddressHistory(k, v):
+    ofs = 2 + k[1]
+    height = struct.unpack('>i', k[ofs:ofs + 4])[0]
+    if k[ofs + 4] == HISTORY_PAYOUT:
+        return {'height': height, 'type': 'payout', 'txid': k[ofs + 5:].hex(), 'amount': int.from_bytes(v[:8], 'big')}
+    return {'height': height, 'type': 'reward',
+            'poolcointotal': int.from_bytes(v[:8], 'big'),
+            'staking': int.from_bytes(v[8:16], 'big'),
+            'stakebonus': int.from_bytes(v[16:24], 'big'),
+            'reward': int.from_bytes(v[24:40], 'big'),
+            'accumulated': int.from_bytes(v[40:56], 'big')}
+
+
+def unpackFoundBlock(k, v):
+    # height, blockhash, blockreward, poolcointotal, blocktime
+    return (struct.unpack('>i', k[1:5])[0], v[:32].hex(), int.from_bytes(v[32:40], 'big'), int.from_bytes(v[40:48], 'big'),
+            int.from_bytes(v[48:56], 'big') if hasBlockTime(k, v) else None)
+
+
+def unpackPayout(k, v):
+    # height, txid, totaldisbursed, blocktime
+    return (struct.unpack('>i', k[1:5])[0], k[5:37].hex(), int.from_bytes(v[:8], 'big'),
+            int.from_bytes(v[8:16], 'big') if hasBlockTime(k, v) else None)
+
+
+def packPayoutStatus(status, seen, height, outputs):
+    data = bytes([status]) + seen.to_bytes(8, 'big') + struct.pack('>i', height)
+    for address, amount in outputs:
+        data += bytes([len(address)]) + address + amount.to_bytes(8, 'big')
+    return data
+
+
+def unpackPayoutStatus(v):
+    # status, seen time, confirmed height, [(address, amount)]
+    outputs = []
+    o = 13
+    while o < len(v):
+        address = v[o + 1:o + 1 + v[o]]
+        o += 1 + v[o]
+        outputs.append((address, int.from_bytes(v[o:o + 8], 'big')))
+        o += 8
+    return v[0], int.from_bytes(v[1:9], 'big'), struct.unpack('>i', v[9:13])[0], outputs
+
+
+class LookupsNeeded(Exception):
+    # Raised by a migration step for the rpc calls it needs, the step is rerun once they're made outside the db lock
+    def __init__(self, calls):
+        super().__init__('%d rpc lookups needed' % (len(calls)))
+        self.calls = calls
+
+
+def requireResults(results, calls):
+    # Results of calls [(method, params)] from results by rpcKey, raises LookupsNeeded for the calls not made yet
+    missing = [(method, params) for method, params in calls if rpcKey(method, params, None) not in results]
+    if len(missing) > 0:
+        raise LookupsNeeded(missing)
+    return [results[rpcKey(method, params, None)] for method, params in calls]
+
+
+def inSnapshot(k):
+    return k[0] in SNAPSHOT_PREFIXES or (k[0] == DBT_DATA and k[1:] in SNAPSHOT_DATA_KEYS)
+
+
+def payoutCohort(addr, num_cohorts):
+    # Spread by hash so cohorts stay balanced as addresses join
+    return int.from_bytes(hashlib.sha256(addr).digest()[:4], 'big') % num_cohorts
+
+
+def addRecordMetrics(month_metrics, k, v, blocktime, period_metrics=None):
+    # Add a found block or payout record to the month buckets, returns the amount disbursed
+    date = time.strftime('%Y-%m', time.gmtime(blocktime))
+    m = month_metrics.setdefault(date, [0, 0, 0])
+    if k[0] == DBT_POOL_BLOCK:
+        values = [1, int.from_bytes(v[40:48], 'big'), 0, 0]
+    else:
+        values = [0, 0, int.from_bytes(v[:8], 'big'), 0]
+    for i in range(3):
+        m[i] += values[i]
+
+    if period_metrics is not None:
+        for dbkey in periodMetricsKeys(blocktime):
+            pm = period_metrics.setdefault(dbkey, [0, 0, 0, 0])
+            for i in range(4):
+                pm[i] += values[i]
+    return values[2]
+
+
+def packChanges(height, blockhash, pool_addr, ops):
+    data = struct.pack('>i', height) + bytes.fromhex(blockhash) + bytes([len(pool_addr)]) + pool_addr
+    for op, k, v in ops:
+        data += bytes([op]) + struct.pack('>H', len(k)) + k
+        if op == CHANGE_PUT:
+            data += struct.pack('>I', len(v)) + v
+    return zlib.compress(data + hashlib.sha256(data).digest())
+
+
+def unpackChanges(record):
+    # Returns height, blockhash, pool address and [(op, key, value)], raises ValueError if the record is corrupt
+    try:
+        data = zlib.decompress(record)
+    except zlib.error:
+        raise ValueError('Bad change record')
+    if len(data) < 69 or hashlib.sha256(data[:-32]).digest() != data[-32:]:
+        raise ValueError('Change record checksum mismatch')
+    height = struct.unpack('>i', data[:4])[0]
+    blockhash = data[4:36].hex()
+    o = 37 + data[36]
+    pool_addr = data[37:o]
+    ops = []
+    end = len(data) - 32
+    while o < end:
+        op = data[o]
+        key_len = struct.unpack('>H', data[o + 1:o + 3])[0]
+        k = data[o + 3:o + 3 + key_len]
+        o += 3 + key_len
+        v = None
+        if op == CHANGE_PUT:
+            value_len = struct.unpack('>I', data[o:o + 4])[0]
+            v = data[o + 4:o + 4 + value_len]
+            o += 4 + value_len
+        ops.append((op, k, v))
+    return height, blockhash, pool_addr, ops
+
+
+class RecordingBatch():
+    # Write batch proxy adding the operations to the recorder when the batch is written
+    def __init__(self, batch, ops, recorder=None):
+        self.batch = batch
+        self.ops = ops
+        self.recorder = recorder
+        self.pending = []
+
+    def put(self, k, v):
+        if self.recorder is not None:
+            self.recorder.keepPrior(k)
+        self.batch.put(k, v)
+        self.pending.append((CHANGE_PUT, k, v))
+
+    def delete(self, k):
+        if self.recorder is not None:
+            self.recorder.keepPrior(k)
+        self.batch.delete(k)
+        self.pending.append((CHANGE_DELETE, k, None))
+
+    def clear(self):
+        self.batch.clear()
+        self.pending = []
+
+    def write(self):
+        self.batch.write()
+        self.ops += self.pending
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.write()
+
+
+class PreviewBatch():
+    # Write batch stand in keeping the writes in memory, nothing reaches the db
+    def __init__(self):
+        self.writes = {}
+
+    def put(self, k, v):
+        self.writes[k] = v
+
+    def delete(self, k):
+        self.writes[k] = None
+
+
+class ChangeRecorder():
+    # Db proxy recording every write, reads go to the db
+    # With undo set the value each key had before its first write is kept to roll the block back
+    def __init__(self, db, undo=False):
+        self.db = db
+        self.ops = []
+        self.prior = {} if undo else None
+
+    def keepPrior(self, k):
+        if self.prior is not None and k not in self.prior:
+            self.prior[k] = self.db.get(k)
+
+    def undoOps(self):
+        return [(CHANGE_DELETE, k, None) if v is None else (CHANGE_PUT, k, v) for k, v in self.prior.items()]
+
+    def put(self, k, v):
+        self.keepPrior(k)
+        self.db.put(k, v)
+        self.ops.append((CHANGE_PUT, k, v))
+
+    def delete(self, k):
+        self.keepPrior(k)
+        self.db.delete(k)
+        self.ops.append((CHANGE_DELETE, k, None))
+
+    def write_batch(self, undo=True, **kwargs):
+        # Writes from a batch with undo False are not rolled back
+        return RecordingBatch(self.db.write_batch(**kwargs), self.ops, self if undo else None)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+# The chain data calls processBlock makes for a block, shared with prefetchBlockRange so the prefetched
+# responses are keyed by the same method and params
+BLOCK_RPC_CALLS = {
+    'reward': lambda height: ('getblockreward', [height, ]),
+    'deltas': lambda address, height: ('getaddressdeltas', [{'addresses': [address], 'start': height, 'end': height}, ]),
+    'tx': lambda txid: ('getrawtransaction', [txid, True]),
+    'staked': lambda address, height: ('listcoldstakeunspent', [address, height - 1, {'mature_only': True, 'all_staked': True}]),
+    'header': lambda blockhash: ('getblockheader', [blockhash]),
+}
+
+
+def prefetchBlockRange(rpc_host, rpc_port, rpc_auth, pool_addr, reward_addr, height_from, height_to):
+    # Runs in a worker process, returns the responses to the chain data rpc calls processBlock makes for each height
+    rpc_func = make_rpc_func(rpc_host, rpc_port, rpc_auth)
+    rv = []
+    for height in range(height_from, height_to + 1):
+        responses = {}
+
+        def call(name, *args):
+            method, params = BLOCK_RPC_CALLS[name](*args)
+            responses[rpcKey(method, params, None)] = rpc_func(method, params)
+            return responses[rpcKey(method, params, None)]
+
+        reward = call('reward', height)
+        if 'coinstake' in reward:
+            deltas = call('deltas', reward_addr, height)
+            for txid in set(d['txid'] for d in deltas if d['txid'] != reward['coinstake']):
+                tx = call('tx', txid)
+                for inp in tx['vin']:
+                    try:
+                        call('tx', inp['txid'])
+                    except Exception:
+                        pass  # processBlock handles the error when it makes the call
+            if any(out.get('script', {}).get('spendaddr') == reward_addr for out in reward['outputs']):
+                call('staked', pool_addr, height)
+                if 'blocktime' not in reward:
+                    call('header', reward['blockhash'])
+        rv.append(responses)
+    return rv
+
+
+class PrefetchedRpc():
+    # Serves prefetched responses, calls that were not prefetched go to the daemon
+    def __init__(self, rpc_func):
+        self.rpc_func = rpc_func
+        self.responses = {}
+
+    def __call__(self, method, params=None, wallet=None):
+        n = self.responses.get(rpcKey(method, params, wallet))
+        telemetry.recordCache('prefetch', n is not None)
+        if n is not None:
+            return n
+        return self.rpc_func(method, params, wallet)
+
+
 class StakePool():
     def __init__(self, fp, dataDir, settings, chain):
         self.is_running = True
@@ -81,13 +469,17 @@ class StakePool():
         self.daemon_running = False
         self.rpc_auth = None
 
-        self.blockBuffer = 100  # Work n blocks from the tip to avoid forks, should be > COINBASE_MATURITY
+        self.blockBuffer = settings.get('blockbuffer', COINBASE_MATURITY)  # Work n blocks from the tip to avoid forks
+        # Blocks within COINBASE_MATURITY of the tip are recorded in the undo log and rolled back on a reorg
+        self.undo_blocks = max(0, COINBASE_MATURITY - self.blockBuffer)
 
         self.mode = settings.get('mode', 'master')
         self.binDir = os.path.expanduser(settings['particlbindir'])
         self.particlDataDir = os.path.expanduser(settings['particldatadir'])
         self.chain = chain
         self.debug = settings.get('debug', DEBUG)
+        self.address_history = settings.get('addresshistory', self.debug)
+        self.address_csv = settings.get('addresscsv', False)  # Also write per address debug csv files
         self.log_time = settings.get('logtime', True)
 
         self.poolAddrHrp = 'pcs' if self.chain == 'mainnet' else 'tpcs'
@@ -96,8 +488,36 @@ class StakePool():
         self.poolAddrReward = settings['rewardaddress']
 
         self.poolHeight = settings.get('startheight', 0)
+        self.chainHeight = 0
 
         self.maxOutputsPerTx = settings.get('maxoutputspertx', 48)
+        # 'adaptive' fills payout txns up to maxpayouttxsize by estimated size, maxoutputspertx is ignored
+        self.payout_packing = settings.get('payoutpacking', 'fixed')
+        self.max_payout_tx_size = min(settings.get('maxpayouttxsize', DEFAULT_MAX_TX_SIZE), MAX_STANDARD_TX_SIZE)
+        self.payout_test_fee = settings.get('payouttestfee', False)  # Check planned txns with sendtypeto test_fee
+        self.consolidation = settings.get('consolidation', None)  # Merge small pool_reward coins between payment runs
+        self.migration_batch_size = settings.get('migrationbatchsize', MIGRATION_BATCH_SIZE)
+        self.rpc_threads = settings.get('rpcthreads', RPC_THREADS)
+        self.sync_workers = settings.get('syncworkers', 0)
+        self.sync_range_size = settings.get('syncrangesize', SYNC_RANGE_SIZE)
+        self.change_stream_blocks = settings.get('changestreamblocks', 0)  # Keep change records for the last n blocks
+        self.change_stream_url = settings.get('changestreamurl', None)  # Apply change records from this pool
+        self.change_stream_wait = settings.get('changestreamwait', 5)
+        self.change_stream_records = {}
+        self.change_stream_range = (-1, -1)  # Oldest and newest change record heights the upstream pool retains
+        self.change_stream_local = False  # Last block was processed locally, logged when the stream stops and resumes
+        self.show_provisional = settings.get('provisional', False)  # Preview rewards from blocks above the pool height
+        self.provisional = {}  # height: dict of blockhash, blockreward, poolcointotal and credits per address
+        self.payouts_tracked = set()  # Unconfirmed payout txids with a DBT_PAYOUT_STATUS record
+        self.payouts_check = set()  # Tracked txids to look up at the next block
+        self.payment_thread = None
+        self.payment_event = threading.Event()
+        self.payment_stop = False
+        self.consolidation_height = 0  # Chain height consolidation was last considered at
+        self.metrics_rebuild = dict()
+        self.db_upgrading = False
+        self.migration_thread = None
+        self.metrics_thread = None
         self.automatic_disbursement = settings.get('automatic_disbursement', True)
 
         # Default parameters
@@ -106,6 +526,7 @@ class StakePool():
 
         self.payoutThreshold = int(0.5 * COIN)
         self.minBlocksBetweenPayments = 100  # Minimum number of blocks between payment runs
+        self.payoutCohorts = 1  # Payable addresses are split into cohorts paid in turn, each every minBlocksBetweenPayments
 
         self.minOutputValue = int(0.1 * COIN)  # Ignore any outputs of lower value when accumulating rewards
         self.tx_fee_per_kb = None
@@ -136,6 +557,12 @@ class StakePool():
             with open(os.path.join(self.debugDir, 'pool.csv'), 'a') as fp:
                 fp.write('height,blockReward,blockOutput,poolReward,poolRewardTotal,poolCoinTotal,Disbursed,fees,totalFees\n')
 
+        # Debug csv files are written from a separate thread to keep disk io out of block processing
+        self.audit_writer = None
+        if self.debug:
+            self.audit_writer = AuditWriter(self.debugDir, flush_interval=settings.get('debugflushinterval', 2.0))
+            self.audit_writer.start()
+
         if self.mode == 'master':
             try:
                 self.min_blocks_between_withdrawals = self.settings['poolownerwithdrawal']['frequency']
@@ -209,10 +636,25 @@ class StakePool():
         self.rpc_port = settings.get('rpcport', 51735 if self.chain == 'mainnet' else 51935)
 
         self.rpc_func = make_rpc_func(self.rpc_host, self.rpc_port, self.rpc_auth)
-
-    def log(self, message, with_time=True):
-        logmt(self.fp, message, log_time=(self.log_time and with_time))
-        sys.stdout.flush()
+        if 'rpcreplay' in settings:
+            self.rpc_func = RpcReplay(settings['rpcreplay'])
+        elif 'rpcrecord' in settings:
+            self.rpc_func = RpcRecorder(self.rpc_func, settings['rpcrecord'])
+
+        # Decode blocks from zmq rawblock notifications, particld must also publish rawblock to the zmq address
+        self.raw_blocks = None
+        if settings.get('zmqrawblock', False) and not isinstance(self.rpc_func, (RpcRecorder, RpcReplay)):
+            self.raw_blocks = RawBlocks(self.chain, self.blockBuffer + RAW_BLOCK_MARGIN)
+            self.rpc_func = RawBlockRpc(self.rpc_func, self.raw_blocks, self.poolAddrReward,
+                                        settings.get('zmqrawblockverify', RAW_BLOCK_VERIFY), self.log)
+            self.zmqSubscriber.setsockopt_string(zmq.SUBSCRIBE, 'rawblock')
+
+        # Follow payout txns from zmq hashtx notifications, particld must also publish hashtx to the zmq address
+        if settings.get('zmqhashtx', False):
+            self.zmqSubscriber.setsockopt_string(zmq.SUBSCRIBE, 'hashtx')
+
+    def log(self, message, with_time=True, level=LOG_INFO):
+        logmt(self.fp, message, log_time=(self.log_time and with_time), level=level)
 
     def openDB(self, create_db=False):
         try:
@@ -225,24 +667,53 @@ class StakePool():
     def start(self):
         self.log('Starting StakePool at height %d\nPool Address: %s, Reward Address: %s, Mode %s\n' % (self.poolHeight, self.poolAddr, self.poolAddrReward, self.mode))
 
-        self.upgradeDatabase(self.db_version)
         self.waitForDaemonRPC()
 
         self.core_version = self.rpc_func('getnetworkinfo')['version']
         self.log('Particl Core version %s\n' % (self.core_version))
 
+        if self.upgradeDatabase(self.db_version):
+            return  # Continued by the migration thread once the db is upgraded
+        self.finishStart()
+
+    def finishStart(self):
+        # Startup steps reading the db, run after any migrations complete
         if self.mode == 'master':
             self.runSanityChecks()
 
-        db = self.openDB(create_db=True)
-        self.listAccumulated(self.poolHeight, db)
-        db.close()
+        self.listAccumulated(self.poolHeight)
+        self.loadPayoutStatus()
         self.daemon_running = True
 
+        with mxDB:
+            db = self.openDB()
+            n = db.get(bytes([DBT_DATA]) + b'metrics_rebuild')
+            db.close()
+        if n is not None:
+            self.log('Resuming metrics rebuild.')
+            self.startRebuildMetrics()
+
+        # Payment runs are queued as jobs and sent from a separate thread, block processing doesn't wait on sendtypeto
+        if self.mode == 'master' and self.settings.get('paymentworker', False):
+            self.payment_thread = threading.Thread(target=self.runPaymentJobs, name='payments', daemon=True)
+            self.payment_thread.start()
+
     def stopRunning(self, with_code=0):
         self.fail_code = with_code
         self.is_running = False
 
+    def shutdown(self):
+        if self.payment_thread is not None:
+            self.payment_stop = True
+            self.payment_event.set()
+            self.payment_thread.join()
+            self.payment_thread = None
+        if self.audit_writer is not None:
+            self.audit_writer.stop()
+            self.audit_writer = None
+        if isinstance(self.rpc_func, (RpcRecorder, RpcReplay)):
+            self.rpc_func.close()
+
     def setParameters(self, height):
         if 'parameters' in self.settings:
             if self.lastHeightParametersSet < 0:
@@ -265,6 +736,8 @@ class StakePool():
                     self.payoutThreshold = int(p['payoutthreshold'] * COIN)
                 if 'minblocksbetweenpayments' in p:
                     self.minBlocksBetweenPayments = p['minblocksbetweenpayments']
+                if 'payoutcohorts' in p:
+                    self.payoutCohorts = max(1, p['payoutcohorts'])
                 if 'minoutputvalue' in p:
                     self.minOutputValue = int(p['minoutputvalue'] * COIN)
                 if 'txfeerate' in p:
@@ -350,17 +823,316 @@ class StakePool():
             self.log('WARNING: Automatic disbursement is disabled.')
 
     def upgradeDatabase(self, db_version):
+        # Returns True if an upgrade was started, startup is finished by the migration thread
         if db_version >= CURRENT_DB_VERSION:
-            return
+            return False
 
         self.log('Upgrading Database from version %d to %d.' % (db_version, CURRENT_DB_VERSION))
 
-        rv = self.rebuildMetrics()
-        self.log('rebuildMetrics processed %d blocks and %d payments.' % (rv['processedblocks'], rv['processedpayments']))
+        # Migrations run in the background, the http server can serve reads while blocks are held back
+        self.db_upgrading = True
+        self.migration_thread = threading.Thread(target=self.runMigrations, args=(db_version,))
+        self.migration_thread.start()
+        return True
 
-        db = self.openDB(create_db=True)
-        db.put(bytes([DBT_DATA]) + b'db_version', struct.pack('>i', CURRENT_DB_VERSION))
-        db.close()
+    def runMigrations(self, db_version):
+        try:
+            for version, method_name in DB_MIGRATIONS:
+                if version <= db_version:
+                    continue
+                if not self.runMigration(version, getattr(self, method_name)):
+                    self.log('Database upgrade interrupted at version %d.' % (db_version))
+                    return
+                db_version = version
+                self.db_version = version
+            self.log('Database upgraded to version %d.' % (db_version))
+            self.finishStart()
+            self.db_upgrading = False
+        except Exception:
+            self.log('ERROR: Database upgrade failed: %s\n' % (traceback.format_exc()))
+            self.stopRunning(1)
+
+    def runMigration(self, version, step):
+        # Each step is written atomically together with the checkpoint to resume from.
+        # Rpc calls a step needs are made between steps without the db lock, then the step is rerun.
+        dbkey = bytes([DBT_DATA]) + b'migration_progress'
+        with mxDB:
+            db = self.openDB()
+            n = db.get(dbkey)
+            db.close()
+        checkpoint = None
+        if n is not None and struct.unpack('>i', n[:4])[0] == version:
+            checkpoint = n[4:]
+            self.log('Resuming migration to version %d.' % (version))
+
+        stats = dict()
+        if not self.runSteps(dbkey, struct.pack('>i', version), step, checkpoint, stats,
+                             lambda b: b.put(bytes([DBT_DATA]) + b'db_version', struct.pack('>i', version))):
+            return False
+        self.log('Migrated database to version %d %s' % (version, dumpj(stats, indent=None)))
+        return True
+
+    def runSteps(self, dbkey, header, step, checkpoint, stats, finish=None):
+        # Runs step until it returns no checkpoint, returns False if interrupted.
+        # Each step is written atomically together with header + the checkpoint to resume from, stored at dbkey.
+        # Rpc calls a step needs are made between steps without the db lock, then the step is rerun.
+        results = dict()
+        while self.is_running:
+            calls = None
+            with mxDB:
+                db = self.openDB()
+                try:
+                    b = db.write_batch(transaction=True)
+                    try:
+                        next_checkpoint = step(db, b, checkpoint, stats, results)
+                    except LookupsNeeded as e:
+                        calls = e.calls
+                    else:
+                        if next_checkpoint is None:
+                            b.delete(dbkey)
+                            if finish is not None:
+                                finish(b)
+                        else:
+                            b.put(dbkey, header + next_checkpoint)
+                        b.write()
+                finally:
+                    db.close()
+            if calls is not None:
+                results.update(self.fetchResults(calls))
+                continue
+            results.clear()
+            checkpoint = next_checkpoint
+            if checkpoint is None:
+                return True
+        return False
+
+    def fetchResults(self, calls):
+        # Make the rpc calls as json-rpc batches, returns {rpcKey: result}.
+        # Wrapped rpc funcs without batch support, like the recorder, make the calls concurrently.
+        batch = getattr(self.rpc_func, 'batch', None)
+        if batch is not None:
+            rv = []
+            for i in range(0, len(calls), RPC_BATCH_SIZE):
+                rv += batch(calls[i:i + RPC_BATCH_SIZE])
+        else:
+            with ThreadPoolExecutor(max_workers=self.rpc_threads) as executor:
+                rv = executor.map(lambda call: self.rpc_func(call[0], call[1]), calls)
+        return {rpcKey(method, params, None): r for (method, params), r in zip(calls, rv)}
+
+    def migrateRebuildMetrics(self, db, b, checkpoint, stats, results):
+        # checkpoint: phase + last key processed
+        # Phases: 0 remove old metrics, 1 add found blocks, 2 add payouts
+        phase = 0 if checkpoint is None else checkpoint[0]
+        stats.setdefault('processedblocks', 0)
+        stats.setdefault('processedpayments', 0)
+
+        if phase == 0:
+            num_removed = 0
+            for k in db.iterator(prefix=bytes([DBT_POOL_METRICS]), include_value=False):
+                b.delete(k)
+                num_removed += 1
+                if num_removed >= self.migration_batch_size:
+                    return bytes([0])
+            b.put(bytes([DBT_DATA]) + b'pool_disbursed', (0).to_bytes(8, 'big'))
+            return bytes([1]) + bytes([DBT_POOL_BLOCK])
+
+        prefix = DBT_POOL_BLOCK if phase == 1 else DBT_POOL_PAYOUT
+        records = self.readRecords(db, checkpoint[1:], prefix, self.migration_batch_size)
+        blocktimes = self.lookupBlockTimes(records, results)
+
+        month_metrics = dict()
+        pool_disbursed = 0
+        for k, v in records:
+            pool_disbursed += addRecordMetrics(month_metrics, k, v, self.getRecordBlockTime(k, v, b, blocktimes))
+        stats['processedblocks' if phase == 1 else 'processedpayments'] += len(records)
+
+        for date, m in month_metrics.items():
+            dbkey = bytes([DBT_POOL_METRICS]) + bytes(date, 'UTF-8')
+            existing = unpackMonthMetrics(db.get(dbkey))
+            b.put(dbkey, packMonthMetrics([existing[i] + m[i] for i in range(3)]))
+        if pool_disbursed > 0:
+            dbkey = bytes([DBT_DATA]) + b'pool_disbursed'
+            n = db.get(dbkey)
+            if n is not None:
+                pool_disbursed += int.from_bytes(n, 'big')
+            b.put(dbkey, pool_disbursed.to_bytes(8, 'big'))
+
+        if len(records) >= self.migration_batch_size:
+            return bytes([phase]) + records[-1][0]
+        if phase == 1:
+            return bytes([2]) + bytes([DBT_POOL_PAYOUT])
+        return None
+
+    def readRecordBatch(self, db, checkpoint):
+        # Next batch of found block then payout records after checkpoint, returns the records and the key to continue from
+        last_key = bytes([DBT_POOL_BLOCK]) if checkpoint is None else checkpoint
+        for prefix in (DBT_POOL_BLOCK, DBT_POOL_PAYOUT):
+            if last_key[0] > prefix:
+                continue
+            records = self.readRecords(db, last_key if last_key[0] == prefix else bytes([prefix]), prefix, self.migration_batch_size)
+            if len(records) >= self.migration_batch_size:
+                return records, records[-1][0]
+            if len(records) > 0:
+                return records, bytes([DBT_POOL_PAYOUT]) if prefix == DBT_POOL_BLOCK else None
+        return [], None
+
+    def migrateBlockTimes(self, db, b, checkpoint, stats, results):
+        # checkpoint: last key processed, found blocks then payouts
+        stats.setdefault('processedrecords', 0)
+        records, last_key = self.readRecordBatch(db, checkpoint)
+        blocktimes = self.lookupBlockTimes(records, results)
+        for k, v in records:
+            self.getRecordBlockTime(k, v, b, blocktimes)
+        stats['processedrecords'] += len(records)
+        return last_key
+
+    def migratePeriodMetrics(self, db, b, checkpoint, stats, results):
+        # checkpoint: last key processed, found blocks then payouts
+        # Fees are only known from when they're detected, the rollups start with zero fees
+        stats.setdefault('processedrecords', 0)
+        records, last_key = self.readRecordBatch(db, checkpoint)
+        blocktimes = self.lookupBlockTimes(records, results)
+
+        period_metrics = dict()
+        for k, v in records:
+            addRecordMetrics(dict(), k, v, self.getRecordBlockTime(k, v, b, blocktimes), period_metrics)
+        stats['processedrecords'] += len(records)
+
+        for dbkey, m in period_metrics.items():
+            existing = unpackPeriodMetrics(db.get(dbkey))
+            b.put(dbkey, packPeriodMetrics([existing[i] + m[i] for i in range(4)]))
+        return last_key
+
+    def migrateAddressHistory(self, db, b, checkpoint, stats, results):
+        # checkpoint: phase + last file name or payout key processed
+        # Phases: 0 import the rewards from existing per address debug csv files, 1 add the payouts from the payout records
+        stats.setdefault('processedfiles', 0)
+        stats.setdefault('processedpayouts', 0)
+        if not self.address_history:
+            return None
+        phase = 0 if checkpoint is None else checkpoint[0]
+
+        if phase == 0:
+            if not os.path.isdir(self.debugDir):
+                return bytes([1, DBT_POOL_PAYOUT])
+            last_name = '' if checkpoint is None else checkpoint[1:].decode('UTF-8')
+            num_rows = 0
+            for name in sorted(os.listdir(self.debugDir)):
+                if name <= last_name or not name.endswith('.csv') or name.startswith('pool'):
+                    continue
+                address = decodeAddress(name[:-4])
+                if address is None:
+                    continue
+                prefix = addressHistoryPrefix(address)
+                with open(os.path.join(self.debugDir, name)) as fp:
+                    for line in fp:
+                        row = line.strip().split(',')
+                        if len(row) != 6:  # Payout rows are added from the payout records
+                            continue
+                        try:
+                            b.put(prefix + struct.pack('>i', int(row[0])) + bytes([HISTORY_REWARD]),
+                                  fixedToInt(row[1]).to_bytes(8, 'big') + fixedToInt(row[2]).to_bytes(8, 'big') + fixedToInt(row[3]).to_bytes(8, 'big')
+                                  + fixedToInt(row[4], 16).to_bytes(16, 'big') + fixedToInt(row[5], 16).to_bytes(16, 'big'))
+                            num_rows += 1
+                        except Exception:
+                            self.log('Warning: Skipping unreadable row in %s: %s' % (name, line.strip()))
+                stats['processedfiles'] += 1
+                if num_rows >= self.migration_batch_size:
+                    return bytes([0]) + bytes(name, 'UTF-8')
+            return bytes([1, DBT_POOL_PAYOUT])
+
+        # Outputs are matched to pool addresses as findPayments does, outputs to addresses without a balance are pool withdrawals
+        records = self.readRecords(db, checkpoint[1:], DBT_POOL_PAYOUT, self.migration_batch_size)
+        txns = requireResults(results, [('getrawtransaction', [k[5:37].hex(), True]) for k, v in records])
+        for (k, v), tx in zip(records, txns):
+            amounts = dict()
+            for out in tx['vout']:
+                if out.get('type') in ('data', 'blind', 'anon'):
+                    continue
+                spk = out.get('scriptPubKey', {})
+                address_str = spk['addresses'][0] if 'addresses' in spk else spk.get('address')
+                if address_str is None or address_str == self.poolAddrReward:
+                    continue
+                address = decodeAddress(address_str)
+                if address is None or db.get(bytes([DBT_BAL]) + address) is None:
+                    continue
+                amounts[address] = amounts.get(address, 0) + amountToSats(out['value'])
+            for address, amount in amounts.items():
+                b.put(addressHistoryPrefix(address) + k[1:5] + bytes([HISTORY_PAYOUT]) + k[5:37], amount.to_bytes(8, 'big'))
+        stats['processedpayouts'] += len(records)
+        if len(records) >= self.migration_batch_size:
+            return bytes([1]) + records[-1][0]
+        return None
+
+    def migratePendingIndex(self, db, b, checkpoint, stats, results):
+        # checkpoint: last balance key processed
+        stats.setdefault('pendingaddresses', 0)
+        records = self.readRecords(db, bytes([DBT_BAL]) if checkpoint is None else checkpoint, DBT_BAL, self.migration_batch_size)
+        batch_mirror = dict()
+        for k, v in records:
+            pending = int.from_bytes(v[16:24], 'big')
+            if pending > 0:
+                self.setPendingIndex(k[1:], 0, pending, db, b, batch_mirror)
+                stats['pendingaddresses'] += 1
+        if len(records) < self.migration_batch_size:
+            return None
+        return records[-1][0]
+
+    def setPendingIndex(self, address, old_pending, new_pending, db, b, batch_mirror):
+        # Keeps the index of addresses with a pending payout and its count and total in step with the balance records
+        if old_pending == new_pending:
+            return
+        dbkey = bytes([DBT_PENDING_INDEX]) + address
+        if new_pending > 0:
+            b.put(dbkey, new_pending.to_bytes(8, 'big'))
+        else:
+            b.delete(dbkey)
+
+        dbkey = bytes([DBT_DATA]) + b'pending_index'
+        n = self.getBatched(dbkey, db, batch_mirror)
+        count = 0 if n is None else int.from_bytes(n[:4], 'big')
+        total = 0 if n is None else int.from_bytes(n[4:12], 'big')
+        count += (new_pending > 0) - (old_pending > 0)
+        total += new_pending - old_pending
+        self.setBatched(dbkey, count.to_bytes(4, 'big') + total.to_bytes(8, 'big'), b, batch_mirror)
+
+    def addPeriodMetrics(self, blocktime, values, db, b, batch_mirror):
+        # values: nblocks, totalcoin, disbursed, fees
+        for dbkey in periodMetricsKeys(blocktime):
+            m = unpackPeriodMetrics(self.getBatched(dbkey, db, batch_mirror))
+            for i in range(4):
+                m[i] += values[i]
+            self.setBatched(dbkey, packPeriodMetrics(m), b, batch_mirror)
+
+    def readRecords(self, db, last_key, prefix, limit, stop=None):
+        records = []
+        for k, v in db.iterator(start=last_key, include_start=False, stop=bytes([prefix + 1]) if stop is None else stop):
+            records.append((k, v))
+            if len(records) >= limit:
+                break
+        return records
+
+    def lookupBlockTimes(self, records, results):
+        # Blocktimes of the records missing them, returns {key: blocktime}.
+        # Raises LookupsNeeded for the rpc calls not in results, payout blockhashes are looked up before the headers.
+        missing = [(k, v) for k, v in records if not hasBlockTime(k, v)]
+        payout_keys = [k for k, v in missing if k[0] != DBT_POOL_BLOCK]
+        blockhashes = dict(zip(payout_keys, requireResults(results, [('getblockhash', [struct.unpack('>i', k[1:5])[0]]) for k in payout_keys])))
+        for k, v in missing:
+            if k[0] == DBT_POOL_BLOCK:
+                blockhashes[k] = v[:32].hex()
+        headers = requireResults(results, [('getblockheader', [blockhashes[k]]) for k, v in missing])
+        return {k: int(header['time']) for (k, v), header in zip(missing, headers)}
+
+    def getRecordBlockTime(self, k, v, b, blocktimes):
+        # Records written before db version 2 are missing the blocktime, backfill from the fetched times
+        time_ofs = 48 if k[0] == DBT_POOL_BLOCK else 8
+        if hasBlockTime(k, v):
+            return int.from_bytes(v[time_ofs:time_ofs + 8], 'big')
+
+        blocktime = blocktimes[k]
+        b.put(k, v[:time_ofs] + blocktime.to_bytes(8, 'big'))
+        return blocktime
 
     def compact_db(self, db):
         start = time.time()
@@ -370,6 +1142,7 @@ class StakePool():
 
     def getBatched(self, key, db, batch_mirror):
         n = batch_mirror.get(key)
+        telemetry.recordCache('batch', n is not None)
         if n is None:
             n = db.get(key)
         return n
@@ -378,13 +1151,29 @@ class StakePool():
         b.put(key, value)
         batch_mirror[key] = value
 
-    @getDBMutex
     def processBlock(self, height):
+        change_record = None
+        if self.change_stream_url is not None and height > self.poolHeight:
+            # Fetched before taking the db mutex, the upstream pool may be slow to respond
+            change_record = self.fetchChangeRecord(height)
+        self.applyBlock(height, change_record)
+
+    @getDBMutex
+    @timeBlock
+    def applyBlock(self, height, change_record=None):
         self.log('processBlock height %d' % (height))
 
-        reward = self.rpc_func('getblockreward', [height, ])
+        if change_record is not None:
+            reward = None
+        else:
+            reward = self.rpc_func(*BLOCK_RPC_CALLS['reward'](height))
+
+        if self.undo_blocks > 0 and self.rollbackReorged(height):
+            return
 
         db = self.openDB(create_db=True)
+        if self.change_stream_blocks > 0 or self.undo_blocks > 0:
+            db = ChangeRecorder(db, undo=self.undo_blocks > 0)
 
         n = db.get(bytes([DBT_DATA]) + b'current_height')
         if n is not None:
@@ -397,9 +1186,19 @@ class StakePool():
 
         self.setParameters(height)
 
+        if reward is None:
+            blockhash = self.applyChangeRecord(height, change_record, db)
+            if blockhash is not None:
+                self.storeChanges(height, blockhash, db)
+                db.close()
+                self.poolHeight = height
+                return
+            reward = self.rpc_func(*BLOCK_RPC_CALLS['reward'](height))
+
         if 'coinstake' not in reward:
             # logm('No coinstake txn found in block ' + str(height))
             db.put(bytes([DBT_DATA]) + b'current_height', struct.pack('>i', height))
+            self.storeChanges(height, reward['blockhash'], db)
             db.close()
             self.poolHeight = height
             return
@@ -430,26 +1229,272 @@ class StakePool():
 
         n = db.get(bytes([DBT_DATA]) + b'last_payment_run')
         lastPaymentRunHeight = 0 if n is None else struct.unpack('>i', n)[0]
-        if lastPaymentRunHeight + self.minBlocksBetweenPayments <= height:
+        if lastPaymentRunHeight + max(1, self.minBlocksBetweenPayments // self.payoutCohorts) <= height:
             with db.write_batch(transaction=True) as b:
                 self.processPayments(height, db, b)
 
-        if self.have_withdrawal_info:
-            n = db.get(bytes([DBT_DATA]) + b'last_withdrawal_run')
-            last_withdrawal_run = 0 if n is None else struct.unpack('>i', n)[0]
-            if last_withdrawal_run + self.min_blocks_between_withdrawals <= height:
-                with db.write_batch(transaction=True) as b:
-                    self.processPoolRewardWithdrawal(height, db, b)
-
+        if self.undo_blocks > 0:
+            self.processMaturedBlocks(height, db)
+        else:
+            # Payment runs planned before undo was disabled by raising 'blockbuffer'
+            self.sendPlannedPayouts(height, db)
+            if self.have_withdrawal_info:
+                n = db.get(bytes([DBT_DATA]) + b'last_withdrawal_run')
+                last_withdrawal_run = 0 if n is None else struct.unpack('>i', n)[0]
+                if last_withdrawal_run + self.min_blocks_between_withdrawals <= height:
+                    with db.write_batch(transaction=True) as b:
+                        self.processPoolRewardWithdrawal(height, db, b)
+
+        self.storeChanges(height, reward['blockhash'], db)
         if height % 5000 == 0:
             self.compact_db(db)
         db.close()
         self.poolHeight = height
 
-    def processPoolBlock(self, height, reward, db, b, batchBalances):
-        self.log('Found block at ' + str(height))
-        opts = {'mature_only': True, 'all_staked': True}
-        outputs = self.rpc_func('listcoldstakeunspent', [self.poolAddr, height - 1, opts])
+    def processMaturedBlocks(self, height, db):
+        # Send the payment runs and owner withdrawals of blocks that can no longer be reorganised,
+        # the writes are not undone if the current block is rolled back.
+        matured_height = height - self.undo_blocks
+        self.sendPlannedPayouts(matured_height, db)
+        try:
+            if self.have_withdrawal_info:
+                n = db.get(bytes([DBT_DATA]) + b'last_withdrawal_run')
+                last_withdrawal_run = 0 if n is None else struct.unpack('>i', n)[0]
+                if last_withdrawal_run + self.min_blocks_between_withdrawals <= matured_height:
+                    with db.write_batch(undo=False, transaction=True) as b:
+                        self.processPoolRewardWithdrawal(matured_height, db, b)
+        except Exception:
+            self.log('ERROR: %s\n' % (traceback.format_exc()))
+
+    def sendPlannedPayouts(self, matured_height, db):
+        # Queue the payment runs planned at or below matured_height, only the master sends
+        if self.mode != 'master':
+            return
+        try:
+            for k, v in list(db.iterator(prefix=bytes([DBT_POOL_PLANNED_PAYOUT]))):
+                planned_height = struct.unpack('>i', k[1:5])[0]
+                if planned_height > matured_height:
+                    break
+                with db.write_batch(transaction=True, **({'undo': False} if isinstance(db, ChangeRecorder) else {})) as b:
+                    b.delete(k)
+                    self.queuePayments(db, b, json.loads(v), planned_height)
+        except Exception:
+            self.log('ERROR: %s\n' % (traceback.format_exc()))
+
+    def getMaturedValue(self, key, db, height):
+        # Value of key after block height was processed, the first later undo record changing the key holds it
+        for k, v in db.iterator(start=bytes([DBT_UNDO]) + struct.pack('>i', height + 1), stop=bytes([DBT_UNDO + 1])):
+            for op, undo_key, undo_value in unpackChanges(v)[3]:
+                if undo_key == key:
+                    return undo_value
+        return db.get(key)
+
+    def rollbackReorged(self, height):
+        # Roll back processed blocks no longer in the chain, returns True if any were
+        db = self.openDB()
+        try:
+            rollback_height = height - 1
+            while True:
+                record = db.get(bytes([DBT_UNDO]) + struct.pack('>i', rollback_height))
+                if record is None:
+                    break
+                record_height, blockhash, pool_addr, ops = unpackChanges(record)
+                if blockhash == self.rpc_func('getblockhash', [rollback_height]):
+                    break
+                self.log('WARNING: Reorg, rolling back block %d %s' % (rollback_height, blockhash), level=LOG_WARNING)
+                with db.write_batch(transaction=True) as b:
+                    for op, k, v in ops:
+                        if op == CHANGE_PUT:
+                            b.put(k, v)
+                        else:
+                            b.delete(k)
+                    b.delete(bytes([DBT_UNDO]) + struct.pack('>i', rollback_height))
+                    b.delete(bytes([DBT_CHANGES]) + struct.pack('>i', rollback_height))
+                rollback_height -= 1
+        finally:
+            db.close()
+
+        if rollback_height == height - 1:
+            return False
+        if record is None:
+            self.log('ERROR: Reorg is deeper than the undo log, rolled back to height %d.\n' % (rollback_height), level=LOG_ERROR)
+            self.stopRunning(1)
+        self.poolHeight = rollback_height
+        self.lastHeightParametersSet = -1  # Reapply parameters from the first
+        self.change_stream_records.clear()
+        return True
+
+    def storeChanges(self, height, blockhash, db):
+        if not isinstance(db, ChangeRecorder):
+            return
+        pool_addr = db.get(bytes([DBT_DATA]) + b'pool_addr')
+        with db.db.write_batch(transaction=True) as b:
+            if self.change_stream_blocks > 0:
+                ops = [op for op in db.ops if op[1][0] not in CHANGE_STREAM_EXCLUDED]
+                b.put(bytes([DBT_CHANGES]) + struct.pack('>i', height), packChanges(height, blockhash, pool_addr, ops))
+                b.delete(bytes([DBT_CHANGES]) + struct.pack('>i', height - self.change_stream_blocks))
+            if db.prior is not None:
+                b.put(bytes([DBT_UNDO]) + struct.pack('>i', height), packChanges(height, blockhash, pool_addr, db.undoOps()))
+                b.delete(bytes([DBT_UNDO]) + struct.pack('>i', height - self.undo_blocks))
+
+    @getDBMutex
+    def getChanges(self, height, count):
+        # Returns the oldest and newest heights retained, -1 if none, then consecutive change records from height, each prefixed by its length.
+        # Only the writes made processing blocks are recorded. Writes made outside applyBlock, by the payment worker,
+        # addPoolFees, updatePayoutStatus, the listAccumulated fixes, metrics rebuilds and migrations, are not streamed.
+        # Nor are the planned payout and payment job records, an observer never sends.
+        db = self.openDB()
+        try:
+            oldest, newest = -1, -1
+            for k in db.iterator(prefix=bytes([DBT_CHANGES]), include_value=False):
+                oldest = struct.unpack('>i', k[1:5])[0]
+                break
+            for k in db.iterator(prefix=bytes([DBT_CHANGES]), include_value=False, reverse=True):
+                newest = struct.unpack('>i', k[1:5])[0]
+                break
+            rv = struct.pack('>ii', oldest, newest)
+            for k, v in db.iterator(start=bytes([DBT_CHANGES]) + struct.pack('>i', height), stop=bytes([DBT_CHANGES + 1])):
+                if struct.unpack('>i', k[1:5])[0] != height or count < 1:
+                    break
+                rv += struct.pack('>I', len(v)) + v
+                height += 1
+                count -= 1
+        finally:
+            db.close()
+        return rv
+
+    def fetchChanges(self, height):
+        # Returns the range of heights the upstream pool retains
+        url = '{}/changes/{}?count={}'.format(self.change_stream_url.rstrip('/'), height, CHANGE_STREAM_FETCH)
+        with urllib.request.urlopen(url, timeout=30) as conn:
+            data = conn.read()
+        self.change_stream_range = struct.unpack('>ii', data[:8])
+        o = 8
+        while o + 4 <= len(data):
+            record_len = struct.unpack('>I', data[o:o + 4])[0]
+            self.change_stream_records[height] = data[o + 4:o + 4 + record_len]
+            o += 4 + record_len
+            height += 1
+        return self.change_stream_range
+
+    def fetchChangeRecord(self, height):
+        # Waits up to 'changestreamwait' only for blocks the upstream pool hasn't processed yet,
+        # blocks it no longer retains or is missing are processed locally without waiting.
+        try:
+            record = self.change_stream_records.pop(height, None)
+            wait_until = time.time() + self.change_stream_wait
+            reason = None
+            while record is None:
+                if height < self.change_stream_range[0]:
+                    reason = 'upstream retains change records from block %d' % (self.change_stream_range[0])
+                    break
+                self.change_stream_records.clear()
+                oldest, newest = self.fetchChanges(height)
+                record = self.change_stream_records.pop(height, None)
+                if record is not None:
+                    break
+                if oldest < 0:
+                    reason = 'upstream retains no change records'
+                    break
+                if height < oldest:
+                    reason = 'upstream retains change records from block %d' % (oldest)
+                    break
+                if height <= newest:
+                    reason = 'upstream is missing the change record'
+                    break
+                if time.time() >= wait_until or not self.is_running:
+                    reason = 'upstream is at block %d' % (newest)
+                    break
+                time.sleep(0.5)
+            if record is None:
+                if not self.change_stream_local:
+                    self.log('No change record from upstream for block %d, processing locally: %s' % (height, reason))
+                self.change_stream_local = True
+            elif self.change_stream_local:
+                self.log('Applying change records from upstream from block %d' % (height))
+                self.change_stream_local = False
+            return record
+        except Exception as e:
+            self.change_stream_records.clear()
+            self.log('WARNING: Fetching change record for block %d failed, processing locally: %s' % (height, str(e)))
+        return None
+
+    def applyChangeRecord(self, height, record, db):
+        # Apply the changes the upstream pool made processing the block, returns the blockhash or None to process the block locally
+        try:
+            record_height, blockhash, pool_addr, ops = unpackChanges(record)
+            if record_height != height:
+                raise ValueError('Change record for height %d, expected %d' % (record_height, height))
+            if pool_addr != db.get(bytes([DBT_DATA]) + b'pool_addr'):
+                raise ValueError('Change record is for a different pool')
+            # Check the upstream pool followed the same chain
+            if blockhash != self.rpc_func('getblockhash', [height]):
+                raise ValueError('Change record blockhash %s does not match block %d' % (blockhash, height))
+
+            with db.write_batch(transaction=True) as b:
+                for op, k, v in ops:
+                    if k[0] in CHANGE_STREAM_EXCLUDED:
+                        continue  # Streamed by older versions
+                    if op == CHANGE_PUT:
+                        b.put(k, v)
+                    else:
+                        b.delete(k)
+            return blockhash
+        except Exception as e:
+            self.change_stream_records.clear()
+            self.log('WARNING: Change stream failed for block %d, processing locally: %s' % (height, str(e)))
+        return None
+
+    def syncBlocks(self, to_height):
+        # Process blocks up to to_height. With 'syncworkers' > 1 the chain data for ranges of
+        # 'syncrangesize' blocks is fetched by worker processes ahead of the blocks being applied in height order.
+        # Blocks are applied by processBlock as in a sequential sync, state dependent logic like payout
+        # thresholds is unchanged and the db is identical.
+        if self.sync_workers < 2 or isinstance(self.rpc_func, (RpcRecorder, RpcReplay)) \
+           or to_height - self.poolHeight < self.sync_range_size:
+            while self.poolHeight < to_height and self.is_running:
+                self.processBlock(self.poolHeight + 1)
+            return
+
+        self.log('Syncing blocks %d to %d with %d workers' % (self.poolHeight + 1, to_height, self.sync_workers))
+        live_rpc_func = self.rpc_func
+        prefetched = PrefetchedRpc(live_rpc_func)
+        pending = collections.deque()
+        next_height = self.poolHeight + 1
+        executor = ProcessPoolExecutor(max_workers=self.sync_workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            self.rpc_func = prefetched
+            while self.is_running:
+                while next_height <= to_height and len(pending) < self.sync_workers * 2:
+                    range_end = min(next_height + self.sync_range_size - 1, to_height)
+                    pending.append((next_height, executor.submit(prefetchBlockRange, self.rpc_host, self.rpc_port, self.rpc_auth,
+                                                                 self.poolAddr, self.poolAddrReward, next_height, range_end)))
+                    next_height = range_end + 1
+                if len(pending) < 1:
+                    break
+                range_start, future = pending.popleft()
+                for i, responses in enumerate(future.result()):
+                    if not self.is_running or self.poolHeight + 1 != range_start + i:
+                        break
+                    prefetched.responses = responses
+                    self.processBlock(range_start + i)
+                if self.poolHeight + 1 != range_start + i + 1:
+                    break  # A block failed, retry from the sequential loop below
+        finally:
+            self.rpc_func = live_rpc_func
+            # Ranges not started yet are dropped, shutdown waits for the running ones
+            for pending_start, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        while self.poolHeight < to_height and self.is_running:
+            self.processBlock(self.poolHeight + 1)
+
+    def processPoolBlock(self, height, reward, db, b, batchBalances, preview=False):
+        # With preview set only b is written to, see updateProvisional
+        if not preview:
+            self.log('Found block at ' + str(height))
+        outputs = self.rpc_func(*BLOCK_RPC_CALLS['staked'](self.poolAddr, height))
 
         totals = dict()
         poolCoinTotal = 0
@@ -466,10 +1511,10 @@ class StakePool():
                 totals[o['addrspend']] = v
             poolCoinTotal += v
 
-        if lowValueOutputs > 0 and self.debug:
-            self.log('Ignoring %d low value outputs at height %d' % (lowValueOutputs, height))
+        if lowValueOutputs > 0 and self.debug and not preview:
+            self.log('Ignoring %d low value outputs at height %d' % (lowValueOutputs, height), level=LOG_DEBUG)
 
-        blockReward = int(decimal.Decimal(reward['blockreward']) * COIN)
+        blockReward = amountToSats(reward['blockreward'])
 
         # Coin paid to the pool operator
         poolReward = int((blockReward * (self.poolFeePercent * (COIN // 100))) // COIN)
@@ -481,26 +1526,27 @@ class StakePool():
         # Coin paid to the pool participants
         poolRewardClients = int(blockReward - (poolReward + stakeBonus))
 
+        if 'blocktime' in reward:
+            blocktime = int(reward['blocktime'])
+        else:
+            # TODO: Remove
+            blocktime = int(self.rpc_func(*BLOCK_RPC_CALLS['header'](reward['blockhash']))['time'])
+
         b.put(bytes([DBT_DATA]) + b'current_height', struct.pack('>i', height))
-        b.put(bytes([DBT_POOL_BLOCK]) + struct.pack('>i', height), bytes.fromhex(reward['blockhash']) + blockReward.to_bytes(8, 'big') + poolCoinTotal.to_bytes(8, 'big'))
+        b.put(bytes([DBT_POOL_BLOCK]) + struct.pack('>i', height), bytes.fromhex(reward['blockhash']) + blockReward.to_bytes(8, 'big') + poolCoinTotal.to_bytes(8, 'big') + blocktime.to_bytes(8, 'big'))
 
         dbkey = bytes([DBT_DATA]) + b'blocks_found'
         n = db.get(dbkey)
         blocksFound = 1 if n is None else struct.unpack('>i', n)[0] + 1
         b.put(dbkey, struct.pack('>i', blocksFound))
 
-        if 'blocktime' in reward:
-            date = time.strftime('%Y-%m', time.gmtime(int(reward['blocktime'])))
-        else:
-            # TODO: Remove
-            blockinfo = self.rpc_func('getblockheader', [reward['blockhash']])
-            date = time.strftime('%Y-%m', time.gmtime(int(blockinfo['time'])))
-
+        date = time.strftime('%Y-%m', time.gmtime(blocktime))
         dbkey = bytes([DBT_POOL_METRICS]) + bytes(date, 'UTF-8')
-        month_metrics = unpackMonthMetrics(db.get(dbkey))
+        month_metrics = unpackMonthMetrics(self.getBatched(dbkey, db, batchBalances))
         month_metrics[0] += 1
         month_metrics[1] += poolCoinTotal
-        db.put(dbkey, packMonthMetrics(month_metrics))
+        self.setBatched(dbkey, packMonthMetrics(month_metrics), b, batchBalances)
+        self.addPeriodMetrics(blocktime, [1, poolCoinTotal, 0, 0], db, b, batchBalances)
 
         poolRewardClients = int(poolRewardClients)
         for k, v in totals.items():
@@ -515,7 +1561,8 @@ class StakePool():
                 assignedStakeBonus = stakeBonus
                 stakeBonus = 0
 
-            dbkey = bytes([DBT_BAL]) + decodeAddress(k)
+            address = decodeAddress(k)
+            dbkey = bytes([DBT_BAL]) + address
             n = self.getBatched(dbkey, db, batchBalances)
             if n is not None:
                 addrTotal += int.from_bytes(n[:16], 'big')
@@ -525,18 +1572,21 @@ class StakePool():
                 addrPaidout = 0
                 self.setBatched(dbkey, addrTotal.to_bytes(16, 'big') + addrPending.to_bytes(8, 'big') + addrPaidout.to_bytes(8, 'big') + v.to_bytes(8, 'big'), b, batchBalances)
 
-            if self.debug:
-                with open(os.path.join(self.debugDir, k + '.csv'), 'a') as fp:
-                    fp.write('%d,%s,%s,%s,%s,%s\n'
-                             % (height,
-                                format8(poolCoinTotal),
-                                format8(v),
-                                format8(assignedStakeBonus),
-                                format16(addrReward),
-                                format16(addrTotal)))
+            if self.address_history:
+                b.put(addressHistoryPrefix(address) + struct.pack('>i', height) + bytes([HISTORY_REWARD]),
+                      poolCoinTotal.to_bytes(8, 'big') + v.to_bytes(8, 'big') + assignedStakeBonus.to_bytes(8, 'big') + addrReward.to_bytes(16, 'big') + addrTotal.to_bytes(16, 'big'))
+
+            if self.debug and self.address_csv and not preview:
+                self.audit_writer.write(k + '.csv', '%d,%s,%s,%s,%s,%s\n'
+                                        % (height,
+                                           format8(poolCoinTotal),
+                                           format8(v),
+                                           format8(assignedStakeBonus),
+                                           format16(addrReward),
+                                           format16(addrTotal)))
 
         if stakeBonus > 0:  # An output < minOutputValue may have staked
-            if self.debug:
+            if self.debug and not preview:
                 self.log('Unassigned stake bonus: %s %s\n' % (reward['kernelscript']['spendaddr'], format8(stakeBonus)))
 
         poolRewardTotal = int(poolReward + stakeBonus)
@@ -546,18 +1596,17 @@ class StakePool():
             poolRewardTotal += int.from_bytes(n, 'big')
         b.put(dbkey, poolRewardTotal.to_bytes(8, 'big'))
 
-        if self.debug:
+        if self.debug and not preview:
             blockOutput = 0
             for out in reward['outputs']:
-                blockOutput += int(decimal.Decimal(out['value']) * COIN)
-            with open(os.path.join(self.debugDir, 'pool.csv'), 'a') as fp:
-                fp.write('%d,%s,%s,%s,%s,%s\n'
-                         % (height,
-                            format8(blockReward),
-                            format8(blockOutput),
-                            format8(poolReward),
-                            format8(poolRewardTotal),
-                            format8(poolCoinTotal)))
+                blockOutput += amountToSats(out['value'])
+            self.audit_writer.write('pool.csv', '%d,%s,%s,%s,%s,%s\n'
+                                    % (height,
+                                       format8(blockReward),
+                                       format8(blockOutput),
+                                       format8(poolReward),
+                                       format8(poolRewardTotal),
+                                       format8(poolCoinTotal)))
 
     def makePayments(self, db, b, outputs, height):
         self.log('makePayments')
@@ -571,75 +1620,320 @@ class StakePool():
             return
 
         txfees = 0
-        for i in range(0, len(outputs), self.maxOutputsPerTx):
-            sl = outputs[i:i + self.maxOutputsPerTx]
-
-            totalDisbursedInTx = 0
-            for o in sl:
-                totalDisbursedInTx += int(decimal.Decimal(o['amount']) * COIN)
+        i = 0
+        for num_outputs, planned_size in self.planPayments(outputs):
+            sl = outputs[i:i + num_outputs]
+            i += num_outputs
+
+            ro = self.sendPayout(sl)
+            self.reportPayoutSize(ro, len(sl), planned_size)
+            totalDisbursedInTx = sum(amountToSats(o['amount']) for o in sl)
             totalDisbursed += totalDisbursedInTx
-            # Send change back to the pool reward address for easier tracking by observers
-            opts = {
-                'show_fee': True,
-                'changeaddress': self.poolAddrReward
-            }
+            txfees += amountToSats(ro['fee'])
+            txns.append(ro['txid'])
+            self.storePayout(b, ro['txid'], sl, totalDisbursedInTx, txfees, height)
 
-            if self.tx_fee_per_kb is not None:
-                opts['feeRate'] = self.tx_fee_per_kb
+        self.storePaymentRun(db, b, height, totalDisbursed, txfees, txns)
 
-            ro = self.rpc_func('sendtypeto',
-                               ['part', 'part', sl, '', '', 4, 64, False, opts], 'pool_reward')
-
-            txfees += int(decimal.Decimal(ro['fee']) * COIN)
-            txns.append(ro['txid'])
+    def sendPayout(self, outputs, comment='', test_fee=False):
+        # Send change back to the pool reward address for easier tracking by observers
+        opts = {
+            'show_fee': True,
+            'changeaddress': self.poolAddrReward
+        }
 
-            b.put(bytes([DBT_POOL_PENDING_PAYOUT]) + bytes.fromhex(ro['txid']), totalDisbursedInTx.to_bytes(8, 'big') + txfees.to_bytes(8, 'big'))
+        if self.tx_fee_per_kb is not None:
+            opts['feeRate'] = self.tx_fee_per_kb
+
+        with mxSend:
+            return self.rpc_func('sendtypeto',
+                                 ['part', 'part', outputs, comment, '', 4, 64, test_fee, opts], 'pool_reward')
+
+    def planPayments(self, outputs):
+        # Returns [(num_outputs, planned_size)] per txn, planned_size is None for fixed chunks
+        if self.payout_packing != 'adaptive':
+            return [(min(self.maxOutputsPerTx, len(outputs) - i), None) for i in range(0, len(outputs), self.maxOutputsPerTx)]
+
+        with mxSend:
+            utxos = [amountToSats(u['amount']) for u in self.rpc_func('listunspent', [0], 'pool_reward')]
+        fee_per_kb = amountToSats(self.tx_fee_per_kb if self.tx_fee_per_kb is not None else 0.0002)
+        plan = planPayoutTxns(outputs, utxos, self.max_payout_tx_size, fee_per_kb)
+
+        if self.payout_test_fee:
+            # Split txns the wallet would build larger than the limit
+            checked = []
+            i = 0
+            while len(plan) > 0:
+                num_outputs, planned_size = plan.pop(0)
+                ro = self.sendPayout(outputs[i:i + num_outputs], test_fee=True)
+                if ro.get('bytes', 0) > self.max_payout_tx_size and num_outputs > 1:
+                    half = num_outputs // 2
+                    plan[0:0] = [(half, planned_size * half // num_outputs), (num_outputs - half, planned_size * (num_outputs - half) // num_outputs)]
+                    continue
+                checked.append((num_outputs, ro.get('bytes', planned_size)))
+                i += num_outputs
+            plan = checked
 
-            if self.debug:
-                for o in sl:
-                    with open(os.path.join(self.debugDir, o['address'] + '.csv'), 'a') as fp:
-                        fp.write('%d,%s,%s,%s,%s,%s,%s,%s\n'
-                                 % (height,
-                                    '',
-                                    '',
-                                    '',
-                                    '',
-                                    '',
-                                    o['amount'],
-                                    ro['txid'],
-                                    ))
+        self.log('Planned %d payout txns of %s bytes' % (len(plan), ', '.join(str(p[1]) for p in plan)))
+        return plan
 
+    def reportPayoutSize(self, ro, num_outputs, planned_size):
+        if 'bytes' in ro:
+            telemetry.payout_tx_bytes.observe(ro['bytes'], 'actual')
+        if planned_size is None:
+            return
+        telemetry.payout_tx_bytes.observe(planned_size, 'planned')
+        self.log('Payout txn %s: %d outputs, planned %d bytes, actual %s bytes.' % (ro['txid'], num_outputs, planned_size, ro.get('bytes', 'unknown')))
+
+    def storePayout(self, b, txid, outputs, disbursed, fees, height):
+        b.put(bytes([DBT_POOL_PENDING_PAYOUT]) + bytes.fromhex(txid), disbursed.to_bytes(8, 'big') + fees.to_bytes(8, 'big'))
+        b.put(bytes([DBT_PAYOUT_STATUS]) + bytes.fromhex(txid),
+              packPayoutStatus(PAYOUT_BROADCAST, 0, 0, [(decodeAddress(o['address']), amountToSats(o['amount'])) for o in outputs]))
+        self.payouts_tracked.add(txid)
+
+        if self.debug and self.address_csv:
+            for o in outputs:
+                self.audit_writer.write(o['address'] + '.csv', '%d,%s,%s,%s,%s,%s,%s,%s\n'
+                                        % (height,
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           '',
+                                           o['amount'],
+                                           txid,
+                                           ))
+
+    def storePaymentRun(self, db, b, height, totalDisbursed, txfees, txns):
         dbkey = bytes([DBT_DATA]) + b'pool_fees'
         n = db.get(dbkey)
         totalPoolFees = txfees if n is None else txfees + int.from_bytes(n, 'big')
         b.put(dbkey, totalPoolFees.to_bytes(8, 'big'))
 
         if self.debug:
-            with open(os.path.join(self.debugDir, 'pool.csv'), 'a') as fp:
-                fp.write('%d,%s,%s,%s,%s,%s,%s,%s,%s\n'
-                         % (height,
-                            '',
-                            '',
-                            '',
-                            '',
-                            format8(totalDisbursed),
-                            format8(txfees),
-                            format8(totalPoolFees),
-                            '|'.join(txns)
-                            ))
+            self.audit_writer.write('pool.csv', '%d,%s,%s,%s,%s,%s,%s,%s,%s\n'
+                                    % (height,
+                                       '',
+                                       '',
+                                       '',
+                                       '',
+                                       format8(totalDisbursed),
+                                       format8(txfees),
+                                       format8(totalPoolFees),
+                                       '|'.join(txns)
+                                       ))
+
+    def queuePayments(self, db, b, outputs, height):
+        if self.mode != 'master':
+            self.log('WARNING: Not sending payment run %d, pool mode is %s.' % (height, self.mode), level=LOG_WARNING)
+            return
+        if self.payment_thread is None:
+            self.makePayments(db, b, outputs, height)
+            return
+
+        # Safety check to prevent double paying if resyncing the chain in master mode, jobs would be sent once caught up
+        ro = self.rpc_func('getblockchaininfo')
+        if ro['blocks'] >= self.poolHeight + self.blockBuffer + 5:
+            self.log('Warning: Pool height is below node height, skipping disbursement, %d, %d.\n' % (self.poolHeight, ro['blocks']))
+            return
+
+        # Outputs are split into txns when queued so a resumed job sends the same txns
+        plan = self.planPayments(outputs)
+        job = {'outputs': outputs, 'chunks': [p[0] for p in plan], 'planned': [p[1] for p in plan], 'txns': [], 'fees': 0, 'sending': False}
+        b.put(bytes([DBT_PAYMENT_JOB]) + struct.pack('>i', height), json.dumps(job).encode('utf-8'))
+        self.payment_event.set()
+
+    def runPaymentJobs(self):
+        while self.is_running and not self.payment_stop:
+            self.payment_event.clear()
+            try:
+                if self.sendPaymentJobs():
+                    continue
+                self.consolidateRewardOutputs(self.chainHeight)
+            except Exception:
+                self.log('ERROR: %s\n' % (traceback.format_exc()))
+            self.payment_event.wait(PAYMENT_JOB_RETRY)
+
+    def sendPaymentJobs(self):
+        # Sends the next txn of the oldest job, returns True if there may be more to send.
+        # A txn is marked as sending before sendtypeto, if interrupted the wallet is searched for it before sending again.
+        job_height, job = self.readPaymentJob()
+        if job is None:
+            return False
+        if self.rpc_func('getblockchaininfo')['blocks'] >= self.poolHeight + self.blockBuffer + 5:
+            self.log('Warning: Pool height is below node height, delaying payment job %d.' % (job_height))
+            return False
+
+        i = len(job['txns'])
+        start = sum(job['chunks'][:i])
+        sl = job['outputs'][start:start + job['chunks'][i]]
+        comment = 'Stake pool payout %d.%d' % (job_height, i)
+        ro = None
+        if job['sending']:
+            ro = self.findPayoutByComment(comment)
+        else:
+            self.setPaymentJobSending(job_height, job)
+        if ro is None:
+            ro = self.sendPayout(sl, comment)
+            self.reportPayoutSize(ro, len(sl), job['planned'][i])
+        self.storePaymentJobTx(job_height, job, sl, ro)
+        return True
+
+    @getDBMutex
+    def readPaymentJob(self):
+        db = self.openDB()
+        try:
+            for k, v in db.iterator(prefix=bytes([DBT_PAYMENT_JOB])):
+                return struct.unpack('>i', k[1:5])[0], json.loads(v)
+        finally:
+            db.close()
+        return None, None
+
+    @getDBMutex
+    def setPaymentJobSending(self, job_height, job):
+        job['sending'] = True
+        db = self.openDB()
+        try:
+            db.put(bytes([DBT_PAYMENT_JOB]) + struct.pack('>i', job_height), json.dumps(job).encode('utf-8'))
+        finally:
+            db.close()
+
+    def findPayoutByComment(self, comment):
+        for tx in reversed(self.rpc_func('listtransactions', ['*', 1000, 0, False], 'pool_reward')):
+            if tx.get('comment') == comment and tx.get('category') == 'send':
+                self.log('Found payment job txn %s sent before interruption.' % (tx['txid']))
+                return {'txid': tx['txid'], 'fee': abs(tx.get('fee', 0))}
+        return None
+
+    @getDBMutex
+    def storePaymentJobTx(self, job_height, job, outputs, ro):
+        job['fees'] += amountToSats(ro['fee'])
+        job['txns'].append(ro['txid'])
+        job['sending'] = False
+        dbkey = bytes([DBT_PAYMENT_JOB]) + struct.pack('>i', job_height)
+        db = self.openDB()
+        try:
+            with db.write_batch(transaction=True) as b:
+                disbursed = sum(amountToSats(o['amount']) for o in outputs)
+                self.storePayout(b, ro['txid'], outputs, disbursed, job['fees'], job_height)
+                if len(job['txns']) < len(job['chunks']):
+                    b.put(dbkey, json.dumps(job).encode('utf-8'))
+                    return
+                b.delete(dbkey)
+                self.storePaymentRun(db, b, job_height, sum(amountToSats(o['amount']) for o in job['outputs']), job['fees'], job['txns'])
+        finally:
+            db.close()
+        self.log('Payment job %d sent in %d txns.' % (job_height, len(job['txns'])))
+
+    def consolidateRewardOutputs(self, chain_height):
+        # Coin selection is serialised with the payout and withdrawal sends by mxSend.
+        # Only while the pool is at the tip, no payment job is queued and no payment run or planned payout is due within 'idleblocks'.
+        if self.mode != 'master' or self.consolidation is None or not self.is_running:
+            return
+        if chain_height - self.blockBuffer > self.poolHeight or self.consolidation_height >= chain_height:
+            return
+        self.consolidation_height = chain_height
+
+        last_payment_run, num_jobs, first_planned = self.readPaymentState()
+        next_send = last_payment_run + max(1, self.minBlocksBetweenPayments // self.payoutCohorts)
+        if first_planned is not None:
+            # Sent by processMaturedBlocks once the planned block matures
+            next_send = min(next_send, first_planned + self.undo_blocks)
+        if num_jobs > 0 or next_send - self.poolHeight <= self.consolidation.get('idleblocks', 10):
+            return
+
+        with mxSend:
+            max_value = amountToSats(self.consolidation.get('maxvalue', 1.0))
+            utxos = [u for u in self.rpc_func('listunspent', [1, 9999999, [self.poolAddrReward, ]], 'pool_reward')
+                     if u.get('spendable', True) and amountToSats(u['amount']) < max_value]
+            if len(utxos) < self.consolidation.get('minutxos', 100):
+                return
+            utxos.sort(key=lambda u: u['amount'])
+            utxos = utxos[:self.consolidation.get('maxinputs', 200)]
+            total = sum(amountToSats(u['amount']) for u in utxos)
+
+            opts = {
+                'show_fee': True,
+                'changeaddress': self.poolAddrReward,
+                'inputs': [{'tx': u['txid'], 'n': u['vout']} for u in utxos],
+            }
+            fee_rate = self.consolidation.get('feerate', self.tx_fee_per_kb)
+            if fee_rate is not None:
+                opts['feeRate'] = fee_rate
+            outputs = [{'address': self.poolAddrReward, 'amount': format8(total), 'subfee': True}]
+            ro = self.rpc_func('sendtypeto',
+                               ['part', 'part', outputs, 'Stake pool consolidation', '', 4, 64, False, opts], 'pool_reward')
+
+        fee = amountToSats(ro['fee'])
+        self.addPoolFees(fee)
+        self.log('Consolidated %d pool reward coins of %s in %s, fee %s.' % (len(utxos), format8(total), ro['txid'], format8(fee)))
+
+    @getDBMutex
+    def readPaymentState(self):
+        # Returns the last payment run height, the number of queued payment jobs and the height of the first planned payout or None
+        db = self.openDB()
+        try:
+            n = db.get(bytes([DBT_DATA]) + b'last_payment_run')
+            num_jobs = sum(1 for k in db.iterator(prefix=bytes([DBT_PAYMENT_JOB]), include_value=False))
+            first_planned = None
+            for k in db.iterator(prefix=bytes([DBT_POOL_PLANNED_PAYOUT]), include_value=False):
+                first_planned = struct.unpack('>i', k[1:5])[0]
+                break
+            return 0 if n is None else struct.unpack('>i', n)[0], num_jobs, first_planned
+        finally:
+            db.close()
+
+    @getDBMutex
+    def addPoolFees(self, fee):
+        db = self.openDB()
+        try:
+            dbkey = bytes([DBT_DATA]) + b'pool_fees'
+            n = db.get(dbkey)
+            db.put(dbkey, (fee if n is None else fee + int.from_bytes(n, 'big')).to_bytes(8, 'big'))
+        finally:
+            db.close()
+
+    @getDBMutex
+    def getPaymentJobs(self):
+        rv = []
+        db = self.openDB()
+        try:
+            for k, v in db.iterator(prefix=bytes([DBT_PAYMENT_JOB])):
+                job = json.loads(v)
+                rv.append({
+                    'height': struct.unpack('>i', k[1:5])[0],
+                    'outputs': len(job['outputs']),
+                    'txns': len(job['chunks']),
+                    'sent': job['txns'],
+                })
+        finally:
+            db.close()
+        return rv
 
     def processPayments(self, height, db, b):
         self.log('processPayments height: %d\n' % (height))
 
         b.put(bytes([DBT_DATA]) + b'last_payment_run', struct.pack('>i', height))
 
+        cohort = None
+        if self.payoutCohorts > 1:
+            dbkey = bytes([DBT_DATA]) + b'last_payment_cohort'
+            n = db.get(dbkey)
+            cohort = 0 if n is None else (struct.unpack('>i', n)[0] + 1) % self.payoutCohorts
+            b.put(dbkey, struct.pack('>i', cohort))
+            self.log('Paying cohort %d of %d' % (cohort + 1, self.payoutCohorts))
+
         outputs = []
+        batch_mirror = dict()
         for key, value in db.iterator(prefix=bytes([DBT_BAL])):
             addrAccumulated = int.from_bytes(value[:16], 'big')
 
             if (addrAccumulated // COIN) < self.payoutThreshold:
                 continue
 
+            if cohort is not None and payoutCohort(key[1:], self.payoutCohorts) != cohort:
+                continue
+
             addrPending = int.from_bytes(value[16:24], 'big')
             addrPaidout = int.from_bytes(value[24:32], 'big')
             address = encodeAddress(key[1:])
@@ -648,6 +1942,7 @@ class StakePool():
             addrAccumulated -= payout * COIN
 
             outputs.append({'address': address, 'amount': format8(payout)})
+            self.setPendingIndex(key[1:], addrPending, addrPending + payout, db, b, batch_mirror)
             addrPending += payout
 
             b.put(key, addrAccumulated.to_bytes(16, 'big') + addrPending.to_bytes(8, 'big') + addrPaidout.to_bytes(8, 'big') + value[32:])
@@ -658,12 +1953,98 @@ class StakePool():
         if self.mode != 'master' or not self.automatic_disbursement:
             return
 
-        self.makePayments(db, b, outputs, height)
+        if self.undo_blocks > 0:
+            # Sent by processMaturedBlocks once the block can no longer be reorganised
+            b.put(bytes([DBT_POOL_PLANNED_PAYOUT]) + struct.pack('>i', height), json.dumps(outputs).encode('utf-8'))
+            return
+
+        self.queuePayments(db, b, outputs, height)
+
+    @getDBMutex
+    def exportSnapshot(self, path):
+        if self.db_upgrading:
+            raise ValueError('Database is upgrading')
+        db = self.openDB()
+        try:
+            n = db.get(bytes([DBT_DATA]) + b'current_height')
+            if n is None:
+                raise ValueError('No blocks processed')
+            height = struct.unpack('>i', n)[0]
+            n = db.get(bytes([DBT_DATA]) + b'db_version')
+            db_version = 0 if n is None else struct.unpack('>i', n)[0]
+            blockhash = self.rpc_func('getblockhash', [height])
+
+            writer = SnapshotWriter(path, self.chain, height, blockhash, db_version)
+            try:
+                for k, v in db.iterator():
+                    if inSnapshot(k):
+                        writer.add(k, v)
+            except Exception:
+                writer.abort()
+                os.remove(path)
+                raise
+            writer.close()
+        finally:
+            db.close()
+        self.log('Wrote snapshot of %d records at height %d to %s' % (writer.num_records, height, path))
+        return height
+
+    @getDBMutex
+    def importSnapshot(self, path):
+        # Replace a new pool db with the snapshot, block processing continues from the snapshot height
+        header, records = readSnapshot(path)
+        # Snapshots written by earlier versions hold every record
+        dropped = [k for k, v in records if not inSnapshot(k)]
+        if len(dropped) > 0:
+            records = [(k, v) for k, v in records if inSnapshot(k)]
+            self.log('WARNING: Dropped %d snapshot records of the exporting pool\'s own state.' % (len(dropped)), level=LOG_WARNING)
+            if any(k[0] in CHANGE_STREAM_EXCLUDED for k in dropped):
+                self.log('WARNING: The snapshot held unsent payment runs, their amounts stay pending unless sent by the exporting pool.'
+                         ' Start with \'recalc_pending\' to return them to the accumulated balances.', level=LOG_WARNING)
+        if header['chain'] != self.chain:
+            raise ValueError('Snapshot is for chain %s' % (header['chain']))
+        if header['db_version'] > CURRENT_DB_VERSION:
+            raise ValueError('Snapshot db version %d is newer than supported %d' % (header['db_version'], CURRENT_DB_VERSION))
+
+        snapshot_data = {k: v for k, v in records if k[0] == DBT_DATA}
+        if snapshot_data.get(bytes([DBT_DATA]) + b'pool_addr') != bech32Decode(self.poolAddrHrp, self.settings['pooladdress']):
+            raise ValueError('Snapshot is for a different pool address')
+
+        self.waitForDaemonRPC()
+        blockhash = self.rpc_func('getblockhash', [header['height']])
+        if blockhash != header['blockhash']:
+            raise ValueError('Snapshot block %s at height %d is not in the chain' % (header['blockhash'], header['height']))
+
+        db = self.openDB()
+        try:
+            if db.get(bytes([DBT_DATA]) + b'current_height') is not None:
+                raise ValueError('Pool db is not empty')
+            b = db.write_batch(transaction=True)
+            for k in db.iterator(include_value=False):
+                b.delete(k)
+            for k, v in records:
+                b.put(k, v)
+            b.write()
+        finally:
+            db.close()
+
+        self.poolHeight = header['height']
+        self.db_version = header['db_version']
+        addr = snapshot_data.get(bytes([DBT_DATA]) + b'reward_addr')
+        if addr is not None:
+            self.poolAddrReward = encodeAddress(addr)
+        self.lastHeightParametersSet = -1
+        self.setParameters(self.poolHeight)
+        self.log('Imported snapshot of %d records at height %d, block %s' % (len(records), header['height'], header['blockhash']))
 
     @getDBMutex
-    def listAccumulated(self, height, db):
+    def listAccumulated(self, height):
         self.log('listAccumulated height: %d' % (height))
+        if self.db_version < CURRENT_DB_VERSION:
+            # The recalc_pending fixes update the pending index, which is built by the last migrations
+            raise ValueError('Database is upgrading')
 
+        db = self.openDB(create_db=True)
         b = db.write_batch(transaction=True)
 
         total_actual_pending = 0
@@ -671,6 +2052,16 @@ class StakePool():
         for k, value in db.iterator(prefix=bytes([DBT_POOL_PENDING_PAYOUT])):
             payment_txid = k[1:].hex()
             self.log(f'Found pending pool payment tx: {payment_txid}')
+
+            # Payouts made since the status was tracked have their outputs stored locally
+            n = db.get(bytes([DBT_PAYOUT_STATUS]) + k[1:])
+            if n is not None:
+                for address, v in unpackPayoutStatus(n)[3]:
+                    address = encodeAddress(address)
+                    pending_payments[address] = pending_payments.get(address, 0) + v
+                    total_actual_pending += v
+                continue
+
             tx = self.rpc_func('getrawtransaction', [payment_txid, True])
 
             for out in tx['vout']:
@@ -700,10 +2091,11 @@ class StakePool():
                 if address == self.poolAddrReward:
                     # Change output
                     continue
-                v = int(decimal.Decimal(out['value']) * COIN)
+                v = amountToSats(out['value'])
                 pending_payments[address] = pending_payments.get(address, 0) + v
                 total_actual_pending += v
 
+        batch_mirror = dict()
         num_addrs: int = 0
         total_addrAccumulated: int = 0
         total_addrPending: int = 0
@@ -724,6 +2116,7 @@ class StakePool():
                 total_reset += diff
                 self.log(f'WARNING: {address} expected pending {addrPending} > actual pending amount in txns {existing_payments}')
                 if self.mode == 'master' and self.settings.get('recalc_pending', False):
+                    self.setPendingIndex(key[1:], addrPending, addrPending - diff, db, b, batch_mirror)
                     addrPending -= diff
                     addrAccumulated += diff * COIN
                     b.put(key, addrAccumulated.to_bytes(16, 'big') + addrPending.to_bytes(8, 'big') + addrPaidout.to_bytes(8, 'big') + value[32:])
@@ -738,16 +2131,20 @@ class StakePool():
             self.log(f'total pending payout reset: {total_reset}')
         else:
             self.log(f'total difference between expected and actual pending payout: {total_reset}')
+        db.close()
 
     @getDBMutex
     def getPending(self, send_txns=False):
         self.log('getPending')
+        if self.db_upgrading:
+            # The pending index is incomplete until its migration finishes
+            raise ValueError('Database is upgrading')
         try:
             db = self.openDB(create_db=True)
 
             outputs = []
-            for key, value in db.iterator(prefix=bytes([DBT_BAL])):
-                amount_pending = int.from_bytes(value[16:24], 'big')
+            for key, value in db.iterator(prefix=bytes([DBT_PENDING_INDEX])):
+                amount_pending = int.from_bytes(value, 'big')
 
                 if amount_pending < self.payoutThreshold:
                     continue
@@ -767,14 +2164,38 @@ class StakePool():
             db.close()
         return outputs
 
+    @getDBMutex
+    def getPendingPage(self, cursor=None, limit=HISTORY_PAGE_SIZE):
+        # Addresses with a pending payout in address order, cursor: continue after a previous page
+        if self.db_upgrading:
+            raise ValueError('Database is upgrading')
+        limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+        seek_key = bytes([DBT_PENDING_INDEX])
+        if cursor is not None:
+            address = decodeAddress(cursor)
+            if address is None:
+                raise ValueError('Invalid cursor')
+            seek_key += address
+        db = self.openDB()
+        try:
+            n = db.get(bytes([DBT_DATA]) + b'pending_index')
+            records = []
+            for k, v in db.iterator(start=seek_key, include_start=cursor is None, stop=bytes([DBT_PENDING_INDEX + 1])):
+                records.append({'address': encodeAddress(k[1:]), 'amount': format8(int.from_bytes(v, 'big'))})
+                if len(records) >= limit:
+                    break
+        finally:
+            db.close()
+        return {
+            'pending': records,
+            'total': 0 if n is None else int.from_bytes(n[:4], 'big'),
+            'totalamount': format8(0 if n is None else int.from_bytes(n[4:12], 'big')),
+            'next': records[-1]['address'] if len(records) >= limit else None,
+        }
+
     def findPayments(self, height, coinstakeid, db, b, batchBalances):
         # logm(self.fp, 'findPayments')
-        opts = {
-            'addresses': [self.poolAddrReward],
-            'start': height,
-            'end': height,
-        }
-        ro = self.rpc_func('getaddressdeltas', [opts, ])
+        ro = self.rpc_func(*BLOCK_RPC_CALLS['deltas'](self.poolAddrReward, height))
 
         txids = set()
         for delta in ro:
@@ -788,19 +2209,19 @@ class StakePool():
             return
 
         for txid in txids:
-            ro = self.rpc_func('getrawtransaction', [txid, True])
+            ro = self.rpc_func(*BLOCK_RPC_CALLS['tx'](txid))
 
             have_blinded = False
             total_input_value = 0
             total_output_value = 0
             for n, inp in enumerate(ro['vin']):
                 try:
-                    ri = self.rpc_func('getrawtransaction', [inp['txid'], True])
+                    ri = self.rpc_func(*BLOCK_RPC_CALLS['tx'](inp['txid']))
                     prevout = ri['vout'][inp['vout']]
                     if prevout['type'] == 'blind':
                         have_blinded = True
                     else:
-                        total_input_value += int(decimal.Decimal(prevout['value']) * COIN)
+                        total_input_value += amountToSats(prevout['value'])
                 except Exception:
                     self.log('WARNING: Could not get prevout value input %s.%d.\n' % (txid, n))
 
@@ -821,7 +2242,7 @@ class StakePool():
                     self.log('WARNING: Found txn %s paying to unknown output type.\n' % (txid))
                     continue
 
-                v = int(decimal.Decimal(out['value']) * COIN)
+                v = amountToSats(out['value'])
                 total_output_value += v
 
                 address = None
@@ -847,14 +2268,14 @@ class StakePool():
                     self.setBatched(dbkey, poolWithdrawnTotal.to_bytes(8, 'big'), b, batchBalances)
 
                     if self.debug:
-                        with open(os.path.join(self.debugDir, 'pool_withdrawals.csv'), 'a') as fp:
-                            fp.write('%d,%s,%d,%s,%s\n'
-                                     % (height, txid, out['n'], address, format8(v)))
+                        self.audit_writer.write('pool_withdrawals.csv', '%d,%s,%d,%s,%s\n'
+                                                % (height, txid, out['n'], address, format8(v)))
                     continue
 
                 addrReward = int.from_bytes(n[:16], 'big')
                 addrPending = int.from_bytes(n[16:24], 'big')
                 addrPaidout = int.from_bytes(n[24:32], 'big')
+                oldPending = addrPending
                 addrPending -= v
                 addrPaidout += v
                 totalDisbursed += v
@@ -868,13 +2289,22 @@ class StakePool():
                     addrPending = 0
 
                 self.setBatched(dbkey, addrReward.to_bytes(16, 'big') + addrPending.to_bytes(8, 'big') + addrPaidout.to_bytes(8, 'big') + n[32:], b, batchBalances)
+                self.setPendingIndex(dbkey[1:], oldPending, addrPending, db, b, batchBalances)
+
+                if self.address_history:
+                    dbkey = addressHistoryPrefix(decodeAddress(address)) + struct.pack('>i', height) + bytes([HISTORY_PAYOUT]) + bytes.fromhex(txid)
+                    n = self.getBatched(dbkey, db, batchBalances)
+                    amount = v if n is None else v + int.from_bytes(n, 'big')
+                    self.setBatched(dbkey, amount.to_bytes(8, 'big'), b, batchBalances)
 
                 if self.debug:
-                    self.log('Payout to %s: %s %d %s.' % (address, txid, out['n'], format8(v)))
+                    self.log('Payout to %s: %s %d %s.' % (address, txid, out['n'], format8(v)), level=LOG_DEBUG)
 
             if totalDisbursed > 0:
-                b.put(bytes([DBT_POOL_PAYOUT]) + struct.pack('>i', height) + bytes.fromhex(txid), totalDisbursed.to_bytes(8, 'big'))
+                b.put(bytes([DBT_POOL_PAYOUT]) + struct.pack('>i', height) + bytes.fromhex(txid), totalDisbursed.to_bytes(8, 'big') + int(ro['blocktime']).to_bytes(8, 'big'))
                 b.delete(bytes([DBT_POOL_PENDING_PAYOUT]) + bytes.fromhex(txid))
+                b.delete(bytes([DBT_PAYOUT_STATUS]) + bytes.fromhex(txid))
+                self.payouts_tracked.discard(txid)
 
                 dbkey = bytes([DBT_DATA]) + b'pool_disbursed'
                 n = self.getBatched(dbkey, db, batchBalances)
@@ -888,20 +2318,22 @@ class StakePool():
                     month_metrics = unpackMonthMetrics(m)
                     month_metrics[2] += totalDisbursed
                     self.setBatched(dbkey, packMonthMetrics(month_metrics), b, batchBalances)
+                self.addPeriodMetrics(int(ro['blocktime']), [0, 0, totalDisbursed, 0], db, b, batchBalances)
 
             try:
                 if have_blinded:
-                    fee = ro['vout'][0]['ct_fee']
+                    fee = amountToSats(ro['vout'][0]['ct_fee'])
                 else:
                     fee = total_input_value - total_output_value
 
                 if self.debug:
-                    self.log('Payout tx %s, input %s, output %s, fee %s.\n' % (txid, format8(total_input_value), format8(total_output_value), format8(fee)))
+                    self.log('Payout tx %s, input %s, output %s, fee %s.\n' % (txid, format8(total_input_value), format8(total_output_value), format8(fee)), level=LOG_DEBUG)
 
                 dbkey = bytes([DBT_DATA]) + b'pool_fees_detected'
                 n = self.getBatched(dbkey, db, batchBalances)
                 total_pool_fees = fee if n is None else fee + int.from_bytes(n, 'big')
                 self.setBatched(dbkey, total_pool_fees.to_bytes(8, 'big'), b, batchBalances)
+                self.addPeriodMetrics(int(ro['blocktime']), [0, 0, 0, fee], db, b, batchBalances)
             except Exception:
                 self.log('ERROR: %s\n' % (traceback.format_exc()))
 
@@ -912,7 +2344,7 @@ class StakePool():
 
         r = self.rpc_func('getwalletinfo', wallet='pool_reward')
 
-        n = db.get(bytes([DBT_POOL_BAL]) + decodeAddress(self.poolAddrReward))
+        n = self.getMaturedValue(bytes([DBT_POOL_BAL]) + decodeAddress(self.poolAddrReward), db, height)
         pool_reward = 0 if n is None else int.from_bytes(n, 'big')
 
         n = db.get(bytes([DBT_DATA]) + b'pool_fees')
@@ -920,14 +2352,14 @@ class StakePool():
 
         n = db.get(bytes([DBT_DATA]) + b'pool_withdrawn')
         pool_reward_withdrawn = 0 if n is None else int.from_bytes(n, 'big')
-        pool_reward_bal = float(decimal.Decimal((pool_reward - (poolfees + pool_reward_withdrawn)) / COIN))
+        pool_reward_bal = (pool_reward - (poolfees + pool_reward_withdrawn)) / COIN
 
         reserve = self.settings['poolownerwithdrawal']['reserve']
         threshold = self.settings['poolownerwithdrawal']['threshold']
 
         if self.debug:
             self.log('Balance %f, reserve %f, threshold %f\npool_reward %s, poolfees %s, pool_reward_withdrawn %s, pool_reward_bal %f' %
-                     (r['balance'], reserve, threshold, format8(decimal.Decimal(pool_reward)), format8(decimal.Decimal(poolfees)), format8(decimal.Decimal(pool_reward_withdrawn)), pool_reward_bal), with_time=False)
+                     (r['balance'], reserve, threshold, format8(pool_reward), format8(poolfees), format8(pool_reward_withdrawn), pool_reward_bal), with_time=False)
 
         if r['balance'] <= reserve or pool_reward_bal < reserve + threshold:
             return
@@ -938,7 +2370,7 @@ class StakePool():
             return
 
         try:
-            withdraw_amount = int(decimal.Decimal(pool_reward_bal - reserve) * COIN)
+            withdraw_amount = pool_reward - (poolfees + pool_reward_withdrawn) - amountToSats(reserve)
 
             # Send change back to the pool reward address for easier tracking by observers
             opts = {
@@ -965,10 +2397,11 @@ class StakePool():
                 outputs.append({'address': withdraw_pair[0], 'amount': amount})
                 self.log('Withdrawing %s to: %s' % (amount, withdraw_pair[0]))
 
-            ro = self.rpc_func('sendtypeto',
-                               ['part', 'part', outputs, '', '', 4, 64, False, opts], 'pool_reward')
+            with mxSend:
+                ro = self.rpc_func('sendtypeto',
+                                   ['part', 'part', outputs, '', '', 4, 64, False, opts], 'pool_reward')
 
-            txfee = int(decimal.Decimal(ro['fee']) * COIN)
+            txfee = amountToSats(ro['fee'])
             self.log('Withdrew %s in tx: %s\n' % (format8(withdraw_amount), ro['txid']))
 
             dbkey = bytes([DBT_DATA]) + b'pool_fees'
@@ -977,11 +2410,10 @@ class StakePool():
             b.put(dbkey, totalPoolFees.to_bytes(8, 'big'))
 
             if self.debug:
-                with open(os.path.join(self.debugDir, 'pool_withdrawals.csv'), 'a') as fp:
-                    for withdraw_pair in dest_pairs:
-                        amount = format8(int(withdraw_pair[1]) // int(total_weight))
-                        fp.write('%d,%s,%d,%s,%s\n'
-                                 % (height, ro['txid'], -1, withdraw_pair[0], amount))
+                for withdraw_pair in dest_pairs:
+                    amount = format8(int(withdraw_pair[1]) // int(total_weight))
+                    self.audit_writer.write('pool_withdrawals.csv', '%d,%s,%d,%s,%s\n'
+                                            % (height, ro['txid'], -1, withdraw_pair[0], amount))
 
                 r = self.rpc_func('getwalletinfo', wallet='pool_reward')
                 self.log('Available balance after withdrawal %f' % (r['balance']), with_time=False)
@@ -990,24 +2422,177 @@ class StakePool():
             self.log('ERROR: %s\n' % (traceback.format_exc()))
 
     def checkBlocks(self, limit_blocks=-1):
+        # Reads all queued zmq notifications, new blocks are processed once after
+        if self.db_upgrading:
+            return
         try:
-            message = self.zmqSubscriber.recv(flags=zmq.NOBLOCK)
-            if message == b'hashblock':
-                message = self.zmqSubscriber.recv()
+            new_block = False
+            chain_height = None  # From the last rawblock, unless a later hashblock is for another block
+            while True:
+                try:
+                    message = self.zmqSubscriber.recv(flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                body = self.zmqSubscriber.recv()
                 seq = self.zmqSubscriber.recv()
-                r = self.rpc_func('getblockchaininfo')
-                while r['blocks'] - self.blockBuffer > self.poolHeight and self.is_running:
+                if message == b'hashtx':
+                    txid = body.hex()
+                    if txid in self.payouts_tracked:
+                        self.payouts_check.add(txid)
+                        self.updatePayoutStatus(txid, PAYOUT_MEMPOOL, seen=int(time.time()))
+                elif message == b'rawblock':
+                    new_block = True
+                    chain_height = self.ingestRawBlock(body)
+                elif message == b'hashblock':
+                    new_block = True
+                    if chain_height is not None and self.raw_blocks.getBlockHash(chain_height) != body.hex():
+                        chain_height = None
+            if new_block:
+                if chain_height is None:
+                    chain_height = self.rpc_func('getblockchaininfo')['blocks']
+                self.chainHeight = chain_height
+                while chain_height - self.blockBuffer > self.poolHeight and self.is_running:
                     self.processBlock(self.poolHeight + 1)
                     if limit_blocks < 0:
                         continue
                     limit_blocks -= 1
                     if limit_blocks == 0:
                         break
-        except zmq.Again as e:
-            pass
+                if len(self.payouts_tracked) > 0:
+                    self.checkPayoutConfirmations(chain_height)
+                if self.raw_blocks is not None:
+                    self.raw_blocks.prune(self.poolHeight)
+                if self.show_provisional:
+                    self.updateProvisional(chain_height)
+                if self.payment_thread is None:
+                    self.consolidateRewardOutputs(chain_height)
+                else:
+                    self.payment_event.set()
         except Exception:
             self.log('ERROR: %s\n' % (traceback.format_exc()))
 
+    def ingestRawBlock(self, data):
+        # Returns the height of the block or None if it could not be decoded
+        try:
+            return self.raw_blocks.add(data)
+        except Exception as e:
+            self.log('WARNING: Ignoring rawblock notification: %s' % (str(e)), level=LOG_WARNING)
+        return None
+
+    @getDBMutex
+    def loadPayoutStatus(self):
+        # Unconfirmed payouts are looked up at the next block in case notifications were missed while stopped
+        db = self.openDB()
+        try:
+            for k, v in db.iterator(prefix=bytes([DBT_PAYOUT_STATUS])):
+                if v[0] != PAYOUT_CONFIRMED:
+                    self.payouts_tracked.add(k[1:].hex())
+        finally:
+            db.close()
+        self.payouts_check.update(self.payouts_tracked)
+
+    @getDBMutex
+    def updatePayoutStatus(self, txid, status, seen=0, height=0):
+        # Status only moves forward, the record is removed by findPayments when the payout is processed
+        db = self.openDB()
+        try:
+            dbkey = bytes([DBT_PAYOUT_STATUS]) + bytes.fromhex(txid)
+            n = db.get(dbkey)
+            if n is None:
+                self.payouts_tracked.discard(txid)
+                return
+            old_status, old_seen, old_height, outputs = unpackPayoutStatus(n)
+            if status <= old_status:
+                return
+            db.put(dbkey, packPayoutStatus(status, old_seen if old_seen > 0 else seen, height, outputs))
+        finally:
+            db.close()
+        if status == PAYOUT_CONFIRMED:
+            self.payouts_tracked.discard(txid)
+            self.log('Payout %s confirmed at height %d' % (txid, height))
+
+    def checkPayoutConfirmations(self, chain_height):
+        # Raw blocks are searched for every tracked payout, the daemon is only asked about txns seen by hashtx
+        check = self.payouts_check
+        self.payouts_check = set()
+        for txid in list(self.payouts_tracked):
+            height = None
+            if self.raw_blocks is not None:
+                height = self.raw_blocks.getTxHeight(txid)
+            if height is None and txid in check:
+                try:
+                    tx = self.rpc_func('getrawtransaction', [txid, True])
+                except Exception as e:
+                    self.log('WARNING: Payout %s lookup failed: %s' % (txid, str(e)), level=LOG_WARNING)
+                    continue
+                if tx.get('confirmations', 0) > 0:
+                    height = chain_height - tx['confirmations'] + 1
+            if height is not None:
+                self.updatePayoutStatus(txid, PAYOUT_CONFIRMED, seen=int(time.time()), height=height)
+
+    @getDBMutex
+    def getPayoutStatus(self):
+        rv = []
+        db = self.openDB()
+        try:
+            for k, v in db.iterator(prefix=bytes([DBT_PAYOUT_STATUS])):
+                status, seen, height, outputs = unpackPayoutStatus(v)
+                rv.append({
+                    'txid': k[1:].hex(),
+                    'status': PAYOUT_STATUS_NAMES[status],
+                    'seen': seen,
+                    'height': height,
+                    'amount': format8(sum(v for a, v in outputs)),
+                    'outputs': len(outputs),
+                })
+        finally:
+            db.close()
+        return rv
+
+    def updateProvisional(self, chain_height):
+        # Preview the rewards of the blocks above the pool height, nothing is committed.
+        # Blocks are dropped once processed, all are recomputed if the highest no longer matches the chain.
+        provisional = {h: v for h, v in self.provisional.items() if h > self.poolHeight}
+        if len(provisional) > 0:
+            top = max(provisional)
+            if top > chain_height or provisional[top]['blockhash'] != self.rpc_func('getblockhash', [top]):
+                provisional = {}
+
+        rewards = []
+        for height in range(max(self.poolHeight, chain_height - self.blockBuffer) + 1, chain_height + 1):
+            if height not in provisional:
+                rewards.append((height, self.rpc_func('getblockreward', [height, ])))
+        provisional.update(self.previewBlocks(rewards))
+        self.provisional = provisional
+
+    @getDBMutex
+    def previewBlocks(self, rewards):
+        rv = {}
+        db = self.openDB()
+        try:
+            for height, reward in rewards:
+                entry = {'blockhash': reward['blockhash'], 'credits': {}}
+                rv[height] = entry
+                if 'coinstake' not in reward \
+                   or not any(out.get('script', {}).get('spendaddr') == self.poolAddrReward for out in reward['outputs']):
+                    continue
+                b = PreviewBatch()
+                self.processPoolBlock(height, reward, db, b, dict(), preview=True)
+                n = b.writes[bytes([DBT_POOL_BLOCK]) + struct.pack('>i', height)]
+                entry['blockreward'] = int.from_bytes(n[32:40], 'big')
+                entry['poolcointotal'] = int.from_bytes(n[40:48], 'big')
+                for k, v in b.writes.items():
+                    if k[0] != DBT_BAL:
+                        continue
+                    n = db.get(k)
+                    entry['credits'][k[1:]] = int.from_bytes(v[:16], 'big') - (0 if n is None else int.from_bytes(n[:16], 'big'))
+        finally:
+            db.close()
+        return rv
+
+    def getProvisional(self):
+        return {h: v for h, v in self.provisional.items() if h > self.poolHeight}
+
     @getDBMutex
     def getAddressSummary(self, address_str):
         rv = {}
@@ -1036,74 +2621,145 @@ class StakePool():
 
         totalCoinCurrent = 0
         for utxo in utxos:
-            totalCoinCurrent += int(decimal.Decimal(utxo['amount']) * COIN)
+            totalCoinCurrent += amountToSats(utxo['amount'])
         rv['currenttotal'] = totalCoinCurrent
 
+        if self.show_provisional:
+            provisional = [v['credits'][address] for v in self.getProvisional().values() if address in v['credits']]
+            rv['provisional'] = {'accumulated': sum(provisional), 'blocks': len(provisional)}
+
         return rv
 
-    @getDBMutex
-    def rebuildMetrics(self):
+    def requestRebuildMetrics(self):
+        if self.db_upgrading:
+            raise ValueError('Database is upgrading')
+        return self.startRebuildMetrics()
 
-        # Remove old metrics cache records
-        db = self.openDB()
-        it = db.iterator(prefix=bytes([DBT_POOL_METRICS]))
-        try:
-            while True:
-                k, v = next(it)
-                db.delete(k)
-        except Exception:
-            pass
-        it.close()
+    def startRebuildMetrics(self):
+        with mxDB:
+            if not self.metrics_rebuild.get('running', False):
+                self.metrics_rebuild = {'running': True, 'processedblocks': 0, 'processedpayments': 0}
+                self.metrics_thread = threading.Thread(target=self.rebuildMetrics, name='metrics')
+                self.metrics_thread.start()
+            return dict(self.metrics_rebuild)
 
-        num_blocks = 0
-        it = db.iterator(prefix=bytes([DBT_POOL_BLOCK]), reverse=True)
-        try:
-            while True:
-                k, v = next(it)
-                foundblock = (struct.unpack('>i', k[1:])[0], v[:32].hex(), int.from_bytes(v[32:40], 'big'), int.from_bytes(v[40:48], 'big'))
-
-                blockinfo = self.rpc_func('getblockheader', [foundblock[1]])
-                date = time.strftime('%Y-%m', time.gmtime(int(blockinfo['time'])))
+    @getDBMutex
+    def getAddressHistory(self, address_str, cursor=None, limit=HISTORY_PAGE_SIZE):
+        address = decodeAddress(address_str)
+        if address is None \
+           or len(address) != 33 and not is_script_prefix(address[0]):
+            raise ValueError('Invalid address')
+        limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
 
-                dbkey = bytes([DBT_POOL_METRICS]) + bytes(date, 'UTF-8')
-                month_metrics = unpackMonthMetrics(db.get(dbkey))
-                month_metrics[0] += 1
-                month_metrics[1] += foundblock[3]
-                db.put(dbkey, packMonthMetrics(month_metrics))
+        prefix = addressHistoryPrefix(address)
+        stop = prefix + (b'\xff' * 5) if cursor is None else prefix + bytes.fromhex(cursor)
+        db = self.openDB()
+        records = []
+        for k, v in db.iterator(start=prefix, stop=stop, reverse=True):
+            records.append((k, v))
+            if len(records) >= limit:
+                break
+        db.close()
 
-                num_blocks += 1
-        except Exception:
-            pass
-        it.close()
+        rv = {'history': [unpackAddressHistory(k, v) for k, v in records]}
+        rv['next'] = records[-1][0][len(prefix):].hex() if len(records) >= limit else None
+        return rv
 
-        pool_disbursed = 0
-        num_payments = 0
-        it = db.iterator(prefix=bytes([DBT_POOL_PAYOUT]), reverse=True)
+    def rebuildMetrics(self):
+        # Metrics are rebuilt into staging keys in checkpointed steps while blocks are processed.
+        # Records above the boundary height can still be rolled back, they're added in the last step which replaces the live metrics.
+        progress = self.metrics_rebuild
+        dbkey = bytes([DBT_DATA]) + b'metrics_rebuild'
         try:
-            while True:
-                k, v = next(it)
-                found_payment = (struct.unpack('>i', k[1:5])[0], int.from_bytes(v[:8], 'big'))
-
-                blockhash = self.rpc_func('getblockhash', [found_payment[0]])
-                blockinfo = self.rpc_func('getblockheader', [blockhash])
-                date = time.strftime('%Y-%m', time.gmtime(int(blockinfo['time'])))
-
-                dbkey = bytes([DBT_POOL_METRICS]) + bytes(date, 'UTF-8')
-                month_metrics = unpackMonthMetrics(db.get(dbkey))
-                month_metrics[2] += found_payment[1]
-                db.put(dbkey, packMonthMetrics(month_metrics))
-
-                pool_disbursed += found_payment[1]
-                num_payments += 1
-        except Exception:
-            pass
-        it.close()
-
-        db.put(bytes([DBT_DATA]) + b'pool_disbursed', pool_disbursed.to_bytes(8, 'big'))
-
-        db.close()
+            with mxDB:
+                db = self.openDB()
+                n = db.get(dbkey)
+                db.close()
+                if n is None:
+                    header, checkpoint = struct.pack('>i', max(0, self.poolHeight - self.undo_blocks)), None
+                else:
+                    header, checkpoint = n[:4], n[4:]
+            boundary = struct.unpack('>i', header)[0]
 
-        return {'processedblocks': num_blocks, 'processedpayments': num_payments}
+            def step(db, b, checkpoint, stats, results):
+                return self.rebuildMetricsStep(boundary, db, b, checkpoint, stats, results)
+            if not self.runSteps(dbkey, header, step, checkpoint, progress):
+                progress['error'] = 'Interrupted, resumes on restart'
+        except Exception as e:
+            self.log('ERROR: rebuildMetrics %s\n' % (traceback.format_exc()))
+            progress['error'] = str(e)
+        finally:
+            progress['running'] = False
+
+        self.log('rebuildMetrics processed %d blocks and %d payments.' % (progress['processedblocks'], progress['processedpayments']))
+        return {'processedblocks': progress['processedblocks'], 'processedpayments': progress['processedpayments']}
+
+    def rebuildMetricsStep(self, boundary, db, b, checkpoint, stats, results):
+        # checkpoint: phase + last key processed
+        # Phases: 0 clear staging, 1 add found blocks, 2 add payouts up to the boundary height, 3 add the records above and replace the live metrics
+        phase = 0 if checkpoint is None else checkpoint[0]
+        staging = bytes([DBT_METRICS_REBUILD])
+
+        if phase == 0:
+            num_removed = 0
+            for k in db.iterator(prefix=staging, include_value=False):
+                b.delete(k)
+                num_removed += 1
+                if num_removed >= self.migration_batch_size:
+                    return bytes([0])
+            return bytes([1, DBT_POOL_BLOCK])
+
+        if phase < 3:
+            prefix = DBT_POOL_BLOCK if phase == 1 else DBT_POOL_PAYOUT
+            records = self.readRecords(db, checkpoint[1:], prefix, self.migration_batch_size, bytes([prefix]) + struct.pack('>i', boundary + 1))
+            for dbkey, m in self.sumRecordMetrics(records, b, results).items():
+                existing = unpackMetrics(dbkey, db.get(staging + dbkey))
+                b.put(staging + dbkey, packMetrics(dbkey, [existing[i] + m[i] for i in range(len(m))]))
+            stats['processedblocks' if phase == 1 else 'processedpayments'] += len(records)
+            if len(records) >= self.migration_batch_size:
+                return bytes([phase]) + records[-1][0]
+            return bytes([2, DBT_POOL_PAYOUT]) if phase == 1 else bytes([3])
+
+        records = []
+        for prefix in (DBT_POOL_BLOCK, DBT_POOL_PAYOUT):
+            records += list(db.iterator(start=bytes([prefix]) + struct.pack('>i', boundary + 1), stop=bytes([prefix + 1])))
+        metrics = {k[1:]: unpackMetrics(k[1:], v) for k, v in db.iterator(prefix=staging)}
+        for dbkey, m in self.sumRecordMetrics(records, b, results).items():
+            existing = metrics.setdefault(dbkey, [0] * len(m))
+            for i in range(len(m)):
+                existing[i] += m[i]
+
+        # Fees can't be recovered from the found block and payout records, keep the detected values
+        for k, v in db.iterator(prefix=bytes([DBT_POOL_PERIOD_METRICS])):
+            fees = unpackPeriodMetrics(v)[3]
+            if fees > 0:
+                metrics.setdefault(k, [0, 0, 0, 0])[3] = fees
+        for prefix in (DBT_POOL_METRICS, DBT_POOL_PERIOD_METRICS):
+            for k in db.iterator(prefix=bytes([prefix]), include_value=False):
+                if k not in metrics:
+                    b.delete(k)
+        for dbkey, m in metrics.items():
+            b.put(dbkey, packMetrics(dbkey, m))
+        for k in db.iterator(prefix=staging, include_value=False):
+            b.delete(k)
+
+        num_blocks = sum(1 for k, v in records if k[0] == DBT_POOL_BLOCK)
+        stats['processedblocks'] += num_blocks
+        stats['processedpayments'] += len(records) - num_blocks
+        return None
+
+    def sumRecordMetrics(self, records, b, results):
+        # Metrics of found block and payout records by metrics key, pool_disbursed included
+        blocktimes = self.lookupBlockTimes(records, results)
+        month_metrics = dict()
+        period_metrics = dict()
+        pool_disbursed = 0
+        for k, v in records:
+            pool_disbursed += addRecordMetrics(month_metrics, k, v, self.getRecordBlockTime(k, v, b, blocktimes), period_metrics)
+        rv = {bytes([DBT_POOL_METRICS]) + bytes(date, 'UTF-8'): m for date, m in month_metrics.items()}
+        rv.update(period_metrics)
+        rv[bytes([DBT_DATA]) + b'pool_disbursed'] = [pool_disbursed]
+        return rv
 
     @getDBMutex
     def getMetrics(self):
@@ -1122,11 +2778,86 @@ class StakePool():
 
         return month_metrics
 
+    @getDBMutex
+    def getPeriodMetrics(self, resolution, time_from=None, time_to=None):
+        if resolution not in METRICS_RESOLUTIONS:
+            raise ValueError('Unknown resolution')
+        r = METRICS_RESOLUTIONS[resolution]
+        # Periods are keyed by their start time as uint32
+        for t in (time_from, time_to):
+            if t is not None and (t < 0 or t > 0xFFFFFFFF):
+                raise ValueError('Time out of range')
+        if time_to is None:
+            time_to = int(time.time())
+        if time_from is None:
+            # Default to the last 100 periods
+            time_from = max(0, time_to - 100 * (3600 if r == b'h' else 86400 if r == b'd' else 31 * 86400))
+        prefix = bytes([DBT_POOL_PERIOD_METRICS]) + r
+
+        db = self.openDB()
+        period_metrics = []
+        it = db.iterator(start=prefix + struct.pack('>I', periodStart(r, time_from)),
+                         stop=prefix + struct.pack('>I', time_to), include_stop=True)
+        for k, v in it:
+            data = unpackPeriodMetrics(v)
+            period_metrics.append([struct.unpack('>I', k[2:6])[0], data[0], 0 if data[0] == 0 else data[1] // data[0], data[2], data[3]])
+            if len(period_metrics) >= MAX_METRICS_PERIODS:
+                break
+        it.close()
+        db.close()
+
+        return period_metrics
+
+    def readHistory(self, db, prefix, seek_key, limit):
+        # Newest first, from below seek_key
+        records = []
+        stop = bytes([prefix + 1]) if seek_key is None else bytes([prefix]) + seek_key
+        for k, v in db.iterator(start=bytes([prefix]), stop=stop, reverse=True):
+            records.append((k, v))
+            if len(records) >= limit:
+                break
+        return records
+
+    @getDBMutex
+    def getHistoryPage(self, name, cursor=None, height=None, limit=HISTORY_PAGE_SIZE):
+        # cursor: continue after a previous page, height: start from the records at height and below
+        # The cursor is the key of the last record of the previous page without the prefix: height and txid for payouts
+        if name == 'blocks':
+            prefix, unpack_func, key_size = DBT_POOL_BLOCK, unpackFoundBlock, 4
+        elif name == 'payouts':
+            prefix, unpack_func, key_size = DBT_POOL_PAYOUT, unpackPayout, 36
+        else:
+            raise ValueError('Unknown history')
+        limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+
+        seek_key = None
+        if cursor is not None:
+            try:
+                seek_key = bytes.fromhex(cursor)
+            except ValueError:
+                seek_key = None
+            if seek_key is None or len(seek_key) != key_size or seek_key[0] & 0x80:
+                raise ValueError('Invalid cursor')
+        elif height is not None:
+            if height < 0 or height >= 0x7FFFFFFF:
+                raise ValueError('Invalid height')
+            seek_key = struct.pack('>i', height + 1)
+
+        db = self.openDB()
+        records = self.readHistory(db, prefix, seek_key, limit)
+        db.close()
+
+        rv = {name: [unpack_func(k, v) for k, v in records]}
+        rv['next'] = records[-1][0][1:].hex() if len(records) >= limit else None
+        return rv
+
     @getDBMutex
     def getSummary(self, opts=None):
         rv = {}
 
         rv['poolmode'] = self.mode
+        if self.db_upgrading:
+            rv['dbupgrading'] = True
 
         db = self.openDB()
 
@@ -1151,15 +2882,7 @@ class StakePool():
         n = db.get(bytes([DBT_DATA]) + b'last_payment_run')
         rv['lastpaymentrunheight'] = 0 if n is None else struct.unpack('>i', n)[0]
 
-        lastBlocks = []
-        it = db.iterator(prefix=bytes([DBT_POOL_BLOCK]), reverse=True)
-        try:
-            for i in range(5):
-                k, v = next(it)
-                lastBlocks.append((struct.unpack('>i', k[1:])[0], v[:32].hex(), int.from_bytes(v[32:40], 'big'), int.from_bytes(v[40:48], 'big')))
-        except Exception:
-            pass
-        it.close()
+        lastBlocks = [unpackFoundBlock(k, v)[:4] for k, v in self.readHistory(db, DBT_POOL_BLOCK, None, 5)]
 
         pendingPayments = []
         it = db.iterator(prefix=bytes([DBT_POOL_PENDING_PAYOUT]), reverse=True)
@@ -1171,15 +2894,7 @@ class StakePool():
             pass
         it.close()
 
-        lastPayments = []
-        it = db.iterator(prefix=bytes([DBT_POOL_PAYOUT]), reverse=True)
-        try:
-            for i in range(5):
-                k, v = next(it)
-                lastPayments.append((struct.unpack('>i', k[1:5])[0], k[5:38].hex(), int.from_bytes(v[:8], 'big')))
-        except Exception:
-            pass
-        it.close()
+        lastPayments = [unpackPayout(k, v)[:3] for k, v in self.readHistory(db, DBT_POOL_PAYOUT, None, 5)]
         db.close()
 
         rv['lastblocks'] = lastBlocks
@@ -1200,8 +2915,21 @@ class StakePool():
             rv['watchonlytotalbalance'] = 0
             rv['stakedbalance'] = 0
 
+        if self.show_provisional:
+            provisional = self.getProvisional()
+            rv['provisional'] = {
+                'height': max(provisional) if len(provisional) > 0 else rv['poolheight'],
+                'blocks': [(h, v['blockhash'], v['blockreward'], v['poolcointotal']) for h, v in sorted(provisional.items(), reverse=True) if 'blockreward' in v],
+            }
+
         return rv
 
+    def getTelemetry(self):
+        telemetry.chain_height.set(self.chainHeight)
+        telemetry.pool_height.set(self.poolHeight)
+        telemetry.blocks_behind.set(max(0, self.chainHeight - self.poolHeight))
+        return telemetry.render()
+
     def getVersions(self):
         return {'pool': __version__,
                 'core': 'Unknown' if self.core_version is None else str(self.core_version)}
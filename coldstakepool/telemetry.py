@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Counters, gauges and histograms rendered in the prometheus text format for the /metrics page
+
+import time
+import threading
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 75000, 100000)
+
+registry = []
+thread_local = threading.local()
+
+
+def formatLabels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+def formatValue(v):
+    if isinstance(v, float):
+        return repr(v) if v != float('inf') else '+Inf'
+    return str(v)
+
+
+class Metric():
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_str, labels=()):
+        self.name = name
+        self.help_str = help_str
+        self.labels = labels
+        self.values = {}
+        self.mx = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_str), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        with self.mx:
+            for label_values, v in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, formatLabels(self.labels, label_values), formatValue(v)))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.mx:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.mx:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_str, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self.mx:
+            h = self.values.get(label_values)
+            if h is None:
+                h = self.values[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    h[0][i] += 1
+            h[1] += 1
+            h[2] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_str), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        with self.mx:
+            for label_values, h in sorted(self.values.items()):
+                for upper, count in zip(self.buckets, h[0]):
+                    lines.append('{}_bucket{} {}'.format(self.name, formatLabels(self.labels, label_values, 'le="{}"'.format(upper)), count))
+                lines.append('{}_bucket{} {}'.format(self.name, formatLabels(self.labels, label_values, 'le="+Inf"'), h[1]))
+                lines.append('{}_count{} {}'.format(self.name, formatLabels(self.labels, label_values), h[1]))
+                lines.append('{}_sum{} {}'.format(self.name, formatLabels(self.labels, label_values), formatValue(h[2])))
+        return lines
+
+
+class TimedLock():
+    # threading.Lock recording the time spent waiting to acquire it
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        lock_wait.observe(time.perf_counter() - start, self.name)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+rpc_latency = Histogram('stakepool_rpc_seconds', 'Latency of rpc calls to the daemon.', ('method',))
+rpc_errors = Counter('stakepool_rpc_errors_total', 'Failed rpc calls to the daemon.', ('method',))
+block_seconds = Histogram('stakepool_process_block_seconds', 'Time spent processing a block, cpu is thread cpu time outside rpc calls, db is the remaining wall time.', ('part',))
+lock_wait = Histogram('stakepool_lock_wait_seconds', 'Time spent waiting to acquire a lock.', ('lock',))
+http_latency = Histogram('stakepool_http_request_seconds', 'Latency of http requests.', ('route',))
+cache_requests = Counter('stakepool_cache_requests_total', 'Cache lookups.', ('cache', 'result'))
+chain_height = Gauge('stakepool_chain_height', 'Height of the daemon chain when last checked.')
+pool_height = Gauge('stakepool_pool_height', 'Height processed by the pool.')
+payout_tx_bytes = Histogram('stakepool_payout_tx_bytes', 'Size of payout txns, planned by the adaptive packer and actual as reported by the wallet.', ('kind',), buckets=SIZE_BUCKETS)
+blocks_behind = Gauge('stakepool_blocks_behind_tip', 'Blocks between the chain tip and the pool height, including the block buffer.')
+
+
+def recordCache(cache, hit):
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+class RpcTimer():
+    # Times an rpc call, the totals are also added to the current thread for the processBlock breakdown
+    def __init__(self, method):
+        self.method = method
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        rpc_latency.observe(elapsed, self.method)
+        if exc_type is not None:
+            rpc_errors.inc(self.method)
+        thread_local.rpc_time = getattr(thread_local, 'rpc_time', 0.0) + elapsed
+        thread_local.rpc_cpu = getattr(thread_local, 'rpc_cpu', 0.0) + time.thread_time() - self.start_cpu
+
+
+class BlockTimer():
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.start_rpc = getattr(thread_local, 'rpc_time', 0.0)
+        self.start_rpc_cpu = getattr(thread_local, 'rpc_cpu', 0.0)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        rpc = getattr(thread_local, 'rpc_time', 0.0) - self.start_rpc
+        cpu = time.thread_time() - self.start_cpu - (getattr(thread_local, 'rpc_cpu', 0.0) - self.start_rpc_cpu)
+        block_seconds.observe(elapsed, 'total')
+        block_seconds.observe(rpc, 'rpc')
+        block_seconds.observe(max(0.0, cpu), 'cpu')
+        block_seconds.observe(max(0.0, elapsed - rpc - cpu), 'db')
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
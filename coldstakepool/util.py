@@ -4,17 +4,24 @@
 # Distributed under the MIT software license, see the accompanying
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 
+import os
+import sys
 import time
+import queue
 import urllib
+import gzip
 import decimal
 import hashlib
 import traceback
 import threading
+import collections
+from functools import lru_cache
 from xmlrpc.client import (
     Transport,
     Fault,
 )
 from .contrib.segwit_addr import bech32_decode, convertbits, bech32_encode
+from . import telemetry
 
 # Use system-compiled JSON lib if available, fallback to stdlib
 try:
@@ -30,14 +37,100 @@ PRINT_TO_STD = True
 LOG_TIME = True
 COIN = 100000000
 DCOIN = decimal.Decimal(COIN)
+MAX_FAST_AMOUNT = 10000000.0
 mxLog = threading.Lock()
 
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVELS = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'warning': LOG_WARNING, 'error': LOG_ERROR}
+log_level = LOG_DEBUG
+log_thread = None
+
+
+class LogWriter(threading.Thread):
+    # Writes log lines from a queue, stdout and the log file are flushed per batch
+    def __init__(self, flush_interval=0.5, max_queued=100000):
+        threading.Thread.__init__(self, daemon=True)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.flush_interval = flush_interval
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        last_flush = time.time()
+        files = set()
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            idle = item is False
+
+            while item is not False:
+                if item is None:
+                    running = False
+                else:
+                    fp, s, tag, printstd = item
+                    try:
+                        if printstd:
+                            sys.stdout.write(s + '\n')
+                        if fp is not None:
+                            fp.write(tag + s + '\n')
+                            files.add(fp)
+                    except Exception:
+                        traceback.print_exc()
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            if idle or not running or time.time() - last_flush >= self.flush_interval:
+                sys.stdout.flush()
+                for fp in files:
+                    try:
+                        fp.flush()
+                    except Exception:
+                        pass
+                files.clear()
+                last_flush = time.time()
+
+
+def setLogLevel(level):
+    global log_level
+    log_level = LOG_LEVELS[level] if isinstance(level, str) else level
+
+
+def startLogThread(flush_interval=0.5):
+    # Until started logm writes and flushes synchronously
+    global log_thread
+    if log_thread is None:
+        log_thread = LogWriter(flush_interval)
+        log_thread.start()
+
+
+def stopLogThread():
+    global log_thread
+    if log_thread is not None:
+        log_thread.stop()
+        log_thread = None
+
+
+def logm(fp, s, tag='', printstd=PRINT_TO_STD, level=LOG_INFO):
+    if level < log_level:
+        return
+    if log_thread is not None:
+        log_thread.queue.put((fp, s, tag, printstd))
+        return
 
-def logm(fp, s, tag='', printstd=PRINT_TO_STD):
     mxLog.acquire()
     try:
         if printstd:
-            print(s)
+            print(s, flush=True)
 
         if fp is not None:
             fp.write(tag + s + '\n')
@@ -46,8 +139,70 @@ def logm(fp, s, tag='', printstd=PRINT_TO_STD):
         mxLog.release()
 
 
-def logmt(fp, s, printstd=PRINT_TO_STD, log_time=LOG_TIME):
-    logm(fp, (time.strftime('%y-%m-%d_%H-%M-%S', time.localtime()) + '\t' + s) if log_time else s, printstd=printstd)
+def logmt(fp, s, printstd=PRINT_TO_STD, log_time=LOG_TIME, level=LOG_INFO):
+    if level < log_level:
+        return
+    logm(fp, (time.strftime('%y-%m-%d_%H-%M-%S', time.localtime()) + '\t' + s) if log_time else s, printstd=printstd, level=level)
+
+
+class AuditWriter(threading.Thread):
+    # Appends lines to files in dir_path from a bounded queue, files are kept open and flushed in batches
+    def __init__(self, dir_path, max_queued=10000, flush_interval=2.0, max_open_files=64):
+        threading.Thread.__init__(self, daemon=True)
+        self.dir_path = dir_path
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self.files = collections.OrderedDict()
+
+    def write(self, name, line):
+        # Blocks while the queue is full
+        self.queue.put((name, line))
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def getFile(self, name):
+        fp = self.files.pop(name, None)
+        telemetry.recordCache('auditfiles', fp is not None)
+        if fp is None:
+            if len(self.files) >= self.max_open_files:
+                self.files.popitem(last=False)[1].close()
+            fp = open(os.path.join(self.dir_path, name), 'a')
+        self.files[name] = fp
+        return fp
+
+    def run(self):
+        last_flush = time.time()
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+
+            while item is not False:
+                if item is None:
+                    running = False
+                else:
+                    try:
+                        self.getFile(item[0]).write(item[1])
+                    except Exception:
+                        traceback.print_exc()
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            if not running or time.time() - last_flush >= self.flush_interval:
+                for fp in self.files.values():
+                    fp.flush()
+                last_flush = time.time()
+
+        for fp in self.files.values():
+            fp.close()
+        self.files.clear()
 
 
 def makeInt(v):
@@ -74,6 +229,32 @@ def format16(i):
     return rv
 
 
+def fixedToInt(s, places=8):
+    # Parse a fixed point string as written by format8 and format16
+    s = s.strip()
+    sign = -1 if s.startswith('-') else 1
+    whole, _, frac = s.lstrip('-').partition('.')
+    if len(frac) > places:
+        raise ValueError('Too many decimal places')
+    return sign * (int(whole or '0') * 10 ** places + int(frac.ljust(places, '0')))
+
+
+def amountToSats(v):
+    # Exact satoshis from an rpc json amount, format8 string or setting without going through Decimal.
+    if isinstance(v, float) and -MAX_FAST_AMOUNT < v < MAX_FAST_AMOUNT:
+        # The float and product errors stay below half a satoshi in this range
+        return round(v * COIN)
+    if isinstance(v, int):
+        return v * COIN
+    # The shortest repr of a float parsed from the daemon's 8 decimal output is that output
+    s = str(v)
+    try:
+        return fixedToInt(s)
+    except ValueError:
+        # Exponent form or more than 8 places, only tiny or computed floats
+        return int(round(float(s) * COIN))
+
+
 def toBool(s):
     return s.lower() in ["1", "true"]
 
@@ -164,7 +345,9 @@ def bech32Encode(hrp, data):
     return ret
 
 
+@lru_cache(maxsize=65536)
 def decodeAddress(address_str):
+    # Cached, the same staking addresses are decoded for every pool block
     b58_addr = b58decode(address_str)
     if b58_addr is not None:
         return b58_addr[:-4]
@@ -209,16 +392,21 @@ class Jsonrpc():
             self.__transport.close()
 
     def json_request(self, method, params):
+        request_body = {
+            'method': method,
+            'params': params,
+            'id': 2
+        }
+        return self.post(request_body)
+
+    def json_batch_request(self, calls):
+        return self.post([{'method': method, 'params': params, 'id': i} for i, (method, params) in enumerate(calls)])
+
+    def post(self, request_body):
         try:
             connection = self.__transport.make_connection(self.__host)
             headers = self.__transport._extra_headers[:]
 
-            request_body = {
-                'method': method,
-                'params': params,
-                'id': 2
-            }
-
             connection.putrequest("POST", self.__handler)
             headers.append(("Content-Type", "application/json"))
             headers.append(("User-Agent", 'jsonrpc'))
@@ -256,7 +444,8 @@ def callrpc(rpc_port, auth, method, params=[], wallet=None, rpc_host='127.0.0.1'
             url += 'wallet/' + urllib.parse.quote(wallet)
         x = Jsonrpc(url)
 
-        v = x.json_request(method, params)
+        with telemetry.RpcTimer(method):
+            v = x.json_request(method, params)
         x.close()
         r = json.loads(v.decode('utf-8'))
     except Exception as e:
@@ -264,11 +453,43 @@ def callrpc(rpc_port, auth, method, params=[], wallet=None, rpc_host='127.0.0.1'
         raise ValueError('RPC Server Error')
 
     if 'error' in r and r['error'] is not None:
+        telemetry.rpc_errors.inc(method)
         raise ValueError('RPC error ' + str(r['error']))
 
     return r['result']
 
 
+def callrpc_batch(rpc_port, auth, calls, wallet=None, rpc_host='127.0.0.1'):
+    # Sends [(method, params)] as one json-rpc batch request, returns the results in order
+    if len(calls) < 1:
+        return []
+    try:
+        url = 'http://{}@{}:{}/'.format(auth, rpc_host, rpc_port)
+        if wallet is not None:
+            url += 'wallet/' + urllib.parse.quote(wallet)
+        x = Jsonrpc(url)
+
+        with telemetry.RpcTimer('batch'):
+            v = x.json_batch_request(calls)
+        x.close()
+        r = json.loads(v.decode('utf-8'))
+        responses = {response['id']: response for response in r}
+    except Exception as e:
+        traceback.print_exc()
+        raise ValueError('RPC Server Error')
+
+    rv = []
+    for i, (method, params) in enumerate(calls):
+        response = responses.get(i)
+        if response is None:
+            raise ValueError('RPC error no response to batched ' + method)
+        if 'error' in response and response['error'] is not None:
+            telemetry.rpc_errors.inc(method)
+            raise ValueError('RPC error ' + str(response['error']))
+        rv.append(response['result'])
+    return rv
+
+
 def make_rpc_func(rpc_host, rpc_port, rpc_auth):
     rpc_host = rpc_host
     rpc_port = rpc_port
@@ -277,4 +498,66 @@ def make_rpc_func(rpc_host, rpc_port, rpc_auth):
     def rpc_func(method, params=None, wallet=None):
         nonlocal rpc_host, rpc_port, rpc_auth
         return callrpc(rpc_port, rpc_auth, method, params, wallet, rpc_host=rpc_host)
+
+    def batch(calls, wallet=None):
+        return callrpc_batch(rpc_port, rpc_auth, calls, wallet, rpc_host=rpc_host)
+    rpc_func.batch = batch
     return rpc_func
+
+
+def rpcKey(method, params, wallet):
+    return json.dumps([method, params, wallet], default=jsonDecimal, sort_keys=True)
+
+
+class RpcRecorder():
+    # Wraps an rpc_func, appends each call and its result or error to a gzipped json lines file
+    def __init__(self, rpc_func, path):
+        self.rpc_func = rpc_func
+        self.mx = threading.Lock()
+        self.fp = gzip.open(path, 'at')
+
+    def __call__(self, method, params=None, wallet=None):
+        record = {'m': method, 'p': params, 'w': wallet}
+        try:
+            record['r'] = self.rpc_func(method, params, wallet)
+            return record['r']
+        except Exception as e:
+            record['e'] = str(e)
+            raise
+        finally:
+            line = json.dumps(record, default=jsonDecimal, sort_keys=True) + '\n'
+            with self.mx:
+                if self.fp is not None:
+                    self.fp.write(line)
+
+    def close(self):
+        with self.mx:
+            self.fp.close()
+            self.fp = None
+
+
+class RpcReplay():
+    # Serves recorded responses in the order they were recorded per method and params.
+    # Once the responses for a call are used up the last one is repeated.
+    def __init__(self, path):
+        self.mx = threading.Lock()
+        self.responses = {}
+        with gzip.open(path, 'rt') as fp:
+            for line in fp:
+                record = json.loads(line)
+                key = rpcKey(record['m'], record['p'], record['w'])
+                self.responses.setdefault(key, collections.deque()).append(record)
+
+    def __call__(self, method, params=None, wallet=None):
+        key = rpcKey(method, params, wallet)
+        with self.mx:
+            responses = self.responses.get(key)
+            if responses is None:
+                raise ValueError('RPC error No recorded response for ' + key)
+            record = responses.popleft() if len(responses) > 1 else responses[0]
+        if 'e' in record:
+            raise ValueError(record['e'])
+        return record['r']
+
+    def close(self):
+        pass
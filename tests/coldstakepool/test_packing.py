@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_packing.py
+
+import unittest
+
+from coldstakepool.util import COIN, encodeAddress, format8
+from coldstakepool.packing import (
+    INPUT_SIZE,
+    OUTPUT_OVERHEAD,
+    outputSize,
+    inputsNeeded,
+    estimateTxSize,
+    planPayoutTxns,
+)
+
+
+ADDRESS = encodeAddress(bytes([0x76]) + bytes(range(20)))
+ADDRESS_256 = encodeAddress(bytes([0x39]) + bytes(range(32)))
+
+
+def makeOutputs(n, amount=COIN, address=ADDRESS):
+    return [{'address': address, 'amount': format8(amount)} for i in range(n)]
+
+
+class TestPacking(unittest.TestCase):
+    def test_output_size(self):
+        self.assertEqual(outputSize(ADDRESS), OUTPUT_OVERHEAD + 25)
+        self.assertEqual(outputSize(ADDRESS_256), OUTPUT_OVERHEAD + 37)
+
+    def test_inputs_needed(self):
+        totals = [10, 15, 17]
+        self.assertEqual(inputsNeeded(totals, 1), (1, 9))
+        self.assertEqual(inputsNeeded(totals, 10), (1, 0))
+        self.assertEqual(inputsNeeded(totals, 11), (2, 4))
+        self.assertEqual(inputsNeeded(totals, 17), (3, 0))
+        self.assertEqual(inputsNeeded(totals, 18), (0, 0))
+        self.assertEqual(inputsNeeded([], 1), (0, 0))
+
+    def test_without_coins(self):
+        # Each txn is assumed to need one input
+        outputs = makeOutputs(100)
+        per_txn = (1000 - estimateTxSize(1, 0)) // outputSize(ADDRESS)
+        plan = planPayoutTxns(outputs, [], 1000, 0)
+        self.assertEqual([n for n, size in plan], [per_txn] * (100 // per_txn) + [100 % per_txn])
+        self.assertEqual(plan[0][1], estimateTxSize(1, per_txn * outputSize(ADDRESS)))
+        self.assertTrue(all(size <= 1000 for n, size in plan))
+
+        # Mixed output sizes are packed by size, not count
+        outputs = makeOutputs(10, address=ADDRESS_256) + makeOutputs(10)
+        plan = planPayoutTxns(outputs, [], estimateTxSize(1, 5 * outputSize(ADDRESS_256)), 0)
+        self.assertEqual(plan[0][0], 5)
+        self.assertEqual(sum(n for n, size in plan), 20)
+
+        self.assertEqual(planPayoutTxns([], [], 1000, 0), [])
+
+    def test_oversized_output(self):
+        # A txn always takes at least one output
+        plan = planPayoutTxns(makeOutputs(2), [], estimateTxSize(1, 0), 0)
+        self.assertEqual(plan, [(1, estimateTxSize(1, outputSize(ADDRESS)))] * 2)
+
+    def test_inputs(self):
+        # Each 1 PART output needs another 1 PART coin
+        outputs = makeOutputs(10)
+        max_size = 1000
+        n = (max_size - estimateTxSize(0, 0)) // (INPUT_SIZE + outputSize(ADDRESS))
+        plan = planPayoutTxns(outputs, [COIN] * 10, max_size, 0)
+        self.assertEqual(plan, [(n, estimateTxSize(n, n * outputSize(ADDRESS)))] * (10 // n))
+
+        # Larger coins each cover several outputs
+        plan = planPayoutTxns(outputs, [6 * COIN, 6 * COIN], 100000, 0)
+        self.assertEqual(plan, [(10, estimateTxSize(2, 10 * outputSize(ADDRESS)))])
+
+    def test_change_funds_next_txn(self):
+        size = estimateTxSize(1, 5 * outputSize(ADDRESS))
+        plan = planPayoutTxns(makeOutputs(10), [12 * COIN], size, 0)
+        self.assertEqual(plan, [(5, size), (5, size)])
+
+        # The fee is taken from the coins, without enough left for the fee a second input is needed
+        plan = planPayoutTxns(makeOutputs(10), [10 * COIN, 1 * COIN], 100000, 10000)
+        self.assertEqual(plan, [(10, estimateTxSize(2, 10 * outputSize(ADDRESS)))])
+
+    def test_insufficient_coins(self):
+        # The send will fail, the plan uses every coin
+        plan = planPayoutTxns(makeOutputs(3), [COIN], 100000, 0)
+        self.assertEqual(plan, [(3, estimateTxSize(1, 3 * outputSize(ADDRESS)))])
+
+
+if __name__ == '__main__':
+    unittest.main()
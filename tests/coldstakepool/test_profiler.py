@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_profiler.py
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from coldstakepool.profiler import Profiler
+
+
+def waitFor(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_request(self):
+        out_dir = tempfile.mkdtemp(prefix='csp_test_')
+        logged = []
+        profiler = Profiler(out_dir, {'profileseconds': 0.2, 'profileinterval': 0.01}, logged.append)
+        try:
+            profiler.watch()
+
+            # Requests start the sampler from the watcher thread, as from a signal handler
+            profiler.request()
+            waitFor(lambda: len(logged) > 0)
+            self.assertTrue(profiler.isRunning())
+            self.assertTrue(logged[0].startswith('Profiling'))
+
+            profiler.request()
+            waitFor(lambda: len(logged) > 1)
+            self.assertEqual(logged[-1], 'Profiler is already running.')
+
+            profiler.sampler.join()
+            self.assertTrue(os.path.exists(profiler.sampler.out_path))
+            self.assertGreater(profiler.sampler.num_samples, 0)
+        finally:
+            profiler.stop()
+            shutil.rmtree(out_dir)
+        self.assertFalse(profiler.watcher.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Decoding Particl serialized blocks, real blocks are compared with getblock verbosity 2 in test_run.py.
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_rawblock.py
+
+import struct
+import unittest
+
+from coldstakepool.chainparams import chainparams
+from coldstakepool.util import encodeAddress
+from coldstakepool.rawblock import (
+    decodeBlock,
+    scriptToAddress,
+    sha256d,
+    merkleRoot,
+    RawBlocks,
+    RawBlockRpc,
+    ANON_MARKER,
+)
+from benchmarks.fakeparticld import (
+    SyntheticChain,
+    compactSize,
+    varBytes,
+    REWARD_ADDRESS,
+)
+
+
+PARAMS = chainparams['testnet']
+HASH20 = bytes(range(20))
+HASH32 = bytes(range(32, 64))
+P2PKH = b'\x76\xa9\x14' + HASH20 + b'\x88\xac'
+P2SH = b'\xa9\x14' + HASH20 + b'\x87'
+P2PKH256 = b'\x76\xa8\x20' + HASH32 + b'\x88\xac'
+P2SH256 = b'\xa8\x20' + HASH32 + b'\x87'
+COLDSTAKE = b'\xb8\x63' + P2PKH + b'\x67' + P2PKH256 + b'\x68'  # OP_ISCOINSTAKE OP_IF stake OP_ELSE spend OP_ENDIF
+
+
+def standardOutput(value, script):
+    return bytes([1]) + struct.pack('<q', value) + varBytes(script)
+
+
+def serializeTx(txn_type, inputs, outputs, witness_items=1):
+    # inputs: [(txid, n, anon_items)], returns the txn and its txid
+    data = bytes([0xa0, txn_type]) + struct.pack('<I', 0)
+    data += compactSize(len(inputs))
+    for txid, n, anon_items in inputs:
+        data += bytes.fromhex(txid)[::-1] + struct.pack('<I', n) + varBytes(b'') + struct.pack('<I', 0xffffffff)
+        if n == ANON_MARKER:
+            data += compactSize(len(anon_items)) + b''.join(varBytes(item) for item in anon_items)
+    data += compactSize(len(outputs)) + b''.join(outputs)
+    txid = sha256d(data)
+    for i in range(len(inputs)):
+        data += compactSize(witness_items) + varBytes(b'\x01' * 72) * witness_items
+    return data, txid[::-1].hex()
+
+
+def serializeBlock(prevhash, blocktime, txns, merkle_root=None):
+    txids = [bytes.fromhex(txid)[::-1] for tx, txid in txns]
+    root = merkleRoot(txids) if merkle_root is None else merkle_root
+    header = struct.pack('<i', 0xa0000000 - 2 ** 32) + bytes.fromhex(prevhash)[::-1] + root + bytes(32) + struct.pack('<III', blocktime, 0x1f00ffff, 0)
+    return header + compactSize(len(txns)) + b''.join(tx for tx, txid in txns) + varBytes(b'\x30' * 70), sha256d(header)[::-1].hex()
+
+
+def makeBlock(height, prevhash='00' * 32, merkle_root=None):
+    coinstake = serializeTx(2, [('11' * 32, 1, None)], [
+        bytes([4]) + varBytes(struct.pack('<i', height) + b'\x05'),
+        standardOutput(150000000, COLDSTAKE),
+        standardOutput(2000000, P2PKH),
+    ])
+    standard = serializeTx(0, [('22' * 32, 0, None), ('33' * 32, 2, None)], [
+        standardOutput(100000000, P2PKH),
+        standardOutput(123456789, P2SH),
+        standardOutput(1, P2PKH256),
+        standardOutput(2100000000000000, P2SH256),
+        bytes([4]) + varBytes(b'\x01\x02'),
+    ])
+    blind = serializeTx(0, [('44' * 32, 0, None)], [
+        bytes([2]) + b'\x08' * 33 + varBytes(b'\x01' * 9) + varBytes(P2PKH) + varBytes(b'\x07' * 700),
+        standardOutput(5000, P2PKH),
+    ])
+    anon = serializeTx(0, [('00' * 32, ANON_MARKER, [b'\x02' * 10, b'\x03' * 33])], [
+        bytes([3]) + b'\x09' * 66 + varBytes(b'\x01' * 9) + varBytes(b'\x07' * 300),
+    ], witness_items=2)
+    txns = [coinstake, standard, blind, anon]
+    data, blockhash = serializeBlock(prevhash, 1600000000 + height * 120, txns, merkle_root)
+    return data, blockhash, [txid for tx, txid in txns]
+
+
+class TestDecode(unittest.TestCase):
+    def test_script_to_address(self):
+        self.assertEqual(scriptToAddress(P2PKH, 'testnet'), encodeAddress(bytes([PARAMS['pubkey_address']]) + HASH20))
+        self.assertEqual(scriptToAddress(P2SH, 'testnet'), encodeAddress(bytes([PARAMS['script_address']]) + HASH20))
+        self.assertEqual(scriptToAddress(P2PKH256, 'testnet'), encodeAddress(bytes([PARAMS['pubkey_address_256']]) + HASH32))
+        self.assertEqual(scriptToAddress(P2SH256, 'testnet'), encodeAddress(bytes([PARAMS['script_address_256']]) + HASH32))
+        mainnet = chainparams['mainnet']
+        self.assertEqual(scriptToAddress(P2PKH, 'mainnet'), encodeAddress(bytes([mainnet['pubkey_address']]) + HASH20))
+        self.assertIsNone(scriptToAddress(COLDSTAKE, 'testnet'))
+        self.assertIsNone(scriptToAddress(P2PKH[:-1], 'testnet'))
+        self.assertIsNone(scriptToAddress(b'', 'testnet'))
+
+    def test_decode_block(self):
+        data, blockhash, txids = makeBlock(1234, '55' * 32)
+        block = decodeBlock(data, 'testnet')
+        self.assertEqual(block['hash'], blockhash)
+        self.assertEqual(block['prevhash'], '55' * 32)
+        self.assertEqual(block['time'], 1600000000 + 1234 * 120)
+        self.assertEqual(block['height'], 1234)
+        self.assertEqual([tx['txid'] for tx in block['tx']], txids)
+        for tx in block['tx']:
+            self.assertEqual(tx['blockhash'], blockhash)
+            self.assertEqual(tx['blocktime'], block['time'])
+
+        coinstake, standard, blind, anon = block['tx']
+        self.assertEqual(coinstake['type'], 2)
+        self.assertEqual(coinstake['vin'], [{'txid': '11' * 32, 'vout': 1}])
+        self.assertEqual([out['type'] for out in coinstake['vout']], ['data', 'standard', 'standard'])
+        self.assertEqual(coinstake['vout'][1]['value'], 1.5)
+        self.assertNotIn('addresses', coinstake['vout'][1]['scriptPubKey'])
+        self.assertEqual(coinstake['vout'][1]['scriptPubKey']['hex'], COLDSTAKE.hex())
+        self.assertFalse(coinstake['local'])
+
+        self.assertTrue(standard['local'])
+        self.assertEqual(standard['vin'], [{'txid': '22' * 32, 'vout': 0}, {'txid': '33' * 32, 'vout': 2}])
+        self.assertEqual([out['n'] for out in standard['vout']], [0, 1, 2, 3, 4])
+        self.assertEqual([out.get('value') for out in standard['vout']], [1.0, 1.23456789, 1e-08, 21000000.0, None])
+        self.assertEqual([out['scriptPubKey']['addresses'][0] for out in standard['vout'][:4]],
+                         [scriptToAddress(script, 'testnet') for script in (P2PKH, P2SH, P2PKH256, P2SH256)])
+        self.assertEqual(standard['vout'][4], {'n': 4, 'type': 'data', 'data_hex': '0102'})
+
+        self.assertFalse(blind['local'])
+        self.assertEqual([out['type'] for out in blind['vout']], ['blind', 'standard'])
+        self.assertEqual(blind['vout'][1]['value'], 0.00005)
+
+        self.assertFalse(anon['local'])
+        self.assertEqual(anon['vin'][0]['vout'], ANON_MARKER)
+        self.assertEqual([out['type'] for out in anon['vout']], ['anon'])
+
+    def test_merkle_mismatch(self):
+        data, blockhash, txids = makeBlock(10, merkle_root=bytes(32))
+        with self.assertRaisesRegex(ValueError, 'merkle root'):
+            decodeBlock(data, 'testnet')
+
+        # Bytes changed inside a txn change its txid
+        data, blockhash, txids = makeBlock(10)
+        o = data.index(struct.pack('<q', 123456789))
+        with self.assertRaisesRegex(ValueError, 'merkle root'):
+            decodeBlock(data[:o] + struct.pack('<q', 123456788) + data[o + 8:], 'testnet')
+
+    def test_truncated(self):
+        data, blockhash, txids = makeBlock(10)
+        with self.assertRaises(Exception):
+            decodeBlock(data[:100], 'testnet')
+        with self.assertRaises(Exception):
+            decodeBlock(data[:len(data) // 2], 'testnet')
+
+    def test_no_coinstake(self):
+        tx = serializeTx(0, [('22' * 32, 0, None)], [standardOutput(1, P2PKH)])
+        data, blockhash = serializeBlock('00' * 32, 1600000000, [tx])
+        self.assertIsNone(decodeBlock(data, 'testnet')['height'])
+        with self.assertRaises(ValueError):
+            RawBlocks('testnet', 10).add(data)
+
+
+class TestRawBlocks(unittest.TestCase):
+    def setUp(self):
+        self.chain = SyntheticChain(30, 5, 2, raw_blocks=True)
+
+    def test_add(self):
+        raw_blocks = RawBlocks('testnet', 10)
+        for h in range(5, 21):
+            self.assertEqual(raw_blocks.add(self.chain.rawBlock(h)['data']), h)
+        self.assertEqual(sorted(raw_blocks.blocks.keys()), list(range(11, 21)))
+        self.assertEqual(raw_blocks.getBlockHash(20), self.chain.getBlockHash(20))
+        self.assertIsNone(raw_blocks.getBlockHash(10))
+
+        # A block not linking to the previous one drops the chain, a reorg replaces the blocks above
+        data, blockhash, txids = makeBlock(21)
+        raw_blocks.add(data)
+        self.assertEqual(list(raw_blocks.blocks.keys()), [21])
+        for h in range(12, 16):
+            raw_blocks.add(self.chain.rawBlock(h)['data'])
+        raw_blocks.add(self.chain.rawBlock(13)['data'])
+        self.assertEqual(sorted(raw_blocks.blocks.keys()), [12, 13])
+        self.assertEqual(raw_blocks.getTxHeight(self.chain.rawBlock(13)['coinstake']), 13)
+        self.assertIsNone(raw_blocks.getTxHeight(self.chain.rawBlock(14)['coinstake']))
+
+        raw_blocks.prune(13)
+        self.assertEqual(list(raw_blocks.blocks.keys()), [13])
+        self.assertIsNone(raw_blocks.getTxHeight(self.chain.rawBlock(12)['coinstake']))
+
+    def test_block_reward(self):
+        raw_blocks = RawBlocks('testnet', 10)
+        for h in (11, 12):
+            raw_blocks.add(self.chain.rawBlock(h)['data'])
+
+        # Blocks paying the reward address go to the daemon
+        self.assertIsNone(raw_blocks.getBlockReward(12, REWARD_ADDRESS))
+        expect = self.chain.getblockreward(11)
+        self.assertEqual(raw_blocks.getBlockReward(11, REWARD_ADDRESS), {
+            'blockhash': expect['blockhash'], 'blocktime': expect['blocktime'], 'coinstake': expect['coinstake'], 'outputs': []})
+        self.assertIsNone(raw_blocks.getBlockReward(13, REWARD_ADDRESS))
+
+    def test_get_tx(self):
+        raw_blocks = RawBlocks('testnet', 10)
+        data, blockhash, txids = makeBlock(10)
+        raw_blocks.add(data)
+        tx = raw_blocks.getTx(txids[1])
+        self.assertEqual(tx['txid'], txids[1])
+        self.assertEqual(tx['blockhash'], blockhash)
+        self.assertNotIn('local', tx)
+        self.assertNotIn('scripts', tx)
+        for txid in (txids[0], txids[2], txids[3], '66' * 32):
+            self.assertIsNone(raw_blocks.getTx(txid))
+
+
+class CountingRpc():
+    def __init__(self, chain):
+        self.chain = chain
+        self.calls = []
+
+    def __call__(self, method, params=None, wallet=None):
+        self.calls.append(method)
+        return self.chain.handle(method, params, wallet)
+
+
+class TestRawBlockRpc(unittest.TestCase):
+    def setUp(self):
+        self.chain = SyntheticChain(30, 5, 2, raw_blocks=True)
+        self.raw_blocks = RawBlocks('testnet', 20)
+        for h in range(10, 21):
+            self.raw_blocks.add(self.chain.rawBlock(h)['data'])
+        self.rpc = CountingRpc(self.chain)
+        self.logged = []
+
+    def log(self, message, level=None):
+        self.logged.append(message)
+
+    def test_verify(self):
+        rpc_func = RawBlockRpc(self.rpc, self.raw_blocks, REWARD_ADDRESS, 3, self.log)
+        for h in range(10, 20):
+            self.assertEqual(rpc_func('getblockhash', [h]), self.chain.getBlockHash(h))
+        self.assertEqual(rpc_func('getblockreward', [11])['coinstake'], self.chain.getblockreward(11)['coinstake'])
+
+        # The first and every third answer is checked, blocks paying the pool and unknown heights go to the daemon
+        self.assertEqual(self.rpc.calls, ['getblockhash'] * 4)
+        self.assertEqual(rpc_func('getblockreward', [12])['outputs'][0]['script']['spendaddr'], REWARD_ADDRESS)
+        self.assertEqual(rpc_func('getblockhash', [25]), self.chain.getBlockHash(25))
+        self.assertEqual(self.rpc.calls[-2:], ['getblockreward', 'getblockhash'])
+        self.assertTrue(rpc_func.enabled)
+        self.assertEqual(self.logged, [])
+
+    def test_mismatch(self):
+        rpc_func = RawBlockRpc(self.rpc, self.raw_blocks, REWARD_ADDRESS, 1, self.log)
+        self.raw_blocks.blocks[15]['time'] += 1
+        self.assertEqual(rpc_func('getblockreward', [13]), rpc_func.raw_blocks.getBlockReward(13, REWARD_ADDRESS))
+        self.assertEqual(rpc_func('getblockreward', [15]), self.chain.getblockreward(15))
+        self.assertFalse(rpc_func.enabled)
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn('blocktime', self.logged[0])
+
+        # Everything goes to the daemon once disabled
+        num_calls = len(self.rpc.calls)
+        rpc_func('getblockhash', [10])
+        self.assertEqual(len(self.rpc.calls), num_calls + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
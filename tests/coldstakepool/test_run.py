@@ -21,6 +21,7 @@ import multiprocessing
 from unittest.mock import patch
 
 from coldstakepool.util import callrpc, COIN
+from coldstakepool.rawblock import decodeBlock, compareResult
 from coldstakepool.contrib.rpcauth import generate_salt, password_to_hmac
 
 import bin.coldstakepool_prepare as prepareSystem
@@ -467,6 +468,19 @@ class Test(unittest.TestCase):
         logging.info('total_pool_users + pool_reward: %d', total_pool)
         assert (abs(accum_block_rewards - total_pool) < 10)
 
+        # Decode the staked blocks from their serialization, coinstakes, cold stake and payout outputs match getblock verbosity 2
+        for i in range(2, stake_blocks + 1):
+            blockhash = callrpc(pool_rpc_port, pool_rpc_auth, 'getblockhash', [i])
+            block = decodeBlock(bytes.fromhex(callrpc(pool_rpc_port, pool_rpc_auth, 'getblock', [blockhash, 0])), 'regtest')
+            expect = callrpc(pool_rpc_port, pool_rpc_auth, 'getblock', [blockhash, 2])
+            assert (block['hash'] == blockhash)
+            assert (block['height'] == i)
+            assert (block['time'] == expect['time'])
+            assert (len(block['tx']) == len(expect['tx']))
+            for tx, expect_tx in zip(block['tx'], expect['tx']):
+                mismatch = compareResult('getrawtransaction', tx, expect_tx, None)
+                assert mismatch is None, mismatch
+
         changeaddress = {'coldstakingaddress': addr_pool_stake, 'address_standard': ms_addr['address']}
         callnoderpc(0, 'walletsettings', ['changeaddress', changeaddress], wallet='MS Wallet')
 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_snapshot.py
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from coldstakepool.snapshot import SnapshotWriter, readSnapshot
+
+
+BLOCKHASH = bytes(range(32)).hex()
+RECORDS = [
+    (b'd' + b'current_height', bytes(4)),
+    (b'b' + bytes(21), bytes(range(40))),
+    (b'e', b''),
+    (b'U' + bytes(4), bytes(100000)),
+]
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='csp_test_')
+        self.path = os.path.join(self.data_dir, 'snapshot.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def writeSnapshot(self, records=RECORDS):
+        writer = SnapshotWriter(self.path, 'testnet', 1234, BLOCKHASH, 5)
+        for k, v in records:
+            writer.add(k, v)
+        writer.close()
+        self.assertEqual(writer.num_records, len(records))
+
+    def rewrite(self, edit):
+        with gzip.open(self.path, 'rb') as fp:
+            data = fp.read()
+        with gzip.open(self.path, 'wb') as fp:
+            fp.write(edit(data))
+
+    def test_round_trip(self):
+        self.writeSnapshot()
+        header, records = readSnapshot(self.path)
+        self.assertEqual(header, {'chain': 'testnet', 'height': 1234, 'blockhash': BLOCKHASH, 'db_version': 5})
+        self.assertEqual(records, RECORDS)
+
+        self.writeSnapshot([])
+        self.assertEqual(readSnapshot(self.path)[1], [])
+
+    def test_corrupt(self):
+        self.writeSnapshot()
+        # A byte of the last record's value
+        self.rewrite(lambda data: data[:-1000] + b'\x01' + data[-999:])
+        with self.assertRaises(ValueError) as cm:
+            readSnapshot(self.path)
+        self.assertEqual(str(cm.exception), 'Snapshot checksum mismatch')
+
+    def test_truncated(self):
+        self.writeSnapshot()
+        self.rewrite(lambda data: data[:-100])
+        with self.assertRaises(ValueError) as cm:
+            readSnapshot(self.path)
+        self.assertEqual(str(cm.exception), 'Truncated snapshot')
+
+        # Missing the checksum
+        self.writeSnapshot()
+        self.rewrite(lambda data: data[:-32])
+        with self.assertRaises(ValueError) as cm:
+            readSnapshot(self.path)
+        self.assertEqual(str(cm.exception), 'Snapshot checksum mismatch')
+
+    def test_unknown_format(self):
+        self.writeSnapshot()
+        self.rewrite(lambda data: b'X' + data[1:])
+        with self.assertRaises(ValueError) as cm:
+            readSnapshot(self.path)
+        self.assertEqual(str(cm.exception), 'Unknown snapshot format')
+
+
+if __name__ == '__main__':
+    unittest.main()
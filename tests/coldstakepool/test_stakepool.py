@@ -0,0 +1,1533 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# Pool logic against the in process synthetic chain from benchmarks/fakeparticld.py, no particld needed.
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_stakepool.py
+
+import json
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+import coldstakepool.stakepool as sp
+from coldstakepool.http_server import HttpThread
+from coldstakepool.profiler import Profiler
+from coldstakepool.snapshot import SnapshotWriter, readSnapshot
+from coldstakepool.util import encodeAddress, fixedToInt, format8, RpcRecorder, RpcReplay
+from coldstakepool.rawblock import RawBlockRpc
+from benchmarks.fakeparticld import (
+    FakeParticld,
+    SyntheticChain,
+    makeHash,
+    POOL_ADDRESS,
+    REWARD_ADDRESS,
+)
+
+
+BLOCK_BUFFER = 100
+
+
+def poolSettings(**kwargs):
+    settings = {
+        'mode': 'master',
+        'debug': False,
+        'particlbindir': '',
+        'particldatadir': '',
+        'startheight': 0,
+        'pooladdress': POOL_ADDRESS,
+        'rewardaddress': REWARD_ADDRESS,
+        'rpcauth': 'test:test',
+        'zmqhost': 'tcp://127.0.0.1',
+        'zmqport': 20792,
+        'parameters': [{'height': 0, 'payoutthreshold': 0.01, 'minblocksbetweenpayments': 10}],
+        'poolownerwithdrawal': {'frequency': 1000000, 'address': REWARD_ADDRESS, 'reserve': 1.0, 'threshold': 1.0},
+    }
+    settings.update(kwargs)
+    return settings
+
+
+class ChainRpc():
+    # rpc_func serving the synthetic chain in process, counts calls per method
+    def __init__(self, chain):
+        self.chain = chain
+        self.calls = {}
+
+    def __call__(self, method, params=None, wallet=None):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        return self.chain.handle(method, params, wallet)
+
+
+class BatchChainRpc(ChainRpc):
+    # As ChainRpc with json-rpc batch support, records the size of each batch
+    def __init__(self, chain):
+        super().__init__(chain)
+        self.batches = []
+
+    def batch(self, calls, wallet=None):
+        self.batches.append(len(calls))
+        return [self.chain.handle(method, params, wallet) for method, params in calls]
+
+
+class ReorgRpc(ChainRpc):
+    # The blocks above fork_height are replaced by blocks the pool didn't find
+    def __init__(self, chain, fork_height):
+        super().__init__(chain)
+        self.fork_height = fork_height
+
+    def reorgHash(self, height):
+        return '%08x' % (height) + makeHash('reorg%d' % (height))[8:]
+
+    def __call__(self, method, params=None, wallet=None):
+        if method == 'getblockhash' and params[0] > self.fork_height:
+            super().__call__(method, params, wallet)
+            return self.reorgHash(params[0])
+        rv = super().__call__(method, params, wallet)
+        if method == 'getblockreward' and params[0] > self.fork_height:
+            rv = dict(rv, blockhash=self.reorgHash(params[0]), coinstake=makeHash('reorgcoinstake%d' % (params[0])),
+                      outputs=[{'script': {'spendaddr': self.chain.other_address}, 'value': rv['blockreward']}])
+        return rv
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='csp_test_')
+        self.db_path = os.path.join(self.data_dir, 'stakepooldb')
+        self.chain = SyntheticChain(BLOCK_BUFFER, 20, 2)
+        self.pools = []
+
+    def tearDown(self):
+        for pool in list(self.pools):
+            self.stopPool(pool)
+        shutil.rmtree(self.data_dir)
+
+    def makePool(self, rpc=None, data_dir=None, **kwargs):
+        pool = sp.StakePool(None, self.data_dir if data_dir is None else data_dir, poolSettings(**kwargs), 'testnet')
+        pool.rpc_func = ChainRpc(self.chain) if rpc is None else rpc
+        self.pools.append(pool)
+        return pool
+
+    def stopPool(self, pool):
+        if pool not in self.pools:
+            return
+        self.pools.remove(pool)
+        pool.stopRunning()
+        if pool.migration_thread is not None:
+            pool.migration_thread.join()
+        pool.shutdown()
+        pool.zmqSubscriber.close()
+        pool.zmqContext.term()
+
+    def startPool(self, pool):
+        pool.start()
+        if pool.migration_thread is not None:
+            pool.migration_thread.join()
+
+    def mine(self, pool, num_blocks):
+        # Mine blocks and process them as the run loop would at each new block
+        for i in range(num_blocks):
+            self.chain.mine()
+            pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+
+    def readDB(self, prefix=None, db_path=None):
+        with sp.mxDB:
+            db = sp.plyvel.DB(self.db_path if db_path is None else db_path)
+            try:
+                if prefix is None:
+                    return dict(db.iterator())
+                return dict(db.iterator(prefix=bytes([prefix])))
+            finally:
+                db.close()
+
+    def writeDB(self, puts, deletes=()):
+        with sp.mxDB:
+            db = sp.plyvel.DB(self.db_path)
+            try:
+                with db.write_batch(transaction=True) as b:
+                    for k, v in puts.items():
+                        b.put(k, v)
+                    for k in deletes:
+                        b.delete(k)
+            finally:
+                db.close()
+
+    def startHttp(self, pool):
+        # Serves pool on a free port until the test ends, returns the base url
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        http_thread = HttpThread(None, '127.0.0.1', port, False, pool)
+        http_thread.start()
+
+        def stopHttp():
+            http_thread.stop()
+            http_thread.join()
+        self.addCleanup(stopHttp)
+        return 'http://127.0.0.1:%d' % (port)
+
+    def expectHttpError(self, url, code=400):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url)
+        self.assertEqual(cm.exception.code, code)
+        return cm.exception.read()
+
+    def expectedPendingIndex(self):
+        # Addresses with a pending payout from the balance records
+        rv = {}
+        for k, v in self.readDB(sp.DBT_BAL).items():
+            pending = int.from_bytes(v[16:24], 'big')
+            if pending > 0:
+                rv[bytes([sp.DBT_PENDING_INDEX]) + k[1:]] = pending
+        return rv
+
+    def checkPendingIndex(self):
+        expect = self.expectedPendingIndex()
+        index = {k: int.from_bytes(v, 'big') for k, v in self.readDB(sp.DBT_PENDING_INDEX).items()}
+        self.assertEqual(index, expect)
+        n = self.readDB(sp.DBT_DATA).get(bytes([sp.DBT_DATA]) + b'pending_index')
+        self.assertEqual(int.from_bytes(n[:4], 'big'), len(expect))
+        self.assertEqual(int.from_bytes(n[4:12], 'big'), sum(expect.values()))
+        return expect
+
+
+class TestMigrations(PoolTestCase):
+    def makeOldDB(self, db_version):
+        # A synced pool db as written before the migrations above db_version
+        pool = self.makePool()
+        self.startPool(pool)
+        self.mine(pool, 60)
+        self.stopPool(pool)
+
+        puts = {bytes([sp.DBT_DATA]) + b'db_version': struct.pack('>i', db_version)}
+        deletes = list(self.readDB(sp.DBT_PENDING_INDEX).keys()) + [bytes([sp.DBT_DATA]) + b'pending_index']
+        if db_version < 2:
+            for k, v in self.readDB(sp.DBT_POOL_BLOCK).items():
+                puts[k] = v[:48]
+            for k, v in self.readDB(sp.DBT_POOL_PAYOUT).items():
+                puts[k] = v[:8]
+        self.writeDB(puts, deletes)
+        return pool
+
+    def test_startup_waits_for_migrations(self):
+        self.makeOldDB(1)
+        self.assertGreater(len(self.expectedPendingIndex()), 0)
+
+        release = threading.Event()
+        locked_calls = []
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method in ('getblockhash', 'getblockheader'):
+                if sp.mxDB.locked():
+                    locked_calls.append(method)
+                release.wait(10)
+            return chain_rpc(method, params, wallet)
+
+        pool = self.makePool(rpc)
+        self.assertEqual(pool.db_version, 1)
+        pool.start()
+        try:
+            # Startup steps reading the db wait for the migrations
+            self.assertTrue(pool.db_upgrading)
+            self.assertFalse(pool.daemon_running)
+        finally:
+            release.set()
+        pool.migration_thread.join()
+
+        self.assertFalse(pool.db_upgrading)
+        self.assertTrue(pool.daemon_running)
+        self.assertEqual(pool.db_version, sp.CURRENT_DB_VERSION)
+        self.assertEqual(locked_calls, [])
+        self.assertGreater(chain_rpc.calls['getblockheader'], 0)
+
+        for k, v in self.readDB(sp.DBT_POOL_BLOCK).items():
+            self.assertEqual(int.from_bytes(v[48:56], 'big'), self.chain.getblockreward(struct.unpack('>i', k[1:5])[0])['blocktime'])
+        for k, v in self.readDB(sp.DBT_POOL_PAYOUT).items():
+            self.assertEqual(len(v), 16)
+        self.checkPendingIndex()
+
+    def test_migration_resumes(self):
+        self.makeOldDB(1)
+        pool = self.makePool(migrationbatchsize=7)
+
+        # Stop after the first few steps
+        calls = {'n': 0}
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'getblockheader':
+                calls['n'] += 1
+                if calls['n'] == 20:
+                    pool.stopRunning()
+            return chain_rpc(method, params, wallet)
+
+        pool.rpc_func = rpc
+        pool.start()
+        pool.migration_thread.join()
+        self.assertTrue(pool.db_upgrading)
+        n = self.readDB(sp.DBT_DATA)[bytes([sp.DBT_DATA]) + b'migration_progress']
+        self.assertEqual(struct.unpack('>i', n[:4])[0], 2)
+        self.stopPool(pool)
+
+        pool = self.makePool(migrationbatchsize=7)
+        self.startPool(pool)
+        self.assertEqual(pool.db_version, sp.CURRENT_DB_VERSION)
+        self.assertNotIn(bytes([sp.DBT_DATA]) + b'migration_progress', self.readDB(sp.DBT_DATA))
+        for k, v in self.readDB(sp.DBT_POOL_BLOCK).items():
+            self.assertEqual(len(v), 56)
+        self.checkPendingIndex()
+
+    def test_lookups_batched(self):
+        self.makeOldDB(1)
+        rpc = BatchChainRpc(self.chain)
+        pool = self.makePool(rpc, migrationbatchsize=25)
+        self.startPool(pool)
+        self.assertEqual(pool.db_version, sp.CURRENT_DB_VERSION)
+
+        # Blocktimes come from batches, not from single calls
+        self.assertNotIn('getblockheader', rpc.calls)
+        self.assertNotIn('getblockhash', rpc.calls)
+        self.assertGreater(len(rpc.batches), 0)
+        self.assertTrue(all(0 < n <= 25 for n in rpc.batches))
+        for k, v in self.readDB(sp.DBT_POOL_BLOCK).items():
+            self.assertEqual(int.from_bytes(v[48:56], 'big'), self.chain.getblockreward(struct.unpack('>i', k[1:5])[0])['blocktime'])
+
+    def test_address_history_payouts(self):
+        pool = self.makePool(addresshistory=True)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        self.stopPool(pool)
+        history = self.readDB(sp.DBT_ADDR_HISTORY)
+        payouts = {k: v for k, v in history.items() if k[2 + k[1] + 4] == sp.HISTORY_PAYOUT}
+        self.assertGreater(len(payouts), 0)
+
+        self.writeDB({bytes([sp.DBT_DATA]) + b'db_version': struct.pack('>i', 3)}, payouts.keys())
+        pool = self.makePool(addresshistory=True, migrationbatchsize=3)
+        self.startPool(pool)
+        self.assertEqual(pool.db_version, sp.CURRENT_DB_VERSION)
+        self.assertEqual(self.readDB(sp.DBT_ADDR_HISTORY), history)
+
+
+class TestRebuildMetrics(PoolTestCase):
+    def readMetrics(self):
+        rv = self.readDB(sp.DBT_POOL_METRICS)
+        rv.update(self.readDB(sp.DBT_POOL_PERIOD_METRICS))
+        n = self.readDB(sp.DBT_DATA).get(bytes([sp.DBT_DATA]) + b'pool_disbursed')
+        rv['pool_disbursed'] = 0 if n is None else int.from_bytes(n, 'big')
+        return rv
+
+    def corruptMetrics(self):
+        puts = {bytes([sp.DBT_DATA]) + b'pool_disbursed': (1).to_bytes(8, 'big')}
+        for k, v in self.readDB(sp.DBT_POOL_METRICS).items():
+            puts[k] = sp.packMonthMetrics([1, 1, 1])
+        for k, v in self.readDB(sp.DBT_POOL_PERIOD_METRICS).items():
+            puts[k] = sp.packPeriodMetrics([1, 1, 1, sp.unpackPeriodMetrics(v)[3]])
+        puts[bytes([sp.DBT_POOL_METRICS]) + b'1999-01'] = sp.packMonthMetrics([1, 1, 1])
+        self.writeDB(puts)
+
+    def rebuild(self, pool):
+        progress = pool.requestRebuildMetrics()
+        self.assertTrue(progress['running'])
+        pool.metrics_thread.join()
+        self.assertNotIn('error', pool.metrics_rebuild)
+        self.assertNotIn(bytes([sp.DBT_DATA]) + b'metrics_rebuild', self.readDB(sp.DBT_DATA))
+        self.assertEqual(self.readDB(sp.DBT_METRICS_REBUILD), {})
+
+    def test_rebuild(self):
+        pool = self.makePool(migrationbatchsize=7)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        expect = self.readMetrics()
+        self.assertGreater(expect['pool_disbursed'], 0)
+
+        self.corruptMetrics()
+        self.rebuild(pool)
+        self.assertEqual(self.readMetrics(), expect)
+        self.assertEqual(pool.metrics_rebuild['processedblocks'], len(self.readDB(sp.DBT_POOL_BLOCK)))
+        self.assertEqual(pool.metrics_rebuild['processedpayments'], len(self.readDB(sp.DBT_POOL_PAYOUT)))
+
+    def test_rebuild_with_blocks(self):
+        # Blocks processed while the rebuild waits on rpc outside the db lock
+        paused = threading.Event()
+        release = threading.Event()
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'getblockhash' and params == [0]:
+                paused.set()
+                release.wait(10)
+            return chain_rpc(method, params, wallet)
+
+        pool = self.makePool(rpc, migrationbatchsize=7)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        self.corruptMetrics()
+
+        step = pool.rebuildMetricsStep
+        num_steps = {'n': 0}
+
+        def pausingStep(boundary, db, b, checkpoint, stats, results):
+            num_steps['n'] += 1
+            if num_steps['n'] == 3:
+                sp.requireResults(results, [('getblockhash', [0])])
+            return step(boundary, db, b, checkpoint, stats, results)
+        pool.rebuildMetricsStep = pausingStep
+
+        pool.requestRebuildMetrics()
+        self.assertTrue(paused.wait(10))
+        self.assertTrue(pool.requestRebuildMetrics()['running'])
+        self.mine(pool, 30)
+        release.set()
+        pool.metrics_thread.join()
+        self.assertNotIn('error', pool.metrics_rebuild)
+        rebuilt = self.readMetrics()
+
+        # Matches a rebuild with no blocks processed meanwhile
+        pool.rebuildMetricsStep = step
+        self.rebuild(pool)
+        self.assertEqual(self.readMetrics(), rebuilt)
+        self.assertNotIn(bytes([sp.DBT_POOL_METRICS]) + b'1999-01', rebuilt)
+
+    def test_rebuild_resumes(self):
+        pool = self.makePool(migrationbatchsize=7)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        expect = self.readMetrics()
+        self.corruptMetrics()
+
+        step = pool.rebuildMetricsStep
+        num_steps = {'n': 0}
+
+        def stoppingStep(boundary, db, b, checkpoint, stats, results):
+            num_steps['n'] += 1
+            if num_steps['n'] == 4:
+                pool.stopRunning()
+            return step(boundary, db, b, checkpoint, stats, results)
+        pool.rebuildMetricsStep = stoppingStep
+        pool.requestRebuildMetrics()
+        pool.metrics_thread.join()
+        self.assertIn('error', pool.metrics_rebuild)
+        self.assertIn(bytes([sp.DBT_DATA]) + b'metrics_rebuild', self.readDB(sp.DBT_DATA))
+        self.stopPool(pool)
+
+        pool = self.makePool(migrationbatchsize=7)
+        self.startPool(pool)
+        pool.metrics_thread.join()
+        self.assertNotIn(bytes([sp.DBT_DATA]) + b'metrics_rebuild', self.readDB(sp.DBT_DATA))
+        self.assertEqual(self.readMetrics(), expect)
+
+
+class TestAuditLog(PoolTestCase):
+    def test_csv_files(self):
+        pool = self.makePool(debug=True, addresscsv=True)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        self.stopPool(pool)
+
+        debug_dir = os.path.join(self.data_dir, 'poolDebug')
+        with open(os.path.join(debug_dir, 'pool.csv')) as fp:
+            lines = [line.split(',') for line in fp.read().splitlines()]
+        self.assertEqual(lines[0][0], 'height')
+        block_heights = [struct.unpack('>i', k[1:])[0] for k in sorted(self.readDB(sp.DBT_POOL_BLOCK))]
+        self.assertEqual([int(r[0]) for r in lines[1:] if len(r) == 6], block_heights)
+        runs = [r for r in lines[1:] if len(r) == 9]
+        self.assertGreater(len(runs), 0)
+
+        # Each payout line in the address files is part of a payment run
+        paid = 0
+        for address in (encodeAddress(k[1:]) for k in self.readDB(sp.DBT_BAL)):
+            with open(os.path.join(debug_dir, address + '.csv')) as fp:
+                rows = [line.split(',') for line in fp.read().splitlines()]
+            self.assertTrue(all(int(r[0]) in block_heights for r in rows if len(r) == 6))
+            paid += sum(fixedToInt(r[6]) for r in rows if len(r) == 8)
+        self.assertEqual(paid, sum(fixedToInt(r[5]) for r in runs))
+
+
+def parseMetrics(text):
+    # sample name with labels: value, checks each metric has its help and type lines
+    samples = {}
+    typed = set()
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            typed.add(line.split(' ')[2])
+            continue
+        if line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        base = name.split('{')[0]
+        assert any(base == t or base in (t + '_bucket', t + '_count', t + '_sum') for t in typed), line
+        samples[name] = float(value.replace('+Inf', 'inf'))
+    return samples
+
+
+class TestTelemetry(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = self.makePool()
+        self.startPool(self.pool)
+        self.url = self.startHttp(self.pool) + '/metrics'
+
+    def scrape(self):
+        with urllib.request.urlopen(self.url) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.headers['Content-type'], 'text/plain; version=0.0.4')
+            return parseMetrics(response.read().decode('utf-8'))
+
+    def test_scrape(self):
+        before = self.scrape()
+        self.mine(self.pool, 30)
+        after = self.scrape()
+        self.assertEqual(after['stakepool_pool_height'], self.pool.poolHeight)
+        total = 'stakepool_process_block_seconds_count{part="total"}'
+        self.assertEqual(after[total] - before.get(total, 0), 30)
+        db_lock = 'stakepool_lock_wait_seconds_count{lock="db"}'
+        self.assertGreaterEqual(after[db_lock] - before.get(db_lock, 0), 30)
+        self.assertGreaterEqual(after['stakepool_http_request_seconds_count{route="metrics"}'], 1)
+
+        # Bucket counts are cumulative and end with the total
+        buckets = [v for k, v in after.items() if k.startswith('stakepool_process_block_seconds_bucket{part="total"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], after[total])
+
+    def test_lock_contention(self):
+        # Time spent waiting for a held lock is added to the lock_wait histogram of that lock
+        for lock, name in ((sp.mxDB, 'db'), (sp.mxSend, 'send')):
+            before = self.scrape()
+            held = threading.Event()
+
+            def holdLock():
+                with lock:
+                    held.set()
+                    time.sleep(0.3)
+            t = threading.Thread(target=holdLock)
+            t.start()
+            held.wait()
+            with lock:
+                pass
+            t.join()
+            after = self.scrape()
+
+            def delta(sample, extra=''):
+                key = 'stakepool_lock_wait_seconds_%s{lock="%s"%s}' % (sample, name, extra)
+                return after[key] - before.get(key, 0)
+            self.assertEqual(delta('count'), 2)
+            self.assertGreaterEqual(delta('sum'), 0.2)
+            self.assertEqual(delta('bucket', ',le="0.1"'), 1)
+            self.assertEqual(delta('bucket', ',le="0.5"'), 2)
+
+
+class TestPeriodMetrics(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = self.makePool()
+        self.startPool(self.pool)
+        self.mine(self.pool, 130)
+
+    def expectedPeriods(self, r):
+        rv = []
+        for k, v in sorted(self.readDB(sp.DBT_POOL_PERIOD_METRICS).items()):
+            if k[1:2] == r:
+                data = sp.unpackPeriodMetrics(v)
+                rv.append([struct.unpack('>I', k[2:6])[0], data[0], 0 if data[0] == 0 else data[1] // data[0], data[2], data[3]])
+        return rv
+
+    def test_periods(self):
+        hours = self.expectedPeriods(b'h')
+        self.assertGreater(len(hours), 3)
+        self.assertEqual(self.pool.getPeriodMetrics('hour', 0, 0xFFFFFFFF), hours)
+        self.assertEqual(self.pool.getPeriodMetrics('day', 0, 0xFFFFFFFF), self.expectedPeriods(b'd'))
+        self.assertEqual(self.pool.getPeriodMetrics('month', 0, 0xFFFFFFFF), self.expectedPeriods(b'm'))
+
+        # from is rounded down to the start of its period, the period starting at to is included
+        self.assertEqual(self.pool.getPeriodMetrics('hour', hours[1][0] + 1, hours[2][0]), hours[1:3])
+        self.assertEqual(self.pool.getPeriodMetrics('hour', hours[1][0], hours[2][0] - 1), hours[1:2])
+        self.assertEqual(self.pool.getPeriodMetrics('hour', hours[2][0], hours[1][0]), [])
+        self.assertEqual(self.pool.getPeriodMetrics('hour', None, hours[-1][0]), hours)
+        self.assertEqual(self.pool.getPeriodMetrics('hour', None, 100), [])
+
+    def test_invalid(self):
+        for args in (('week', ), ('hour', -1), ('hour', 0, -1), ('hour', 0x100000000), ('hour', 0, 0x100000000)):
+            with self.assertRaises(ValueError):
+                self.pool.getPeriodMetrics(*args)
+
+    def test_route(self):
+        url = self.startHttp(self.pool) + '/json/metrics'
+        with urllib.request.urlopen(url + '?res=hour&from=0&to=%d' % (0xFFFFFFFF)) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(response.read()), self.expectedPeriods(b'h'))
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(json.loads(response.read()), self.pool.getMetrics())
+
+        for query in ('?res=week', '?res=hour&from=x', '?res=hour&to=1.5', '?from=-1', '?to=%d' % (0x100000000)):
+            self.assertIn('error', json.loads(self.expectHttpError(url + query)))
+
+
+class TestChangeStream(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+        self.http_thread = None
+
+    def tearDown(self):
+        if self.http_thread is not None:
+            self.http_thread.stop()
+            self.http_thread.join()
+        super().tearDown()
+
+    def makeObserver(self, **kwargs):
+        observer_dir = os.path.join(self.data_dir, 'observer')
+        os.makedirs(observer_dir)
+        observer = self.makePool(data_dir=observer_dir, mode='observer', changestreamurl='http://127.0.0.1:%d' % (self.port), **kwargs)
+        self.startPool(observer)
+
+        fetched = []
+        fetchChanges = observer.fetchChanges
+
+        def countingFetch(height):
+            fetched.append(height)
+            return fetchChanges(height)
+        observer.fetchChanges = countingFetch
+        return observer, fetched
+
+    def test_retained_range(self):
+        upstream = self.makePool(changestreamblocks=20)
+        self.startPool(upstream)
+        self.mine(upstream, 60)
+        self.http_thread = HttpThread(None, '127.0.0.1', self.port, False, upstream)
+        self.http_thread.start()
+
+        data = upstream.getChanges(50, 5)
+        self.assertEqual(struct.unpack('>ii', data[:8]), (41, 60))
+        self.assertEqual(struct.unpack('>ii', upstream.getChanges(10, 5)), (41, 60))
+
+        observer, fetched = self.makeObserver(changestreamwait=5)
+        t = time.time()
+        observer.syncBlocks(60)
+        self.assertLess(time.time() - t, 4)
+        self.assertEqual(observer.poolHeight, 60)
+
+        # The first fetch finds block 1 isn't retained, blocks up to 40 are processed locally without asking again
+        self.assertEqual(observer.change_stream_range, (41, 60))
+        self.assertEqual(fetched[0], 1)
+        self.assertEqual([h for h in fetched if h > 1 and h < 41], [])
+        self.assertIn(41, fetched)
+        self.assertFalse(observer.change_stream_local)
+        self.assertEqual(self.readDB(sp.DBT_BAL, os.path.join(self.data_dir, 'observer', 'stakepooldb')), self.readDB(sp.DBT_BAL))
+
+        # Only blocks above the upstream tip are waited for
+        observer.change_stream_wait = 1
+        t = time.time()
+        self.assertIsNone(observer.fetchChangeRecord(61))
+        self.assertGreaterEqual(time.time() - t, 1)
+
+    def test_invalid_request(self):
+        upstream = self.makePool(changestreamblocks=20)
+        self.startPool(upstream)
+        self.mine(upstream, 30)
+        url = self.startHttp(upstream) + '/changes/'
+        with urllib.request.urlopen(url + '25?count=3') as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.headers['Content-type'], 'application/octet-stream')
+            self.assertEqual(response.read(), upstream.getChanges(25, 3))
+        for path in ('x', '-1', '2147483648', '25?count=x', '25?count=0'):
+            self.expectHttpError(url + path)
+
+    def test_nothing_retained(self):
+        upstream = self.makePool()
+        self.startPool(upstream)
+        self.mine(upstream, 10)
+        self.http_thread = HttpThread(None, '127.0.0.1', self.port, False, upstream)
+        self.http_thread.start()
+        self.assertEqual(upstream.getChanges(1, 5), struct.pack('>ii', -1, -1))
+
+        observer, fetched = self.makeObserver(changestreamwait=5)
+        t = time.time()
+        observer.syncBlocks(10)
+        self.assertLess(time.time() - t, 4)
+        self.assertEqual(observer.poolHeight, 10)
+
+    def test_observer_near_tip(self):
+        # The master's planned payouts and payment jobs aren't streamed, an observer never sends
+        upstream = self.makePool(blockbuffer=10, changestreamblocks=200)
+        self.startPool(upstream)
+        self.mine(upstream, 150)
+        self.assertGreater(self.chain.num_sent, 0)
+        self.assertGreater(len(self.readDB(sp.DBT_POOL_PLANNED_PAYOUT)), 0)
+        self.http_thread = HttpThread(None, '127.0.0.1', self.port, False, upstream)
+        self.http_thread.start()
+
+        num_sent = self.chain.num_sent
+        observer, fetched = self.makeObserver(blockbuffer=10)
+        observer.syncBlocks(upstream.poolHeight)
+        self.assertEqual(observer.poolHeight, upstream.poolHeight)
+        self.assertFalse(observer.change_stream_local)
+        self.assertEqual(self.chain.num_sent, num_sent)
+        observer_db_path = os.path.join(self.data_dir, 'observer', 'stakepooldb')
+        self.assertEqual(self.readDB(sp.DBT_POOL_PLANNED_PAYOUT, observer_db_path), {})
+        self.assertEqual(self.readDB(sp.DBT_PAYMENT_JOB, observer_db_path), {})
+        self.assertEqual(self.readDB(sp.DBT_BAL, observer_db_path), self.readDB(sp.DBT_BAL))
+        for k, v in self.readDB(sp.DBT_CHANGES).items():
+            self.assertFalse(any(op[1][0] in sp.CHANGE_STREAM_EXCLUDED for op in sp.unpackChanges(v)[3]))
+
+
+class TestPendingPage(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = self.makePool()
+        self.startPool(self.pool)
+        self.mine(self.pool, 130)
+        self.expect = self.checkPendingIndex()
+        self.assertGreater(len(self.expect), 5)
+
+    def test_pages(self):
+        # Address order is the order of the decoded address bytes
+        expect = [(encodeAddress(k[1:]), format8(v)) for k, v in sorted(self.expect.items())]
+        found = []
+        cursor = None
+        while True:
+            page = self.pool.getPendingPage(cursor, 3)
+            self.assertEqual(page['total'], len(expect))
+            self.assertEqual(page['totalamount'], format8(sum(self.expect.values())))
+            self.assertLessEqual(len(page['pending']), 3)
+            found += [(r['address'], r['amount']) for r in page['pending']]
+            cursor = page['next']
+            if cursor is None:
+                break
+            self.assertEqual(cursor, found[-1][0])
+        self.assertEqual(found, expect)
+
+        page = self.pool.getPendingPage(None, len(expect))
+        self.assertEqual(len(page['pending']), len(expect))
+        self.assertEqual(page['next'], expect[-1][0])
+        page = self.pool.getPendingPage(page['next'], len(expect))
+        self.assertEqual(page['pending'], [])
+        self.assertIsNone(page['next'])
+
+        page = self.pool.getPendingPage(None, len(expect) + 1)
+        self.assertEqual(len(page['pending']), len(expect))
+        self.assertIsNone(page['next'])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError) as cm:
+            self.pool.getPendingPage('0OIl', 3)
+        self.assertEqual(str(cm.exception), 'Invalid cursor')
+
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        http_thread = HttpThread(None, '127.0.0.1', port, False, self.pool)
+        http_thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/json/pending' % (port)
+            with urllib.request.urlopen(url + '?limit=2') as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(len(json.loads(response.read())['pending']), 2)
+            for query in ('?cursor=0OIl', '?limit=x'):
+                with self.assertRaises(urllib.error.HTTPError) as cm:
+                    urllib.request.urlopen(url + query)
+                self.assertEqual(cm.exception.code, 400)
+                self.assertIn('error', json.loads(cm.exception.read()))
+        finally:
+            http_thread.stop()
+            http_thread.join()
+
+    def test_upgrading(self):
+        # The index is incomplete while its migration runs
+        self.pool.db_upgrading = True
+        for method in (self.pool.getPending, self.pool.getPendingPage):
+            with self.assertRaises(ValueError) as cm:
+                method()
+            self.assertEqual(str(cm.exception), 'Database is upgrading')
+        self.pool.db_upgrading = False
+        self.assertEqual(len(self.pool.getPending()), len(self.expect))
+
+    def test_list_accumulated_waits_for_index(self):
+        self.pool.db_version = sp.CURRENT_DB_VERSION - 1
+        with self.assertRaises(ValueError):
+            self.pool.listAccumulated(self.pool.poolHeight)
+
+
+class TestHistoryPage(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = self.makePool()
+        self.startPool(self.pool)
+
+    def readPages(self, name, limit, height=None):
+        found = []
+        cursor = None
+        while True:
+            page = self.pool.getHistoryPage(name, cursor, height, limit)
+            self.assertLessEqual(len(page[name]), limit)
+            found += page[name]
+            cursor = page['next']
+            if cursor is None:
+                return found
+
+    def test_pages(self):
+        self.mine(self.pool, 130)
+        blocks = [sp.unpackFoundBlock(k, v) for k, v in sorted(self.readDB(sp.DBT_POOL_BLOCK).items(), reverse=True)]
+        payouts = [sp.unpackPayout(k, v) for k, v in sorted(self.readDB(sp.DBT_POOL_PAYOUT).items(), reverse=True)]
+        self.assertGreater(len(payouts), 1)
+        for name, prefix, expect in (('blocks', sp.DBT_POOL_BLOCK, blocks), ('payouts', sp.DBT_POOL_PAYOUT, payouts)):
+            for limit in (1, 3, len(expect), len(expect) + 1):
+                self.assertEqual(self.readPages(name, limit), expect)
+
+            # A full last page returns a cursor to an empty page
+            page = self.pool.getHistoryPage(name, None, None, len(expect))
+            self.assertEqual(page['next'], min(self.readDB(prefix))[1:].hex())
+            page = self.pool.getHistoryPage(name, page['next'], None, len(expect))
+            self.assertEqual(page, {name: [], 'next': None})
+
+        # From height, the records at and below it
+        height = blocks[len(blocks) // 2][0]
+        self.assertEqual(self.readPages('blocks', 3, height), [r for r in blocks if r[0] <= height])
+        self.assertEqual(self.readPages('payouts', 3, height), [r for r in payouts if r[0] <= height])
+        self.assertEqual(self.readPages('blocks', 3, 0), [])
+
+    def test_empty(self):
+        for name in ('blocks', 'payouts'):
+            self.assertEqual(self.pool.getHistoryPage(name), {name: [], 'next': None})
+            self.assertEqual(self.pool.getHistoryPage(name, None, 100), {name: [], 'next': None})
+
+    def test_invalid(self):
+        self.mine(self.pool, 130)
+        url = self.startHttp(self.pool) + '/json/'
+        for name, cursor in (('blocks', '00000064'), ('payouts', '00000064' + '00' * 32)):
+            with urllib.request.urlopen(url + name + '?limit=2&cursor=' + cursor) as response:
+                self.assertEqual(response.status, 200)
+                self.assertTrue(all(r[0] < 100 for r in json.loads(response.read())[name]))
+
+            # Not hex, the wrong length, the other history's cursor and a negative height
+            other = '00000064' + '00' * 32 if name == 'blocks' else '00000064'
+            for bad in ('xyz', '0000006', '0000006400', other, 'ffffffff' + cursor[8:]):
+                with self.assertRaises(ValueError) as cm:
+                    self.pool.getHistoryPage(name, bad)
+                self.assertEqual(str(cm.exception), 'Invalid cursor')
+                self.assertIn('error', json.loads(self.expectHttpError(url + name + '?cursor=' + bad)))
+            for query in ('?height=-1', '?height=x', '?limit=x'):
+                self.expectHttpError(url + name + query)
+        self.expectHttpError(url + 'blocks?height=%d' % (0x7FFFFFFF))
+
+
+class TestSnapshot(PoolTestCase):
+    def test_round_trip(self):
+        pool = self.makePool()
+        self.startPool(pool)
+        self.mine(pool, 60)
+        path = os.path.join(self.data_dir, 'snapshot.gz')
+        self.assertEqual(pool.exportSnapshot(path), pool.poolHeight)
+        exported = {k: v for k, v in self.readDB().items() if sp.inSnapshot(k)}
+
+        import_dir = os.path.join(self.data_dir, 'import')
+        os.makedirs(import_dir)
+        imported = self.makePool(data_dir=import_dir, mode='observer')
+        imported.importSnapshot(path)
+        self.startPool(imported)
+        self.assertEqual(imported.poolHeight, pool.poolHeight)
+        import_db_path = os.path.join(import_dir, 'stakepooldb')
+        self.assertEqual(self.readDB(db_path=import_db_path), exported)
+
+        # Both continue syncing to the same state, less the records the master keeps for its own sends
+        self.mine(pool, 40)
+        imported.syncBlocks(self.chain.tip - imported.blockBuffer)
+        self.assertEqual(imported.poolHeight, pool.poolHeight)
+
+        def syncedRecords(records):
+            return {k: v for k, v in records.items()
+                    if k[0] not in (sp.DBT_POOL_PENDING_PAYOUT, sp.DBT_PAYOUT_STATUS) and k != bytes([sp.DBT_DATA]) + b'pool_fees'}
+        self.assertEqual(syncedRecords(self.readDB(db_path=import_db_path)), syncedRecords(self.readDB()))
+
+        with self.assertRaises(ValueError) as cm:
+            imported.importSnapshot(path)
+        self.assertEqual(str(cm.exception), 'Pool db is not empty')
+
+    def test_pool_state_excluded(self):
+        # Payout work, undo and change records and progress keys stay with the exporting pool
+        pool = self.makePool(blockbuffer=10, changestreamblocks=50)
+        self.startPool(pool)
+        self.mine(pool, 130)
+        operational = {
+            bytes([sp.DBT_PAYMENT_JOB]) + struct.pack('>i', 1): b'{}',
+            bytes([sp.DBT_METRICS_REBUILD]) + b'M2020-01': bytes(24),
+            bytes([sp.DBT_DATA]) + b'migration_progress': bytes(4),
+            bytes([sp.DBT_DATA]) + b'metrics_rebuild': bytes(4),
+        }
+        self.writeDB(operational)
+        prefixes = set(k[0] for k in self.readDB())
+        for prefix in (sp.DBT_POOL_PLANNED_PAYOUT, sp.DBT_PAYOUT_STATUS, sp.DBT_UNDO, sp.DBT_CHANGES):
+            self.assertIn(prefix, prefixes)
+
+        path = os.path.join(self.data_dir, 'snapshot.gz')
+        pool.exportSnapshot(path)
+        header, records = readSnapshot(path)
+        self.assertEqual(dict(records), {k: v for k, v in self.readDB().items() if sp.inSnapshot(k)})
+        excluded = (sp.DBT_PAYMENT_JOB, sp.DBT_POOL_PLANNED_PAYOUT, sp.DBT_PAYOUT_STATUS, sp.DBT_UNDO, sp.DBT_CHANGES, sp.DBT_METRICS_REBUILD)
+        self.assertFalse(any(k[0] in excluded for k, v in records))
+        self.assertFalse(any(k in operational for k, v in records))
+        self.assertIn(bytes([sp.DBT_DATA]) + b'pool_disbursed', dict(records))
+
+        # A snapshot of every record, as written by earlier versions, is imported without them
+        writer = SnapshotWriter(path, header['chain'], header['height'], header['blockhash'], header['db_version'])
+        for k, v in self.readDB().items():
+            writer.add(k, v)
+        writer.close()
+        import_dir = os.path.join(self.data_dir, 'import')
+        os.makedirs(import_dir)
+        imported = self.makePool(data_dir=import_dir)
+        logged = []
+        imported.log = lambda s, level=None: logged.append(s)
+        imported.importSnapshot(path)
+        self.assertEqual(self.readDB(db_path=os.path.join(import_dir, 'stakepooldb')), dict(records))
+        self.assertTrue(any('unsent payment runs' in s for s in logged))
+
+    def test_checks(self):
+        pool = self.makePool()
+        self.startPool(pool)
+        self.mine(pool, 20)
+        path = os.path.join(self.data_dir, 'snapshot.gz')
+        pool.exportSnapshot(path)
+
+        import_dir = os.path.join(self.data_dir, 'import')
+        os.makedirs(import_dir)
+        imported = self.makePool(data_dir=import_dir)
+        imported.chain = 'mainnet'
+        with self.assertRaises(ValueError) as cm:
+            imported.importSnapshot(path)
+        self.assertEqual(str(cm.exception), 'Snapshot is for chain testnet')
+
+        # The snapshot block is no longer in the chain
+        imported.chain = 'testnet'
+        rpc = imported.rpc_func
+        imported.rpc_func = lambda method, params=None, wallet=None: '00' * 32 if method == 'getblockhash' else rpc(method, params, wallet)
+        with self.assertRaises(ValueError):
+            imported.importSnapshot(path)
+        self.assertNotIn(bytes([sp.DBT_DATA]) + b'current_height', self.readDB(sp.DBT_DATA, db_path=os.path.join(import_dir, 'stakepooldb')))
+
+
+class TestUndo(PoolTestCase):
+    def test_change_recorder(self):
+        db_path = os.path.join(self.data_dir, 'recorderdb')
+        db = sp.plyvel.DB(db_path, create_if_missing=True)
+        try:
+            db.put(b'a', b'1')
+            db.put(b'd', b'4')
+            initial = dict(db.iterator())
+
+            recorder = sp.ChangeRecorder(db, undo=True)
+            recorder.put(b'a', b'2')
+            recorder.put(b'b', b'1')
+            recorder.put(b'a', b'3')
+            with recorder.write_batch(transaction=True) as b:
+                b.put(b'c', b'1')
+                b.delete(b'd')
+            # A cleared batch records no changes, the unchanged prior value is kept
+            b = recorder.write_batch(transaction=True)
+            b.put(b'e', b'1')
+            b.clear()
+            b.write()
+            with recorder.write_batch(undo=False, transaction=True) as b:
+                b.put(b'f', b'1')
+
+            self.assertEqual(recorder.ops, [
+                (sp.CHANGE_PUT, b'a', b'2'),
+                (sp.CHANGE_PUT, b'b', b'1'),
+                (sp.CHANGE_PUT, b'a', b'3'),
+                (sp.CHANGE_PUT, b'c', b'1'),
+                (sp.CHANGE_DELETE, b'd', None),
+                (sp.CHANGE_PUT, b'f', b'1'),
+            ])
+            # The first prior value of each key, writes with undo False are kept
+            self.assertEqual(sorted(recorder.undoOps()), [
+                (sp.CHANGE_PUT, b'a', b'1'),
+                (sp.CHANGE_PUT, b'd', b'4'),
+                (sp.CHANGE_DELETE, b'b', None),
+                (sp.CHANGE_DELETE, b'c', None),
+                (sp.CHANGE_DELETE, b'e', None),
+            ])
+
+            record = sp.packChanges(12, '11' * 32, b'pool', recorder.undoOps())
+            self.assertEqual(sp.unpackChanges(record), (12, '11' * 32, b'pool', recorder.undoOps()))
+            for op, k, v in sp.unpackChanges(record)[3]:
+                if op == sp.CHANGE_PUT:
+                    db.put(k, v)
+                else:
+                    db.delete(k)
+            # Except the write with undo False
+            initial[b'f'] = b'1'
+            self.assertEqual(dict(db.iterator()), initial)
+
+            self.assertIsNone(sp.ChangeRecorder(db).prior)
+        finally:
+            db.close()
+
+        with self.assertRaises(ValueError):
+            sp.unpackChanges(b'not a record')
+        data = sp.zlib.decompress(record)
+        with self.assertRaises(ValueError):
+            sp.unpackChanges(sp.zlib.compress(data[:10] + bytes([data[10] ^ 1]) + data[11:]))
+
+    def test_rollback(self):
+        pool = self.makePool(blockbuffer=10)
+        self.assertEqual(pool.undo_blocks, sp.COINBASE_MATURITY - 10)
+        self.startPool(pool)
+        self.mine(pool, 30)
+        fork_height = pool.poolHeight
+        at_fork = self.readDB()
+
+        self.mine(pool, 6)
+        self.assertEqual(pool.poolHeight, fork_height + 6)
+        self.assertNotEqual(self.readDB(), at_fork)
+
+        # The blocks above the fork are rolled back to the state at the fork
+        pool.rpc_func = ReorgRpc(self.chain, fork_height)
+        pool.processBlock(pool.poolHeight + 1)
+        self.assertEqual(pool.poolHeight, fork_height)
+        # Less the oldest undo records, pruned while processing the rolled back blocks
+        for height in range(fork_height - pool.undo_blocks + 1, fork_height - pool.undo_blocks + 7):
+            del at_fork[bytes([sp.DBT_UNDO]) + struct.pack('>i', height)]
+        self.assertEqual(self.readDB(), at_fork)
+
+        pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+        self.assertEqual(pool.poolHeight, fork_height + 6)
+        for height in range(fork_height + 1, pool.poolHeight + 1):
+            self.assertIsNone(self.readDB(sp.DBT_POOL_BLOCK).get(bytes([sp.DBT_POOL_BLOCK]) + struct.pack('>i', height)))
+            record = self.readDB(sp.DBT_UNDO)[bytes([sp.DBT_UNDO]) + struct.pack('>i', height)]
+            self.assertEqual(sp.unpackChanges(record)[1], pool.rpc_func.reorgHash(height))
+
+    def test_planned_payouts_after_undo_disabled(self):
+        # Payment runs planned with undo enabled are sent once 'blockbuffer' is raised again
+        pool = self.makePool(blockbuffer=10)
+        self.startPool(pool)
+        self.mine(pool, 30)
+        planned = self.readDB(sp.DBT_POOL_PLANNED_PAYOUT)
+        self.assertGreater(len(planned), 0)
+        self.stopPool(pool)
+
+        sends = []
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'sendtypeto':
+                sends.append(params[2])
+            return chain_rpc(method, params, wallet)
+
+        pool = self.makePool(rpc)
+        self.assertEqual(pool.undo_blocks, 0)
+        self.startPool(pool)
+        self.chain.tip += pool.blockBuffer - 10
+        self.mine(pool, 1)
+        self.assertEqual(self.readDB(sp.DBT_POOL_PLANNED_PAYOUT), {})
+        sent = [o for outputs in sends for o in outputs]
+        for v in planned.values():
+            for o in json.loads(v):
+                self.assertIn(o, sent)
+
+
+class TestPayoutCohorts(PoolTestCase):
+    def test_cohort(self):
+        addresses = [bytes([0x76]) + i.to_bytes(20, 'big') for i in range(1000)]
+        self.assertTrue(all(sp.payoutCohort(a, 1) == 0 for a in addresses))
+        counts = [0] * 4
+        for a in addresses:
+            cohort = sp.payoutCohort(a, 4)
+            self.assertEqual(cohort, sp.payoutCohort(a, 4))
+            counts[cohort] += 1
+        self.assertTrue(all(200 < n < 300 for n in counts))
+
+    def test_runs_rotate(self):
+        sends = []
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'sendtypeto':
+                sends.append((self.chain.tip, [sp.decodeAddress(o['address']) for o in params[2]]))
+            return chain_rpc(method, params, wallet)
+
+        parameters = [{'height': 0, 'payoutthreshold': 0.01, 'minblocksbetweenpayments': 30, 'payoutcohorts': 3}]
+        pool = self.makePool(rpc, parameters=parameters)
+        self.startPool(pool)
+        self.mine(pool, 130)
+
+        self.assertGreater(len(sends), 6)
+        cohorts = []
+        for tip, addresses in sends:
+            cohort = sp.payoutCohort(addresses[0], 3)
+            self.assertTrue(all(sp.payoutCohort(a, 3) == cohort for a in addresses))
+            cohorts.append(cohort)
+        # Runs every 10 blocks, each paying the next cohort
+        self.assertTrue(all(b == (a + 1) % 3 for a, b in zip(cohorts, cohorts[1:])))
+        self.assertTrue(all(b[0] - a[0] == 10 for a, b in zip(sends, sends[1:])))
+
+
+class TestRpcReplay(PoolTestCase):
+    def test_same_db(self):
+        # A pool replaying a recorded session writes the db the recording pool wrote
+        path = os.path.join(self.data_dir, 'rpc.jsonl.gz')
+        record_dir = os.path.join(self.data_dir, 'record')
+        os.makedirs(record_dir)
+        pool = self.makePool(data_dir=record_dir)
+        pool.rpc_func = RpcRecorder(pool.rpc_func, path)
+        self.startPool(pool)
+        heights = []
+        for i in range(130):
+            self.chain.mine()
+            pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+            heights.append(pool.poolHeight)
+        self.stopPool(pool)
+        num_sent = self.chain.num_sent
+        self.assertGreater(num_sent, 0)
+
+        replay = self.makePool(rpc=RpcReplay(path))
+        self.startPool(replay)
+        for height in heights:
+            replay.syncBlocks(height)
+        self.assertEqual(replay.poolHeight, heights[-1])
+        self.assertEqual(self.chain.num_sent, num_sent)
+        self.assertEqual(self.readDB(), self.readDB(db_path=os.path.join(record_dir, 'stakepooldb')))
+
+        # Calls that were not recorded fail
+        with self.assertRaises(ValueError):
+            replay.syncBlocks(heights[-1] + 1)
+        self.assertEqual(replay.poolHeight, heights[-1])
+
+
+class TestProvisional(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = self.makePool(provisional=True)
+        self.startPool(self.pool)
+        self.mine(self.pool, 130)
+
+    def accumulated(self):
+        return {k[1:]: int.from_bytes(v[:16], 'big') for k, v in self.readDB(sp.DBT_BAL).items()}
+
+    def lastPaymentRun(self):
+        return self.readDB(sp.DBT_DATA).get(bytes([sp.DBT_DATA]) + b'last_payment_run')
+
+    def test_preview(self):
+        pool = self.pool
+        before = self.readDB()
+        pool.updateProvisional(self.chain.tip)
+        self.assertEqual(self.readDB(), before)
+
+        provisional = pool.getProvisional()
+        self.assertEqual(sorted(provisional), list(range(pool.poolHeight + 1, self.chain.tip + 1)))
+        found = [h for h, v in provisional.items() if 'blockreward' in v]
+        self.assertEqual(found, [h for h in provisional if h % 2 == 0])
+        summary = pool.getSummary()
+        self.assertEqual(summary['provisional']['height'], self.chain.tip)
+        self.assertEqual(len(summary['provisional']['blocks']), len(found))
+        address = next(iter(provisional[found[0]]['credits']))
+        credits = [v['credits'][address] for v in provisional.values() if address in v['credits']]
+        self.assertEqual(pool.getAddressSummary(encodeAddress(address))['provisional'], {'accumulated': sum(credits), 'blocks': len(credits)})
+
+        # Each block credits what its preview showed once processed
+        compared = 0
+        for height in found:
+            accumulated = self.accumulated()
+            last_payment_run = self.lastPaymentRun()
+            pool.syncBlocks(height)
+            self.assertNotIn(height, pool.getProvisional())
+            block = self.readDB(sp.DBT_POOL_BLOCK)[bytes([sp.DBT_POOL_BLOCK]) + struct.pack('>i', height)]
+            self.assertEqual(int.from_bytes(block[32:40], 'big'), provisional[height]['blockreward'])
+            self.assertEqual(int.from_bytes(block[40:48], 'big'), provisional[height]['poolcointotal'])
+            if self.lastPaymentRun() != last_payment_run or height in self.chain.mined_txs:
+                continue  # Payment runs and payouts found also change the accumulated balances
+            credits = {k: v - accumulated.get(k, 0) for k, v in self.accumulated().items() if v != accumulated.get(k, 0)}
+            self.assertEqual(credits, provisional[height]['credits'])
+            compared += 1
+        self.assertGreater(compared, 5)
+
+    def test_reorg(self):
+        # The preview is recomputed once its highest block leaves the chain
+        pool = self.pool
+        pool.updateProvisional(self.chain.tip)
+        fork_height = pool.poolHeight + 10
+        rpc = ReorgRpc(self.chain, fork_height)
+        pool.rpc_func = rpc
+        pool.updateProvisional(self.chain.tip)
+        provisional = pool.getProvisional()
+        self.assertEqual(rpc.calls['getblockreward'], self.chain.tip - pool.poolHeight)
+        for height, entry in provisional.items():
+            if height > fork_height:
+                self.assertEqual(entry, {'blockhash': rpc.reorgHash(height), 'credits': {}})
+            else:
+                self.assertEqual(entry['blockhash'], self.chain.getBlockHash(height))
+
+        # Unchanged tip, nothing is fetched again
+        pool.updateProvisional(self.chain.tip)
+        self.assertEqual(rpc.calls['getblockreward'], self.chain.tip - pool.poolHeight)
+
+    def test_not_committed(self):
+        # Previewed blocks that are reorganised away leave the balances as a pool without previews would
+        reference_dir = os.path.join(self.data_dir, 'reference')
+        os.makedirs(reference_dir)
+        reference = self.makePool(data_dir=reference_dir)
+        self.startPool(reference)
+        reference.syncBlocks(self.pool.poolHeight)
+
+        self.pool.updateProvisional(self.chain.tip)
+        self.assertGreater(sum(len(v['credits']) for v in self.pool.getProvisional().values()), 0)
+        rpc = ReorgRpc(self.chain, self.pool.poolHeight)
+        for pool in (self.pool, reference):
+            pool.rpc_func = rpc
+        for i in range(30):
+            self.chain.mine()
+            for pool in (self.pool, reference):
+                pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+            self.pool.updateProvisional(self.chain.tip)
+        self.assertTrue(all(v['credits'] == {} for v in self.pool.getProvisional().values()))
+        self.assertEqual(self.readDB(sp.DBT_BAL), self.readDB(sp.DBT_BAL, os.path.join(reference_dir, 'stakepooldb')))
+        self.assertEqual(self.readDB(sp.DBT_POOL_BLOCK), self.readDB(sp.DBT_POOL_BLOCK, os.path.join(reference_dir, 'stakepooldb')))
+
+
+class TestProfiler(PoolTestCase):
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'Needs SIGUSR1')
+    def test_signal_during_sync(self):
+        # A profile requested while the pool is behind samples the sync
+        profiler = Profiler(self.data_dir, {'profileseconds': 0.5, 'profileinterval': 0.005})
+        profiler.watch()
+        prev_handler = signal.signal(signal.SIGUSR1, lambda sig, frame: profiler.request())
+        chain_rpc = ChainRpc(self.chain)
+        sampled_during_sync = []
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'getblockreward':
+                if params[0] == 10:
+                    os.kill(os.getpid(), signal.SIGUSR1)
+                elif params[0] > 10:
+                    time.sleep(0.005)
+                    if profiler.sampler is not None and profiler.sampler.num_samples > 0:
+                        sampled_during_sync.append(params[0])
+            return chain_rpc(method, params, wallet)
+
+        try:
+            pool = self.makePool(rpc)
+            self.chain.tip += 200
+            self.startPool(pool)
+            pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+            self.assertGreater(len(sampled_during_sync), 0)
+            profiler.sampler.join()
+        finally:
+            signal.signal(signal.SIGUSR1, prev_handler)
+            profiler.stop()
+        self.assertTrue(any('syncBlocks' in stack for stack in profiler.sampler.stacks))
+        self.assertTrue(os.path.exists(profiler.sampler.out_path))
+
+
+class TestConsolidation(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sends = []
+        chain_rpc = ChainRpc(self.chain)
+
+        def rpc(method, params=None, wallet=None):
+            if method == 'sendtypeto':
+                self.sends.append(params)
+            return chain_rpc(method, params, wallet)
+        self.rpc = rpc
+
+    def makeCoins(self):
+        coins = [{'txid': makeHash('coin%d' % (i)), 'vout': i % 2, 'address': REWARD_ADDRESS, 'amount': 0.05 * (12 - i)} for i in range(12)]
+        coins.append({'txid': makeHash('large'), 'vout': 0, 'address': REWARD_ADDRESS, 'amount': 2.0})
+        coins.append({'txid': makeHash('locked'), 'vout': 0, 'address': REWARD_ADDRESS, 'amount': 0.001, 'spendable': False})
+        self.chain.unspent = coins
+        return coins
+
+    def makeSyncedPool(self, **kwargs):
+        consolidation = {'minutxos': 5, 'maxinputs': 8, 'maxvalue': 1.0, 'idleblocks': 3, 'feerate': 0.0001}
+        pool = self.makePool(self.rpc, consolidation=consolidation, **kwargs)
+        self.startPool(pool)
+        self.mine(pool, 20)
+        self.makeCoins()
+        self.setLastPaymentRun(pool.poolHeight)
+        self.sends.clear()
+        return pool
+
+    def setLastPaymentRun(self, height):
+        self.writeDB({bytes([sp.DBT_DATA]) + b'last_payment_run': struct.pack('>i', height)})
+
+    def consolidate(self, pool, chain_height=None):
+        pool.consolidation_height = 0
+        num_sends = len(self.sends)
+        pool.consolidateRewardOutputs(self.chain.tip if chain_height is None else chain_height)
+        return len(self.sends) > num_sends
+
+    def test_consolidate(self):
+        pool = self.makeSyncedPool()
+        fees = self.readDB(sp.DBT_DATA).get(bytes([sp.DBT_DATA]) + b'pool_fees')
+        self.assertTrue(self.consolidate(pool))
+
+        # The smallest spendable coins below maxvalue, paid back to the reward address less the fee
+        params = self.sends[-1]
+        smallest = sorted((c for c in self.makeCoins() if c.get('spendable', True) and c['amount'] < 1.0), key=lambda c: c['amount'])[:8]
+        self.assertEqual(params[8]['inputs'], [{'tx': c['txid'], 'n': c['vout']} for c in smallest])
+        self.assertEqual(params[8]['changeaddress'], REWARD_ADDRESS)
+        self.assertEqual(params[8]['feeRate'], 0.0001)
+        self.assertEqual(params[2], [{'address': REWARD_ADDRESS, 'amount': format8(sum(sp.amountToSats(c['amount']) for c in smallest)), 'subfee': True}])
+        self.assertEqual(params[3], 'Stake pool consolidation')
+        n = self.readDB(sp.DBT_DATA)[bytes([sp.DBT_DATA]) + b'pool_fees']
+        self.assertGreater(int.from_bytes(n, 'big'), 0 if fees is None else int.from_bytes(fees, 'big'))
+
+        # Considered once per chain height
+        self.makeCoins()
+        pool.consolidateRewardOutputs(self.chain.tip)
+        self.assertEqual(len(self.sends), 1)
+
+    def test_skipped(self):
+        pool = self.makeSyncedPool()
+
+        # Behind the tip
+        self.assertFalse(self.consolidate(pool, self.chain.tip + 1))
+
+        # A payment run is due within idleblocks
+        self.setLastPaymentRun(pool.poolHeight - 8)
+        self.assertFalse(self.consolidate(pool))
+        self.setLastPaymentRun(pool.poolHeight)
+
+        # A payment job is queued
+        job_key = bytes([sp.DBT_PAYMENT_JOB]) + struct.pack('>i', pool.poolHeight)
+        self.writeDB({job_key: b'{}'})
+        self.assertFalse(self.consolidate(pool))
+        self.writeDB({}, [job_key])
+
+        # Too few small coins
+        self.chain.unspent = self.chain.unspent[8:]
+        self.assertFalse(self.consolidate(pool))
+        self.makeCoins()
+
+        self.assertTrue(self.consolidate(pool))
+
+        pool.mode = 'observer'
+        self.makeCoins()
+        self.assertFalse(self.consolidate(pool))
+
+    def test_planned_payout_due(self):
+        # With undo enabled the payment runs planned in the last undo_blocks are sent as their blocks mature
+        pool = self.makeSyncedPool(blockbuffer=10)
+        self.writeDB({}, list(self.readDB(sp.DBT_POOL_PLANNED_PAYOUT).keys()))
+        planned_key = bytes([sp.DBT_POOL_PLANNED_PAYOUT]) + struct.pack('>i', pool.poolHeight - pool.undo_blocks + 2)
+        self.writeDB({planned_key: b'[]'})
+        self.assertFalse(self.consolidate(pool))
+
+        self.writeDB({}, [planned_key])
+        self.writeDB({bytes([sp.DBT_POOL_PLANNED_PAYOUT]) + struct.pack('>i', pool.poolHeight): b'[]'})
+        self.assertTrue(self.consolidate(pool))
+
+    def test_serialised_with_sends(self):
+        pool = self.makeSyncedPool()
+        with sp.mxSend:
+            t = threading.Thread(target=self.consolidate, args=(pool,))
+            t.start()
+            time.sleep(0.2)
+            self.assertEqual(self.sends, [])
+        t.join()
+        self.assertEqual(len(self.sends), 1)
+
+
+class TestPaymentWorker(PoolTestCase):
+    def waitForJobs(self, pool):
+        for i in range(100):
+            if len(self.readDB(sp.DBT_PAYMENT_JOB)) == 0:
+                return
+            pool.payment_event.set()
+            time.sleep(0.05)
+        self.fail('Payment jobs not sent')
+
+    def test_sends_jobs(self):
+        pool = self.makePool(paymentworker=True)
+        self.startPool(pool)
+        self.assertIsNotNone(pool.payment_thread)
+        self.mine(pool, 130)
+        self.waitForJobs(pool)
+        self.assertGreater(self.chain.num_sent, 0)
+
+    def test_resync_skips_jobs(self):
+        # A pool far behind the node doesn't queue payments for past runs
+        pool = self.makePool(paymentworker=True)
+        self.startPool(pool)
+        for i in range(300):
+            self.chain.mine()
+        pool.syncBlocks(self.chain.tip - 2 * BLOCK_BUFFER)
+        self.assertEqual(pool.poolHeight, self.chain.tip - 2 * BLOCK_BUFFER)
+        self.assertEqual(self.readDB(sp.DBT_PAYMENT_JOB), {})
+        pool.payment_event.set()
+        time.sleep(0.2)
+        self.assertEqual(self.chain.num_sent, 0)
+
+        # Once caught up payments are queued again
+        self.mine(pool, 30)
+        self.waitForJobs(pool)
+        self.assertGreater(self.chain.num_sent, 0)
+
+
+class QueuedSubscriber():
+    # Stands in for the zmq subscriber, returns the queued multipart notifications
+    def __init__(self, socket):
+        self.socket = socket
+        self.parts = []
+        self.num_reads = 0
+
+    def notify(self, topic, body):
+        self.parts += [topic, body, struct.pack('<I', 0)]
+
+    def recv(self, flags=0):
+        if len(self.parts) < 1:
+            raise sp.zmq.Again()
+        self.num_reads += 1
+        return self.parts.pop(0)
+
+    def close(self):
+        self.socket.close()
+
+
+class TestCheckBlocks(PoolTestCase):
+    def test_drain(self):
+        pool = self.makePool()
+        self.startPool(pool)
+        self.mine(pool, 10)
+        pool.zmqSubscriber = QueuedSubscriber(pool.zmqSubscriber)
+
+        # Notifications queued between calls are all read, blocks are processed once
+        for i in range(5):
+            self.chain.mine()
+            pool.zmqSubscriber.notify(b'hashblock', bytes.fromhex(self.chain.getBlockHash(self.chain.tip)))
+            pool.zmqSubscriber.notify(b'hashtx', bytes(32))
+        num_calls = pool.rpc_func.calls.get('getblockchaininfo', 0)
+        pool.checkBlocks()
+        self.assertEqual(pool.zmqSubscriber.parts, [])
+        self.assertEqual(pool.zmqSubscriber.num_reads, 30)
+        self.assertEqual(pool.rpc_func.calls['getblockchaininfo'], num_calls + 1)
+        self.assertEqual(pool.poolHeight, self.chain.tip - pool.blockBuffer)
+
+        # Nothing queued
+        pool.checkBlocks()
+        self.assertEqual(pool.rpc_func.calls['getblockchaininfo'], num_calls + 1)
+
+    def test_rawblock_height(self):
+        self.chain = SyntheticChain(BLOCK_BUFFER, 20, 2, raw_blocks=True)
+        chain_rpc = ChainRpc(self.chain)
+        pool = self.makePool(zmqrawblock=True)
+        pool.rpc_func = RawBlockRpc(chain_rpc, pool.raw_blocks, pool.poolAddrReward, 0)
+        self.startPool(pool)
+        self.mine(pool, 10)
+        pool.zmqSubscriber = QueuedSubscriber(pool.zmqSubscriber)
+
+        # The tip height is read from the last rawblock, a later hashblock for another block asks the daemon
+        for i in range(3):
+            self.chain.mine()
+            pool.zmqSubscriber.notify(b'hashblock', bytes.fromhex(self.chain.getBlockHash(self.chain.tip)))
+            pool.zmqSubscriber.notify(b'rawblock', self.chain.rawBlock(self.chain.tip)['data'])
+        num_calls = chain_rpc.calls.get('getblockchaininfo', 0)
+        pool.checkBlocks()
+        self.assertEqual(chain_rpc.calls.get('getblockchaininfo', 0), num_calls)
+        self.assertEqual(pool.chainHeight, self.chain.tip)
+
+        self.chain.mine()
+        pool.zmqSubscriber.notify(b'rawblock', self.chain.rawBlock(self.chain.tip)['data'])
+        self.chain.mine()
+        pool.zmqSubscriber.notify(b'hashblock', bytes.fromhex(self.chain.getBlockHash(self.chain.tip)))
+        pool.checkBlocks()
+        self.assertEqual(chain_rpc.calls['getblockchaininfo'], num_calls + 1)
+        self.assertEqual(pool.chainHeight, self.chain.tip)
+        self.assertEqual(pool.poolHeight, self.chain.tip - pool.blockBuffer)
+
+
+class TestParallelSync(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        ports = []
+        for i in range(2):
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            ports.append(s.getsockname()[1])
+            s.close()
+        self.rpc_port, zmq_port = ports
+        # Worker processes fetch from the node over rpc
+        self.node = FakeParticld(self.chain, self.rpc_port, zmq_port)
+        self.node.start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.node.stop()
+
+    def test_same_db(self):
+        # Blocks synced with prefetching workers are applied as in a sequential sync
+        pool = self.makePool()
+        self.startPool(pool)
+        self.mine(pool, 130)
+        self.stopPool(pool)
+        self.assertGreater(len(self.chain.mined_txs), 0)
+        for i in range(60):
+            self.chain.mine()
+
+        dbs = []
+        for workers in (1, 3):
+            pool_dir = os.path.join(self.data_dir, 'workers%d' % (workers))
+            os.makedirs(pool_dir)
+            pool = self.makePool(data_dir=pool_dir, rpcport=self.rpc_port, syncworkers=workers, syncrangesize=20)
+            self.startPool(pool)
+            pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+            self.assertEqual(pool.poolHeight, self.chain.tip - pool.blockBuffer)
+            if workers > 1:
+                # Every chain data call was prefetched
+                for method in ('getblockreward', 'getaddressdeltas', 'getrawtransaction', 'listcoldstakeunspent'):
+                    self.assertNotIn(method, pool.rpc_func.calls)
+            self.stopPool(pool)
+            dbs.append(self.readDB(db_path=os.path.join(pool_dir, 'stakepooldb')))
+        self.assertGreater(len([k for k in dbs[0] if k[0] == sp.DBT_POOL_PAYOUT]), 0)
+        self.assertEqual(dbs[0], dbs[1])
+
+
+class TestRawBlocks(PoolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chain = SyntheticChain(BLOCK_BUFFER, 20, 2, raw_blocks=True)
+
+    def test_same_db(self):
+        # A pool reading blocks from rawblock notifications writes the same db as one using rpc
+        rpc_dir = os.path.join(self.data_dir, 'rpc')
+        os.makedirs(rpc_dir)
+        rpc_pool = self.makePool(data_dir=rpc_dir)
+        self.startPool(rpc_pool)
+
+        chain_rpc = ChainRpc(self.chain)
+        raw_pool = self.makePool(zmqrawblock=True, zmqrawblockverify=10)
+        self.assertIsNotNone(raw_pool.raw_blocks)
+        raw_pool.rpc_func = RawBlockRpc(chain_rpc, raw_pool.raw_blocks, raw_pool.poolAddrReward, 10, raw_pool.log)
+        self.startPool(raw_pool)
+
+        for i in range(130):
+            self.chain.mine()
+            self.assertEqual(raw_pool.ingestRawBlock(self.chain.rawBlock(self.chain.tip)['data']), self.chain.tip)
+            for pool in (rpc_pool, raw_pool):
+                pool.syncBlocks(self.chain.tip - pool.blockBuffer)
+
+        self.assertTrue(raw_pool.rpc_func.enabled)
+        self.assertGreater(raw_pool.rpc_func.num_answered, 10)
+        self.assertLess(chain_rpc.calls['getblockreward'], rpc_pool.rpc_func.calls['getblockreward'])
+        self.assertGreater(len(self.readDB(sp.DBT_POOL_PAYOUT)), 0)
+        self.assertEqual(self.readDB(sp.DBT_BAL), self.readDB(sp.DBT_BAL, os.path.join(rpc_dir, 'stakepooldb')))
+        self.assertEqual(self.readDB(sp.DBT_POOL_BLOCK), self.readDB(sp.DBT_POOL_BLOCK, os.path.join(rpc_dir, 'stakepooldb')))
+        self.assertEqual(self.readDB(sp.DBT_POOL_PAYOUT), self.readDB(sp.DBT_POOL_PAYOUT, os.path.join(rpc_dir, 'stakepooldb')))
+
+
+if __name__ == '__main__':
+    unittest.main()
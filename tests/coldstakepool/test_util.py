@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018-2024 The Particl Core developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+# coldstakepool$ pytest -v -s tests/coldstakepool/test_util.py
+
+import io
+import os
+import sys
+import time
+import decimal
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+import coldstakepool.util as util
+from coldstakepool import telemetry
+from coldstakepool.util import (
+    COIN,
+    MAX_FAST_AMOUNT,
+    AuditWriter,
+    make_rpc_func,
+    amountToSats,
+    fixedToInt,
+    format8,
+    format16,
+)
+from benchmarks.fakeparticld import FakeParticld, SyntheticChain
+
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestRpcBatch(unittest.TestCase):
+    def setUp(self):
+        self.chain = SyntheticChain(10, 5, 2)
+        self.node = FakeParticld(self.chain, freePort(), freePort())
+        self.node.start()
+        self.rpc_func = make_rpc_func('127.0.0.1', self.node.rpc_server.server_address[1], 'test:test')
+
+    def tearDown(self):
+        self.node.stop()
+
+    def test_batch(self):
+        calls = [('getblockhash', [h]) for h in range(1, 6)] + [('getblockheader', [self.rpc_func('getblockhash', [2])])]
+        rv = self.rpc_func.batch(calls)
+        self.assertEqual(rv, [self.rpc_func(method, params) for method, params in calls])
+        self.assertEqual(self.rpc_func.batch([]), [])
+
+    def test_batch_error(self):
+        with self.assertRaises(ValueError) as cm:
+            self.rpc_func.batch([('getblockhash', [1]), ('nosuchmethod', [])])
+        self.assertIn('nosuchmethod', str(cm.exception))
+
+
+class TestAuditWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp(prefix='csp_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def readFile(self, name):
+        with open(os.path.join(self.dir_path, name)) as fp:
+            return fp.read()
+
+    def test_write(self):
+        with open(os.path.join(self.dir_path, 'a.csv'), 'w') as fp:
+            fp.write('header\n')
+        writer = AuditWriter(self.dir_path, max_open_files=2)
+        writer.start()
+        misses = telemetry.cache_requests.values.get(('auditfiles', 'miss'), 0)
+        expect = {'a.csv': 'header\n', 'b.csv': '', 'c.csv': ''}
+        for i in range(30):
+            name = 'abc'[i % 3] + '.csv'
+            writer.write(name, '%d,%s\n' % (i, name))
+            expect[name] += '%d,%s\n' % (i, name)
+        writer.stop()
+        self.assertFalse(writer.is_alive())
+
+        # Files closed to stay under max_open_files are appended to when reopened
+        for name, lines in expect.items():
+            self.assertEqual(self.readFile(name), lines)
+        self.assertEqual(telemetry.cache_requests.values.get(('auditfiles', 'miss'), 0) - misses, 30)
+        self.assertEqual(writer.files, {})
+
+    def test_flush_interval(self):
+        # Lines reach the file while the writer runs
+        writer = AuditWriter(self.dir_path, flush_interval=0.05)
+        writer.start()
+        try:
+            writer.write('pool.csv', '1,2\n')
+            for i in range(100):
+                if os.path.exists(os.path.join(self.dir_path, 'pool.csv')) and self.readFile('pool.csv') == '1,2\n':
+                    break
+                time.sleep(0.02)
+            self.assertEqual(self.readFile('pool.csv'), '1,2\n')
+            self.assertIn('pool.csv', writer.files)
+        finally:
+            writer.stop()
+
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp(prefix='csp_test_')
+        self.path = os.path.join(self.dir_path, 'stakepool.log')
+
+    def tearDown(self):
+        util.stopLogThread()
+        util.setLogLevel(util.LOG_DEBUG)
+        shutil.rmtree(self.dir_path)
+
+    def writeLevels(self, fp):
+        for name, level in sorted(util.LOG_LEVELS.items(), key=lambda x: x[1]):
+            util.logmt(fp, name, printstd=False, log_time=False, level=level)
+            util.logm(fp, name + ' tagged', tag='t ', printstd=False, level=level)
+
+    def readLog(self):
+        with open(self.path) as fp:
+            return fp.read().splitlines()
+
+    def test_levels(self):
+        # Without the log thread lines are written and flushed as logged
+        with open(self.path, 'w') as fp:
+            self.writeLevels(fp)
+            self.assertEqual(len(self.readLog()), 8)
+            util.setLogLevel('warning')
+            self.writeLevels(fp)
+        self.assertEqual(self.readLog()[8:], ['warning', 't warning tagged', 'error', 't error tagged'])
+
+    def test_thread(self):
+        util.setLogLevel('info')
+        util.startLogThread(flush_interval=0.05)
+        self.assertIsNotNone(util.log_thread)
+        stdout = io.StringIO()
+        with open(self.path, 'w') as fp, mock.patch.object(sys, 'stdout', stdout):
+            self.writeLevels(fp)
+            for i in range(100):
+                util.logm(fp, str(i), printstd=i % 10 == 0)
+            util.logm(fp, 'skipped', level=util.LOG_DEBUG)
+            util.stopLogThread()
+        self.assertIsNone(util.log_thread)
+        lines = self.readLog()
+        self.assertEqual(lines[:6], ['info', 't info tagged', 'warning', 't warning tagged', 'error', 't error tagged'])
+        self.assertEqual(lines[6:], [str(i) for i in range(100)])
+        self.assertEqual(stdout.getvalue().splitlines(), [str(i) for i in range(0, 100, 10)])
+
+
+class TestAmounts(unittest.TestCase):
+    def test_fixed_to_int(self):
+        self.assertEqual(fixedToInt('1.5'), 150000000)
+        self.assertEqual(fixedToInt('-0.00000001'), -1)
+        self.assertEqual(fixedToInt(' 12 '), 12 * COIN)
+        self.assertEqual(fixedToInt('.1'), 10000000)
+        self.assertEqual(fixedToInt('-.1'), -10000000)
+        with self.assertRaises(ValueError):
+            fixedToInt('1.123456789')
+        with self.assertRaises(ValueError):
+            fixedToInt('1e-08')
+        for v in (0, 1, -1, 123456789, -987654321012345678):
+            self.assertEqual(fixedToInt(format8(v)), v)
+            self.assertEqual(fixedToInt(format16(v), 16), v)
+
+    def test_amount_to_sats(self):
+        self.assertEqual(amountToSats(0.1 + 0.2), 30000000)
+        self.assertEqual(amountToSats(0.00000001), 1)
+        self.assertEqual(amountToSats(1e-08), 1)
+        self.assertEqual(amountToSats(-1e-08), -1)
+        self.assertEqual(amountToSats(-0.29), -29000000)
+        self.assertEqual(amountToSats(2), 2 * COIN)
+        self.assertEqual(amountToSats(-3), -3 * COIN)
+        self.assertEqual(amountToSats('1.23456789'), 123456789)
+        self.assertEqual(amountToSats('-0.5'), -50000000)
+        self.assertEqual(amountToSats(decimal.Decimal('0.00012345')), 12345)
+        self.assertEqual(amountToSats(1.5e-9), 0)
+        self.assertEqual(amountToSats(2.5e-8), 2)  # Round half to even
+
+        # Either side of the float fast path
+        self.assertEqual(amountToSats(MAX_FAST_AMOUNT), int(MAX_FAST_AMOUNT) * COIN)
+        self.assertEqual(amountToSats(-MAX_FAST_AMOUNT), -int(MAX_FAST_AMOUNT) * COIN)
+        self.assertEqual(amountToSats(9999999.99999999), 999999999999999)
+        self.assertEqual(amountToSats(-9999999.99999999), -999999999999999)
+        self.assertEqual(amountToSats(10000000.00000001), 1000000000000001)
+        self.assertEqual(amountToSats(21000000.12345678), 2100000012345678)
+
+        # Every 8 decimal string parsed as a float from rpc json converts exactly
+        for sats in (1, 99999999, 100000001, 123456789012, 999999999999999, 1000000000000001, 2100000012345678):
+            for v in (sats, -sats):
+                self.assertEqual(amountToSats(float(format8(v))), v)
+
+    def test_payout_arithmetic(self):
+        # The 8 digit Decimal context rounded amounts of 1 PART or more, the pool fee split is now exact
+        block_reward = 1.23456789
+        with decimal.localcontext() as ctx:
+            ctx.prec = 8
+            old_reward = int(+decimal.Decimal(repr(block_reward)) * COIN)
+        self.assertEqual(old_reward, 123456790)
+
+        blockReward = amountToSats(block_reward)
+        self.assertEqual(blockReward, 123456789)
+        poolFeePercent = 2
+        poolReward = int((blockReward * (poolFeePercent * (COIN // 100))) // COIN)
+        self.assertEqual(poolReward, 2469135)
+        self.assertEqual(blockReward - poolReward, 120987654)
+
+
+if __name__ == '__main__':
+    unittest.main()